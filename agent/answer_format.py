@@ -0,0 +1,179 @@
+"""
+Answer validation against format hints.
+
+A format hint ("int", "float", "str", "bool", "{category:str, quantity:int}",
+"list[{product:str, revenue:float}]", nested freely) is parsed once into a
+validator (compile_format_hint, cached per hint). A validator coerces a
+synthesized answer into the hinted shape and returns (ok, value, problem),
+where problem says what did not match, to be fed back to the synthesizer.
+Answers given as strings are parsed as JSON or as a Python literal first.
+
+Only a top-level int / float answer may be pulled out of text ("about 14
+days" -> 14). Fields of objects and list items must already have the
+hinted type (a number for int / float, true / false for bool), so
+{"quantity": "12 units"} is rejected rather than guessed at.
+"""
+import ast
+import json
+import re
+from functools import lru_cache
+
+_INT_RE = re.compile(r"\d+")
+_FLOAT_RE = re.compile(r"[-+]?\d*\.\d+|\d+")
+
+
+def _parse_literal(value):
+    """value parsed from JSON / Python literal syntax, or None."""
+    text = value.strip()
+    for parse in (json.loads, ast.literal_eval):
+        try:
+            return parse(text)
+        except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+            continue
+    return None
+
+
+def _int(value):
+    if isinstance(value, (int, float)):
+        return True, int(value), None
+    if isinstance(value, str):
+        nums = _INT_RE.findall(value)
+        if nums:
+            return True, int(nums[0]), None
+    return False, value, f"expected an integer, got {value!r}"
+
+
+def _float(value):
+    if isinstance(value, (int, float)):
+        return True, float(value), None
+    if isinstance(value, str):
+        nums = _FLOAT_RE.findall(value)
+        if nums:
+            return True, float(nums[0]), None
+    return False, value, f"expected a number, got {value!r}"
+
+
+def _str(value):
+    if isinstance(value, str):
+        return True, value, None
+    return False, value, f"expected a string, got {value!r}"
+
+
+def _bool(value):
+    if isinstance(value, bool):
+        return True, value, None
+    if isinstance(value, str) and value.strip().lower() in ("true", "yes", "false", "no"):
+        return True, value.strip().lower() in ("true", "yes"), None
+    return False, value, f"expected true/false, got {value!r}"
+
+
+def _int_field(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return True, int(value), None
+    return False, value, f"expected an integer, got {value!r}"
+
+
+def _float_field(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return True, float(value), None
+    return False, value, f"expected a number, got {value!r}"
+
+
+def _bool_field(value):
+    if isinstance(value, bool):
+        return True, value, None
+    return False, value, f"expected true/false, got {value!r}"
+
+
+_SCALARS = {"int": _int, "float": _float, "str": _str, "bool": _bool}
+# Inside objects and lists: no extraction from strings.
+_FIELD_SCALARS = {"int": _int_field, "float": _float_field, "str": _str, "bool": _bool_field}
+
+
+def _object(fields):
+    keys = ", ".join(key for key, _ in fields)
+
+    def validate(raw):
+        value = _parse_literal(raw) if isinstance(raw, str) else raw
+        if not isinstance(value, dict):
+            return False, raw, f"expected an object with keys {keys}"
+        fixed = {}
+        for key, check in fields:
+            if key not in value:
+                return False, raw, f"missing key {key!r} (expected keys {keys})"
+            ok, item, problem = check(value[key])
+            if not ok:
+                return False, raw, f"{key}: {problem}"
+            fixed[key] = item
+        return True, fixed, None
+    return validate
+
+
+def _list(item_check):
+    def validate(raw):
+        value = _parse_literal(raw) if isinstance(raw, str) else raw
+        if isinstance(value, tuple):
+            value = list(value)
+        if not isinstance(value, list):
+            return False, raw, "expected a list"
+        fixed = []
+        for i, item in enumerate(value):
+            ok, item, problem = item_check(item)
+            if not ok:
+                return False, raw, f"item {i}: {problem}"
+            fixed.append(item)
+        return True, fixed, None
+    return validate
+
+
+def _accept(value):
+    return True, value, None
+
+
+def _split_top(text):
+    """Split on commas outside brackets / braces."""
+    parts, depth, start = [], 0, 0
+    for i, ch in enumerate(text):
+        if ch in "[{":
+            depth += 1
+        elif ch in "]}":
+            depth -= 1
+        elif ch == "," and depth == 0:
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return [p for p in parts if p]
+
+
+def _compile(hint, nested=False):
+    if hint in _SCALARS:
+        return (_FIELD_SCALARS if nested else _SCALARS)[hint]
+    if hint.startswith("list[") and hint.endswith("]"):
+        return _list(_compile(hint[5:-1], nested=True))
+    if hint.startswith("{") and hint.endswith("}"):
+        fields = []
+        for part in _split_top(hint[1:-1]):
+            key, sep, type_hint = part.partition(":")
+            if not sep or not key:
+                raise ValueError(f"bad field {part!r}")
+            fields.append((key.strip("'\""), _compile(type_hint, nested=True)))
+        return _object(fields)
+    raise ValueError(f"unknown type {hint!r}")
+
+
+@lru_cache(maxsize=256)
+def compile_format_hint(format_hint):
+    """
+    Validator for format_hint. Hints that cannot be parsed get a validator
+    that accepts any answer as-is.
+    """
+    hint = re.sub(r"\s+", "", format_hint or "")
+    try:
+        return _compile(hint)
+    except (ValueError, RecursionError):
+        return _accept
+
+
+def validate_answer(value, format_hint):
+    """(ok, coerced value, problem or None) for an answer against format_hint."""
+    return compile_format_hint(format_hint)(value)
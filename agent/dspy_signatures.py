@@ -1,3 +1,5 @@
+import inspect
+
 import dspy
 
 # 1. Router
@@ -69,9 +71,11 @@ CRITICAL:
 - If you use p.CategoryID or p.ProductName, you MUST JOIN products p.
 
 NOW: Generate the query for the current question using the Plan. Output ONLY the SQL, nothing else."""
+    # db_schema first: it only changes with the DB, so it extends the prompt
+    # prefix a server-side KV cache can reuse across questions.
+    db_schema = dspy.InputField()
     question = dspy.InputField()
     plan = dspy.InputField(desc="Date ranges and logic extracted by the Planner")
-    db_schema = dspy.InputField() 
     previous_error = dspy.InputField()
     
     sql_query = dspy.OutputField(desc="A single valid SQLite SELECT query with NO extra text")
@@ -98,4 +102,29 @@ class SynthesizeAnswer(dspy.Signature):
     format_hint = dspy.InputField()
     
     final_answer = dspy.OutputField(desc="The answer value matching format_hint EXACTLY (int, float, dict, or list) based ONLY on context")
-    explanation = dspy.OutputField(desc="Short explanation (1-2 sentences), acknowledging if data was unavailable")
\ No newline at end of file
+    explanation = dspy.OutputField(desc="Short explanation (1-2 sentences), acknowledging if data was unavailable")
+
+# 5. Fused Planner + SQL Generator (one LLM call instead of two)
+class PlanAndGenerateSQL(dspy.Signature):
+    """First extract the plan, then write the SQL.
+
+    PLAN: From the Context and Question extract (a) the actual DATE RANGE and (b) category names
+    like 'Beverages' or 'Dairy Products'. Marketing calendar names (like 'Summer Beverages 1997')
+    are DOCUMENTATION ONLY: resolve them to their dates, never use them as filters or columns.
+
+    SQL: Write the query for the Question using your own date_range and filters."""
+    db_schema = dspy.InputField()
+    question = dspy.InputField()
+    context = dspy.InputField(desc="Retrieved documents with dates and policies")
+    previous_error = dspy.InputField()
+
+    date_range = dspy.OutputField(desc="Start and End dates in YYYY-MM-DD format (or 'None')")
+    filters = dspy.OutputField(desc="Category names or product filters (NOT marketing calendar event names)")
+    sql_query = dspy.OutputField(desc="A single valid SQLite SELECT query with NO extra text")
+
+
+# Same SQL rules as GenerateSQL, so both graph modes are judged on the plan step alone.
+PlanAndGenerateSQL.__doc__ = (
+    inspect.cleandoc(PlanAndGenerateSQL.__doc__) + "\n\n"
+    + GenerateSQL.__doc__.split("NOW:")[0].rstrip()
+)
@@ -1,27 +1,123 @@
-import dspy 
+import threading
+from functools import partial
 from typing import TypedDict, List
-from langgraph.graph import StateGraph, END  #type:ignore
-
-# Import components
-from agent.dspy_signatures import RouterSignature, PlannerSignature, GenerateSQL, SynthesizeAnswer
-from agent.rag.retrieval import LocalRetriever
-from agent.tools.sqlite_tool import get_schema_string, execute_query
-
-# -- SETUP DSPy --
-lm = dspy.LM(
-    "ollama_chat/llama3.1:8b",
-    api_base="http://localhost:11434",
-    api_key=""
-)
-dspy.configure(lm=lm)
-
-# Initialize base Modules (router / planner / synthesizer / retriever are fixed;
-# the SQL generator can be overridden, e.g. with a DSPy-optimized module).
-router = dspy.Predict(RouterSignature)
-planner = dspy.Predict(PlannerSignature)
-sql_gen = dspy.ChainOfThought(GenerateSQL)
-synthesizer = dspy.Predict(SynthesizeAnswer)
-retriever = LocalRetriever()
+
+# Heavy components (DSPy LM + predictors, retriever) are built lazily by the
+# shared AgentRuntime; dspy and langgraph are imported only when needed.
+from agent.llm_cache import LLMCache, signature_name
+from agent.prompt_budget import (FIELD_BUDGETS, RAG_CONTEXT_BUDGET, SCHEMA_BUDGET, estimate_tokens,
+                                 fit_chunks, fit_inputs, fit_table)
+from agent.routing import log_route, normalize_route
+from agent.runtime import get_runtime
+from agent.tools.schema import get_schema_string
+from agent.tools.sql_repair import run_with_repair
+from agent.tools.sql_templates import match_template
+from agent.tracing import span, traced_node
+from agent.tools.sqlite_tool import execute_query
+
+# Caps how many LLM calls are in flight at once across worker threads
+# (a local Ollama server only has so many cores to share).
+_llm_slots = threading.BoundedSemaphore(1)
+
+
+def set_max_llm_calls(n: int):
+    """Allow up to n concurrent LLM calls (call before starting workers)."""
+    global _llm_slots
+    _llm_slots = threading.BoundedSemaphore(max(1, int(n)))
+
+
+# Prefetch branch: start planning before the router finishes when local
+# signals (rules, or the classifier at this confidence) say "hybrid".
+SPECULATIVE_PLAN_THRESHOLD = 0.6
+_spec_lock = threading.Lock()
+_spec_stats = {"started": 0, "used": 0, "discarded": 0}
+
+
+def speculation_stats():
+    """Counters of speculative planning (started / used / discarded)."""
+    with _spec_lock:
+        return dict(_spec_stats)
+
+
+def _count_speculation(key):
+    with _spec_lock:
+        _spec_stats[key] += 1
+
+
+# Persistent response cache in front of every DSPy module call.
+llm_cache = LLMCache()
+
+
+def configure_llm_cache(enabled: bool = True, **kwargs):
+    """Replace the LLM response cache (kwargs go to LLMCache), or disable it."""
+    global llm_cache
+    if llm_cache is not None:
+        llm_cache.close()
+    llm_cache = LLMCache(**kwargs) if enabled else None
+
+
+# Queue priority per signature for LMs with their own request queue
+# (agent.ollama_lm.OllamaLM); lower runs first, so later stages win.
+LLM_PRIORITIES = {
+    "SynthesizeAnswer": 0,
+    "ChainOfThought(sql_query)": 1,
+    "ChainOfThought(date_range,filters,sql_query)": 1,
+    "PlannerSignature": 2,
+    "RouterSignature": 3,
+}
+
+
+def _run_llm(module, name, **kwargs):
+    import dspy
+
+    if getattr(dspy.settings.lm, "queues_requests", False):
+        # The LM bounds concurrency itself; let its priority queue order calls.
+        from agent.ollama_lm import DEFAULT_PRIORITY, request_priority
+
+        with request_priority(LLM_PRIORITIES.get(name, DEFAULT_PRIORITY)), dspy.context(track_usage=True):
+            return module(**kwargs)
+    with _llm_slots, dspy.context(track_usage=True):
+        return module(**kwargs)
+
+
+def _record_usage(attrs, pred):
+    """Add prompt/completion token counts of pred to span attrs."""
+    try:
+        usage = pred.get_lm_usage() or {}
+    except Exception:
+        return
+    for stats in usage.values():
+        for field in ("prompt_tokens", "completion_tokens"):
+            attrs[field] = attrs.get(field, 0) + int((stats or {}).get(field) or 0)
+
+
+def call_llm(module, **kwargs):
+    """Run a DSPy module, served from the response cache when possible."""
+    import dspy
+
+    runtime = get_runtime()
+    runtime.lm  # make sure an LM is configured before the first call
+    name = signature_name(module)
+    kwargs, budget = fit_inputs(name, kwargs)
+    if budget["trimmed"]:  # the span records the numbers for every call
+        print(f"[budget] {name}: ~{budget['used']}/{budget['budget']} input tokens trimmed={budget['trimmed']}")
+    with span(name, "llm", input_tokens_est=budget["used"], input_budget=budget["budget"],
+              trimmed=budget["trimmed"]) as attrs:
+        if llm_cache is None:
+            pred = _run_llm(module, name, **kwargs)
+            _record_usage(attrs, pred)
+            return pred
+
+        key = llm_cache.make_key(module, kwargs, runtime.model_id())
+        cached = llm_cache.get(key)
+        attrs["cache_hit"] = cached is not None
+        if cached is not None:
+            return dspy.Prediction(**cached)
+
+        pred = _run_llm(module, name, **kwargs)
+        _record_usage(attrs, pred)
+        llm_cache.put(key, name, dict(pred.items()))
+        return pred
 
 
 # -- STATE --
@@ -38,39 +134,66 @@ class AgentState(TypedDict):
     retry_count: int
     # Heuristic signal: max BM25 score from retriever for this question
     retrieval_score: float
+    # True while plan (and, fused, sql_query) came from speculative planning
+    speculative: bool
+    # Why the previous final_answer was rejected (set by resynthesize())
+    format_feedback: str
     final_output: dict
 
 
 # -- NODES --
 
-def route_question(state: AgentState):
-    """Route question to rag / sql / hybrid, with a small rule-based override for obvious cases."""
-    question_text = state["question"]
-    q_lower = question_text.lower()
-
-    pred = router(question=question_text)
-    route = pred.classification.lower().strip()
-
-    # Heuristic overrides to improve behavior on known patterns
+def _heuristic_route(q_lower, route):
+    """Heuristic overrides to improve behavior on known patterns."""
     if ("product policy" in q_lower or "returns & policy" in q_lower or "return window" in q_lower 
         or "return" in q_lower and ("days" in q_lower or "policy" in q_lower)
         or "according to" in q_lower and "policy" in q_lower):
         # Pure policy questions should rely on docs only.
-        route = "rag"
+        return "rag"
     elif any(kw in q_lower for kw in ["kpi", "average order value", "aov", "gross margin"]):
         # KPI questions that reference campaigns should usually be hybrid.
         if "summer beverages" in q_lower or "winter classics" in q_lower:
-            route = "hybrid"
+            return "hybrid"
+    return route
+
+
+def route_question(state: AgentState):
+    """
+    Route question to rag / sql / hybrid, with a small rule-based override for obvious cases.
 
-    print(f"[router] route={route}")
+    A local classifier answers first; the LLM router is only called when the
+    classifier is missing or below the runtime's confidence threshold.
+    """
+    question_text = state["question"]
+    q_lower = question_text.lower()
+    runtime = get_runtime()
+
+    route, source, confidence = None, "llm", None
+    clf = runtime.route_classifier
+    if clf is not None:
+        clf_route, confidence = clf.predict(question_text)
+        if confidence >= runtime.router_threshold:
+            route, source = clf_route, "classifier"
+
+    if route is None:
+        pred = call_llm(runtime.router, question=question_text)
+        route = pred.classification.lower().strip()
+    heuristic_input = route
+    route = _heuristic_route(q_lower, route)
+
+    if route != heuristic_input:
+        source = "rule"
+    log_route(question_text, normalize_route(route), source, confidence)
+    print(f"[router] route={route} source={source}")
     return {"route": route}
 
 
 def retrieve_docs(state: AgentState):
-    results = retriever.search(state["question"])
-    # results are (content, doc_id, score)
-    context_str = "\n".join([r[0] for r in results])
-    citations = [r[1] for r in results]
+    results = get_runtime().retriever.search(state["question"])
+    # results are (content, doc_id, score), best first; keep what fits the budget
+    chunks = fit_chunks([r[0] for r in results], RAG_CONTEXT_BUDGET)
+    context_str = "\n".join(chunks)
+    citations = [r[1] for r in results[:len(chunks)]]
     scores = [r[2] for r in results] if results else []
     retrieval_score = max(scores) if scores else 0.0
     print(f"[retrieve_docs] k={len(results)} citations={citations} max_score={retrieval_score:.3f}")
@@ -78,7 +201,8 @@ def retrieve_docs(state: AgentState):
 
 
 def planner_node(state: AgentState):
-    pred = planner(
+    pred = call_llm(
+        get_runtime().planner,
         question=state["question"],
         context=state.get("rag_context", "")
     )
@@ -87,19 +211,10 @@ def planner_node(state: AgentState):
     return {"plan": plan_str}
 
 
-def generate_sql_node(state: AgentState):
-    schema_str = get_schema_string()
-    prev_error = state.get("error", "")
-
-    pred = sql_gen(
-        question=state["question"],
-        plan=state.get("plan", ""),
-        db_schema=schema_str,
-        previous_error=prev_error
-    )
-
+def clean_sql(raw: str):
+    """Strip markdown fences, commentary and extra statements from LLM SQL output."""
     # Aggressive SQL cleaning to handle model errors
-    raw = pred.sql_query.strip()
+    raw = raw.strip()
     
     # Remove markdown code fences
     raw = raw.replace("```sql", "").replace("```", "")
@@ -122,9 +237,60 @@ def generate_sql_node(state: AgentState):
         if line.strip():
             lines.append(line)
     
-    clean_sql = "\n".join(lines).strip()
-    print(f"[generate_sql] sql={clean_sql}")
-    return {"sql_query": clean_sql}
+    return "\n".join(lines).strip()
+
+
+def generate_sql_node(state: AgentState, sql_module=None):
+    prev_error = state.get("error", "")
+
+    # Known KPI shapes get deterministic SQL; the LLM handles everything else
+    # and repairs a template query that failed.
+    if not prev_error:
+        template = match_template(state["question"], state.get("plan", ""))
+        if template is not None:
+            name, sql = template
+            print(f"[generate_sql] template={name} sql={sql}")
+            return {"sql_query": sql}
+
+    schema_str = get_schema_string(max_tokens=SCHEMA_BUDGET)
+
+    pred = call_llm(
+        sql_module or get_runtime().sql_gen,
+        question=state["question"],
+        plan=state.get("plan", ""),
+        db_schema=schema_str,
+        previous_error=prev_error
+    )
+
+    clean = clean_sql(pred.sql_query)
+    print(f"[generate_sql] sql={clean}")
+    return {"sql_query": clean}
+
+
+def plan_sql_node(state: AgentState):
+    """
+    Fused mode: planner + SQL generator in one LLM call. Produces the same
+    state (plan, sql_query) as planner_node -> generate_sql_node, so repairs
+    go through generate_sql_node with this plan.
+    """
+    # Templates can still fire when the question itself pins the period.
+    template = match_template(state["question"])
+    if template is not None:
+        name, sql = template
+        print(f"[plan_sql] template={name} sql={sql}")
+        return {"sql_query": sql, "plan": ""}
+
+    pred = call_llm(
+        get_runtime().plan_sql,
+        question=state["question"],
+        context=state.get("rag_context", ""),
+        db_schema=get_schema_string(max_tokens=SCHEMA_BUDGET),
+        previous_error=""
+    )
+    plan_str = f"Date Range: {pred.date_range}\nFilters: {pred.filters}\nLogic: (fused)"
+    clean = clean_sql(pred.sql_query)
+    print(f"[plan_sql] plan={plan_str.replace(chr(10), ' | ')} sql={clean}")
+    return {"plan": plan_str, "sql_query": clean}
 
 
 def execute_sql_node(state: AgentState):
@@ -134,6 +300,13 @@ def execute_sql_node(state: AgentState):
 
     if error:
         print(f"[execute_sql] error={error}")
+        # Mechanical errors (ambiguous column, missing join, YEAR()) are fixed
+        # locally; only what the rules cannot fix costs an LLM retry.
+        repaired = run_with_repair(query, error)
+        if repaired is not None:
+            query, result = repaired
+            print("[execute_sql] success (repaired locally)")
+            return {"sql_query": query, "sql_result": result, "error": None}
         return {"error": error, "retry_count": state.get("retry_count", 0) + 1}
     else:
         print("[execute_sql] success")
@@ -141,9 +314,15 @@ def execute_sql_node(state: AgentState):
 
 
 def synthesize_node(state: AgentState):
-    context = f"RAG Context: {state.get('rag_context','')}\nSQL Result: {state.get('sql_result','')}"
-
-    pred = synthesizer(
+    # The SQL result holds the answer, so it gets whatever the docs leave.
+    rag_context = state.get('rag_context', '')
+    sql_budget = max(300, FIELD_BUDGETS["SynthesizeAnswer"]["context"] - estimate_tokens(rag_context) - 16)
+    context = f"RAG Context: {rag_context}\nSQL Result: {fit_table(state.get('sql_result', ''), sql_budget)}"
+    if state.get("format_feedback"):
+        context += f"\nFormat Feedback: {state['format_feedback']}"
+
+    pred = call_llm(
+        get_runtime().synthesizer,
         question=state["question"],
         context=context,
         format_hint=state["format_hint"]
@@ -197,6 +376,79 @@ def synthesize_node(state: AgentState):
     return {"final_output": output}
 
 
+def resynthesize(state: AgentState, feedback: str):
+    """
+    Re-run only the synthesizer on a finished graph state (the dict
+    app.invoke returned), telling it why its last answer was rejected.
+    Routing, retrieval, planning and SQL are reused as they are. Returns the
+    updated state.
+    """
+    state = {**state, "format_feedback": feedback, "retry_count": state.get("retry_count", 0) + 1}
+    state.update(traced_node("synthesize", synthesize_node)(state))
+    return state
+
+
+def _looks_hybrid(question):
+    """Cheap local guess (no LLM) that the router will say hybrid."""
+    if _heuristic_route(question.lower(), None) == "hybrid":
+        return True
+    clf = get_runtime().route_classifier
+    if clf is None:
+        return False
+    route, confidence = clf.predict(question)
+    return route == "hybrid" and confidence >= SPECULATIVE_PLAN_THRESHOLD
+
+
+def _looks_sql_free(question):
+    """Cheap local guess (no LLM) that the router will say rag."""
+    if _heuristic_route(question.lower(), None) == "rag":
+        return True
+    runtime = get_runtime()
+    clf = runtime.route_classifier
+    if clf is None:
+        return False
+    route, confidence = clf.predict(question)
+    return route == "rag" and confidence >= runtime.router_threshold
+
+
+def prefetch_node(state: AgentState, speculate_with=None):
+    """
+    Runs concurrently with the router: retrieval and the schema snapshot only
+    depend on the question. The schema is only warmed for questions that may
+    reach the SQL step. With speculate_with (planner_node or plan_sql_node)
+    planning also starts early for likely-hybrid questions.
+    """
+    update = retrieve_docs(state)
+    speculate = speculate_with is not None and _looks_hybrid(state["question"])
+    if speculate or not _looks_sql_free(state["question"]):
+        try:
+            get_schema_string(max_tokens=SCHEMA_BUDGET)  # warm the schema cache for the SQL step
+        except Exception as e:
+            # The SQL step reports a missing or broken DB; rag answers do not need it.
+            print(f"[prefetch] warning: schema warm-up failed: {e}")
+    if speculate:
+        _count_speculation("started")
+        print("[prefetch] speculative planning")
+        update.update(speculate_with({**state, **update}))
+        update["speculative"] = True
+    return update
+
+
+def dispatch_node(state: AgentState):
+    """Join point after router + prefetch: drop work the chosen route does not use."""
+    route = state["route"]
+    update = {}
+    if state.get("speculative") and "hybrid" not in route:
+        _count_speculation("discarded")
+        update.update({"plan": "", "sql_query": "", "speculative": False})
+    elif state.get("speculative"):
+        _count_speculation("used")
+    if "sql" in route:
+        # The sql route never sees retrieved docs (same as the sequential graph).
+        update.update({"rag_context": "", "citations": [], "retrieval_score": 0.0})
+    return update
+
+
 # -- EDGES --
 
 def router_edge(state: AgentState):
@@ -214,6 +466,15 @@ def retrieval_edge(state: AgentState):
     return "synthesize"
 
 
+def dispatch_edge(state: AgentState):
+    r = state["route"]
+    if "sql" in r:
+        return "planner"
+    if "hybrid" in r:
+        return "speculated" if state.get("speculative") else "planner"
+    return "synthesize"
+
+
 def execution_check(state: AgentState):
     if state["error"]:
         if state["retry_count"] < 2:
@@ -225,40 +486,62 @@ def execution_check(state: AgentState):
 
 # -- GRAPH FACTORY --
 
-def build_app(override_sql_gen=None):
+def build_app(override_sql_gen=None, fused_plan_sql=False, prefetch=True, speculative_plan=False):
     """
     Build and compile a LangGraph workflow.
 
     If override_sql_gen is provided (e.g., a DSPy-optimized module),
-    it will be used instead of the default sql_gen.
+    it will be used instead of the default sql_gen for this app only.
+    With fused_plan_sql=True the planner and first SQL generation are a
+    single LLM call (plan_sql_node); repairs still use generate_sql.
+    With prefetch=True retrieval and the schema fetch run in parallel with
+    the router (joined in dispatch_node); speculative_plan=True also starts
+    planning early for likely-hybrid questions.
+    All other components are shared through the runtime.
     """
-    global sql_gen
-    if override_sql_gen is not None:
-        sql_gen = override_sql_gen
+    from langgraph.graph import StateGraph, END, START  #type:ignore
 
     workflow = StateGraph(AgentState)
-
-    workflow.add_node("router", route_question)
-    workflow.add_node("retrieve_docs", retrieve_docs)
-    workflow.add_node("planner", planner_node)
-    workflow.add_node("generate_sql", generate_sql_node)
-    workflow.add_node("execute_sql", execute_sql_node)
-    workflow.add_node("synthesize", synthesize_node)
-
-    workflow.set_entry_point("router")
-
-    workflow.add_conditional_edges("router", router_edge, {
-        "planner": "planner",
-        "retrieve_docs": "retrieve_docs",
-    })
-
-    workflow.add_conditional_edges("retrieve_docs", retrieval_edge, {
-        "planner": "planner",
-        "synthesize": "synthesize",
-    })
-
-    workflow.add_edge("planner", "generate_sql")
-    workflow.add_edge("generate_sql", "execute_sql")
+    plan_step = "plan_sql" if fused_plan_sql else "planner"
+    plan_fn = plan_sql_node if fused_plan_sql else planner_node
+
+    # Every node is wrapped in a tracing span (no-op unless tracing is on).
+    workflow.add_node("router", traced_node("router", route_question))
+    workflow.add_node(plan_step, traced_node(plan_step, plan_fn))
+    workflow.add_node("generate_sql", traced_node(
+        "generate_sql", partial(generate_sql_node, sql_module=override_sql_gen)))
+    workflow.add_node("execute_sql", traced_node("execute_sql", execute_sql_node))
+    workflow.add_node("synthesize", traced_node("synthesize", synthesize_node))
+
+    if prefetch:
+        workflow.add_node("prefetch", traced_node(
+            "prefetch", partial(prefetch_node, speculate_with=plan_fn if speculative_plan else None)))
+        workflow.add_node("dispatch", traced_node("dispatch", dispatch_node))
+        workflow.add_edge(START, "router")
+        workflow.add_edge(START, "prefetch")
+        workflow.add_edge(["router", "prefetch"], "dispatch")
+        workflow.add_conditional_edges("dispatch", dispatch_edge, {
+            "planner": plan_step,
+            "speculated": "execute_sql" if fused_plan_sql else "generate_sql",
+            "synthesize": "synthesize",
+        })
+    else:
+        workflow.add_node("retrieve_docs", traced_node("retrieve_docs", retrieve_docs))
+        workflow.add_edge(START, "router")
+        workflow.add_conditional_edges("router", router_edge, {
+            "planner": plan_step,
+            "retrieve_docs": "retrieve_docs",
+        })
+        workflow.add_conditional_edges("retrieve_docs", retrieval_edge, {
+            "planner": plan_step,
+            "synthesize": "synthesize",
+        })
+
+    if fused_plan_sql:
+        workflow.add_edge("plan_sql", "execute_sql")
+    else:
+        workflow.add_edge("planner", "generate_sql")
+        workflow.add_edge("generate_sql", "execute_sql")
 
     workflow.add_conditional_edges("execute_sql", execution_check, {
         "generate_sql": "generate_sql",
@@ -270,5 +553,22 @@ def build_app(override_sql_gen=None):
     return workflow.compile()
 
 
-# Default compiled app using the base (non-optimized) SQL generator.
-app = build_app()
\ No newline at end of file
+_default_app = None
+
+
+def get_app():
+    """Default compiled app using the base (non-optimized) SQL generator, built on first use."""
+    global _default_app
+    if _default_app is None:
+        _default_app = build_app()
+    return _default_app
+
+
+def __getattr__(name):
+    # Backwards compatible module attributes (`app`, `sql_gen`, `retriever`, ...)
+    # resolved lazily instead of being built at import time.
+    if name == "app":
+        return get_app()
+    if name in ("lm", "router", "planner", "sql_gen", "plan_sql", "synthesizer", "retriever"):
+        return getattr(get_runtime(), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
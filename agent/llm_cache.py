@@ -0,0 +1,165 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+LLM_CACHE_PATH = "data/cache/llm_cache.sqlite"
+LLM_CACHE_MAX_ENTRIES = 50_000
+LLM_CACHE_TTL_S = None  # None = entries never expire
+
+
+def _normalize(value):
+    """Collapse whitespace so cosmetic prompt differences share a cache entry."""
+    if isinstance(value, str):
+        return re.sub(r"\s+", " ", value).strip()
+    return value
+
+
+def program_version(module):
+    """
+    Hash of everything about a DSPy module that shapes its output:
+    signature instructions/fields and any (bootstrapped) demos.
+    """
+    try:
+        state = module.dump_state()
+    except Exception:
+        state = repr(module)
+    blob = json.dumps(state, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()[:16]
+
+
+def signature_name(module):
+    """Readable name for a DSPy module, e.g. 'RouterSignature' or 'ChainOfThought(sql_query)'."""
+    sig = getattr(module, "signature", None)
+    if sig is None and hasattr(module, "predict"):
+        sig = getattr(module.predict, "signature", None)
+    name = getattr(sig, "__name__", None)
+    if name and name != "StringSignature":
+        return name
+    # Derived signatures (e.g. ChainOfThought's) lose the original class name.
+    outputs = [f for f in getattr(sig, "output_fields", {}) if f != "reasoning"]
+    return f"{type(module).__name__}({','.join(outputs)})"
+
+
+class LLMCache:
+    """
+    Disk-backed (SQLite) cache of DSPy module outputs.
+
+    Entries are keyed by signature name, normalized inputs, model id and
+    program version. Size is bounded with LRU eviction, entries can expire
+    after `ttl_s` seconds, and hit/miss counters are available via stats().
+    """
+
+    def __init__(self, path=LLM_CACHE_PATH, max_entries=LLM_CACHE_MAX_ENTRIES, ttl_s=LLM_CACHE_TTL_S):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self._conn = None
+        self._lock = threading.Lock()
+        self._count = 0  # entries in the table, tracked on insert/delete
+        self._stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0}
+
+    def _db(self):
+        if self._conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                " key TEXT PRIMARY KEY, signature TEXT, value TEXT,"
+                " created_at REAL, last_access REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_access ON llm_cache(last_access)")
+            (self._count,) = conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+            self._conn = conn
+        return self._conn
+
+    def make_key(self, module, inputs, model_id):
+        # The program version is recomputed per call (cheap next to an LLM
+        # call) so demos loaded or compiled into the module change the key.
+        payload = {
+            "signature": signature_name(module),
+            "inputs": {k: _normalize(v) for k, v in sorted(inputs.items())},
+            "model": model_id,
+            "program": program_version(module),
+        }
+        blob = json.dumps(payload, sort_keys=True, default=str)
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Return the cached output dict for key, or None."""
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            row = db.execute("SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self._stats["misses"] += 1
+                return None
+            value, created_at = row
+            if self.ttl_s is not None and now - created_at > self.ttl_s:
+                db.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                db.commit()
+                self._count -= 1
+                self._stats["expired"] += 1
+                self._stats["misses"] += 1
+                return None
+            db.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (now, key))
+            db.commit()
+            self._stats["hits"] += 1
+        return json.loads(value)
+
+    def put(self, key, signature, outputs):
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            value = json.dumps(outputs, default=str)
+            cur = db.execute(
+                "INSERT OR IGNORE INTO llm_cache (key, signature, value, created_at, last_access)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (key, signature, value, now, now),
+            )
+            if cur.rowcount:
+                self._count += 1
+            else:
+                db.execute(
+                    "UPDATE llm_cache SET signature = ?, value = ?, created_at = ?, last_access = ?"
+                    " WHERE key = ?",
+                    (signature, value, now, now, key),
+                )
+            overflow = self._count - self.max_entries
+            if overflow > 0:
+                cur = db.execute(
+                    "DELETE FROM llm_cache WHERE key IN"
+                    " (SELECT key FROM llm_cache ORDER BY last_access LIMIT ?)",
+                    (overflow,),
+                )
+                self._count -= cur.rowcount
+                self._stats["evictions"] += cur.rowcount
+            db.commit()
+
+    def stats(self):
+        """Counters plus hit rate and current entry count."""
+        with self._lock:
+            out = dict(self._stats)
+            if self._conn is not None:
+                out["entries"] = self._count
+        lookups = out["hits"] + out["misses"]
+        out["hit_rate"] = round(out["hits"] / lookups, 3) if lookups else 0.0
+        return out
+
+    def clear(self):
+        with self._lock:
+            self._db().execute("DELETE FROM llm_cache")
+            self._conn.commit()
+            self._count = 0
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,240 @@
+"""
+Async Ollama client for DSPy with connection pooling and request queueing.
+
+OllamaLM talks to Ollama's /api/chat endpoint directly instead of going
+through a fresh synchronous client per call:
+
+* one httpx.AsyncClient per LM with pooled keep-alive connections;
+* a bounded priority queue in front of `max_concurrency` worker tasks, so a
+  batch with many workers neither serializes on Python locks nor floods
+  the server; callers block (backpressure) when the queue is full;
+* per-request timeouts with exponential backoff + jitter on connection
+  errors, timeouts and 5xx responses;
+* `keep_alive` sent with every request (and warm() to preload the model) so
+  the model stays resident between questions.
+
+The event loop runs on a background thread, so forward() (sync graph path)
+and aforward() (async path, e.g. app.ainvoke / dspy acall) share the same
+queue and connection pool. Point `api_base` at any server speaking the same
+API, e.g. bench_stub_lm.FakeOllamaServer for offline runs.
+"""
+import asyncio
+import contextvars
+import itertools
+import random
+import threading
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import dspy
+
+OLLAMA_API_BASE = "http://localhost:11434"
+OLLAMA_KEEP_ALIVE = "30m"
+OLLAMA_MAX_CONCURRENCY = 1   # requests in flight to the server
+OLLAMA_MAX_CONNECTIONS = 4   # pooled keep-alive connections
+OLLAMA_QUEUE_MAX = 64        # queued requests before callers block
+OLLAMA_TIMEOUT_S = 120.0
+OLLAMA_MAX_RETRIES = 3
+OLLAMA_BACKOFF_S = 0.5
+
+# Lower runs first. Later pipeline stages go first so questions that are
+# almost done finish before new ones start (lower per-question latency).
+DEFAULT_PRIORITY = 5
+_priority = contextvars.ContextVar("ollama_request_priority", default=DEFAULT_PRIORITY)
+
+
+@contextmanager
+def request_priority(priority):
+    """Queue priority for LM requests made inside this block."""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def _completion(data, model):
+    message = data.get("message") or {}
+    prompt_tokens = int(data.get("prompt_eval_count") or 0)
+    completion_tokens = int(data.get("eval_count") or 0)
+    return SimpleNamespace(
+        choices=[SimpleNamespace(
+            message=SimpleNamespace(content=message.get("content", ""), tool_calls=None),
+            finish_reason=data.get("done_reason") or "stop",
+            logprobs=None,
+        )],
+        usage={
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+        model=model,
+    )
+
+
+class _RetryableError(Exception):
+    pass
+
+
+class OllamaLM(dspy.BaseLM):
+    """DSPy LM backed by a pooled, queued async client for Ollama's chat API."""
+
+    # agent.graph_hybrid skips its own LLM semaphore for LMs that queue requests.
+    queues_requests = True
+
+    def __init__(self, model, api_base=OLLAMA_API_BASE, keep_alive=OLLAMA_KEEP_ALIVE,
+                 max_concurrency=OLLAMA_MAX_CONCURRENCY, max_connections=OLLAMA_MAX_CONNECTIONS,
+                 queue_max=OLLAMA_QUEUE_MAX, timeout_s=OLLAMA_TIMEOUT_S,
+                 max_retries=OLLAMA_MAX_RETRIES, backoff_s=OLLAMA_BACKOFF_S, **kwargs):
+        super().__init__(model=model, **kwargs)
+        # "ollama_chat/llama3.1:8b" (litellm style) -> "llama3.1:8b"
+        self.ollama_model = model.split("/", 1)[1] if model.startswith("ollama") and "/" in model else model
+        self.api_base = api_base.rstrip("/")
+        self.keep_alive = keep_alive
+        self.max_concurrency = max_concurrency
+        self.max_connections = max(max_connections, max_concurrency)
+        self.queue_max = queue_max
+        self.timeout_s = timeout_s
+        self.max_retries = max_retries
+        self.backoff_s = backoff_s
+        self._start_lock = threading.Lock()
+        self._loop = None
+        self._ready = None
+        self._seq = itertools.count()
+        self._stats = {"requests": 0, "retries": 0, "errors": 0, "max_queue_depth": 0}
+
+    # -- background loop -------------------------------------------------
+
+    def _ensure_started(self):
+        if self._loop is not None:
+            return self._loop
+        with self._start_lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                ready = threading.Event()
+                failure = []
+                thread = threading.Thread(target=self._run_loop, args=(loop, ready, failure),
+                                          name="ollama-lm", daemon=True)
+                thread.start()
+                ready.wait()
+                if failure:
+                    loop.close()
+                    raise failure[0]
+                self._loop = loop
+        return self._loop
+
+    def _run_loop(self, loop, ready, failure):
+        try:
+            import httpx
+
+            asyncio.set_event_loop(loop)
+            self._queue = asyncio.PriorityQueue(maxsize=self.queue_max)
+            self._client = httpx.AsyncClient(
+                base_url=self.api_base,
+                timeout=httpx.Timeout(self.timeout_s, connect=min(10.0, self.timeout_s)),
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections),
+            )
+            self._workers = [loop.create_task(self._worker()) for _ in range(self.max_concurrency)]
+        except BaseException as e:  # hand it to the caller blocked in _ensure_started
+            failure.append(e)
+            return
+        finally:
+            ready.set()
+        loop.run_forever()
+
+    async def _worker(self):
+        while True:
+            _, _, payload, future = await self._queue.get()
+            try:
+                if not future.cancelled():
+                    result = await self._post_with_retries(payload)
+                    if not future.cancelled():
+                        future.set_result(result)
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            finally:
+                self._queue.task_done()
+
+    async def _post_with_retries(self, payload, path="/api/chat"):
+        import httpx
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await self._client.post(path, json=payload)
+                if response.status_code >= 500:
+                    raise _RetryableError(f"HTTP {response.status_code}: {response.text[:200]}")
+                response.raise_for_status()
+                self._stats["requests"] += 1
+                return response.json()
+            except (httpx.TransportError, _RetryableError) as e:  # timeouts are TransportErrors
+                if attempt == self.max_retries:
+                    self._stats["errors"] += 1
+                    raise RuntimeError(f"Ollama request failed after {attempt + 1} attempts: {e}") from e
+                self._stats["retries"] += 1
+                delay = self.backoff_s * (2 ** attempt)
+                await asyncio.sleep(delay + random.uniform(0, delay / 2))
+
+    async def _enqueue(self, payload, priority):
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((priority, next(self._seq), payload, future))
+        self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], self._queue.qsize())
+        return await future
+
+    # -- DSPy interface --------------------------------------------------
+
+    def _payload(self, prompt, messages, kwargs):
+        options = {**self.kwargs, **kwargs}
+        ollama_options = {}
+        if options.get("temperature") is not None:
+            ollama_options["temperature"] = options["temperature"]
+        if options.get("max_tokens"):
+            ollama_options["num_predict"] = options["max_tokens"]
+        return {
+            "model": self.ollama_model,
+            "messages": messages or [{"role": "user", "content": prompt or ""}],
+            "stream": False,
+            "keep_alive": self.keep_alive,
+            "options": ollama_options,
+        }
+
+    def _submit(self, payload):
+        loop = self._ensure_started()
+        return asyncio.run_coroutine_threadsafe(self._enqueue(payload, _priority.get()), loop)
+
+    def forward(self, prompt=None, messages=None, **kwargs):
+        data = self._submit(self._payload(prompt, messages, kwargs)).result()
+        return _completion(data, self.model)
+
+    async def aforward(self, prompt=None, messages=None, **kwargs):
+        data = await asyncio.wrap_future(self._submit(self._payload(prompt, messages, kwargs)))
+        return _completion(data, self.model)
+
+    def warm(self):
+        """Load the model now and keep it resident for `keep_alive`."""
+        loop = self._ensure_started()
+        payload = {"model": self.ollama_model, "keep_alive": self.keep_alive}
+        asyncio.run_coroutine_threadsafe(self._post_with_retries(payload, "/api/generate"), loop).result()
+        return self
+
+    def stats(self):
+        """Request / retry / error counters and the deepest queue seen."""
+        out = dict(self._stats)
+        out["queued"] = self._queue.qsize() if self._loop is not None else 0
+        return out
+
+    def close(self):
+        """Close pooled connections and stop the background loop."""
+        with self._start_lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+
+        async def shutdown():
+            for task in self._workers:
+                task.cancel()
+            await self._client.aclose()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
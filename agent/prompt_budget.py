@@ -0,0 +1,125 @@
+"""
+Token budgets for the inputs of every LLM call.
+
+On CPU inference, prompt length dominates latency, so each signature gets
+per-field token budgets (FIELD_BUDGETS). Nodes trim semantically before
+calling the LLM (retrieved chunks by score, SQL result rows, schema sample
+values), and call_llm() enforces the budgets as a hard cap via fit_inputs()
+and logs what each call used.
+
+Nothing question-dependent is trimmed out of the static parts of a prompt:
+the instructions and the schema text only change when the DB does, so a
+server-side prompt (KV) cache can keep reusing that prefix.
+"""
+from agent.tools.sqlite_tool import CHARS_PER_TOKEN
+
+# signature name (llm_cache.signature_name) -> {input field: max tokens}
+FIELD_BUDGETS = {
+    "RouterSignature": {"question": 256},
+    "PlannerSignature": {"question": 256, "context": 600},
+    "ChainOfThought(sql_query)": {"db_schema": 1000, "question": 256, "plan": 200, "previous_error": 200},
+    "ChainOfThought(date_range,filters,sql_query)": {
+        "db_schema": 1000, "question": 256, "context": 600, "previous_error": 200},
+    "SynthesizeAnswer": {"question": 256, "context": 1500, "format_hint": 64},
+}
+DEFAULT_FIELD_BUDGET = 1000
+
+# Retrieved chunks kept in rag_context (planner and synthesizer both read it).
+RAG_CONTEXT_BUDGET = 600
+# Schema text budget; shared by every SQL prompt, so it is question independent.
+SCHEMA_BUDGET = 1000
+
+TRUNCATED = "... [truncated]"
+
+
+def estimate_tokens(text):
+    """Rough token count (~CHARS_PER_TOKEN characters per token)."""
+    return (len(text or "") + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def fit_lines(text, max_tokens):
+    """Keep whole leading lines of text that fit in max_tokens."""
+    text = text or ""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    budget = max_tokens * CHARS_PER_TOKEN - len(TRUNCATED) - 1
+    out, used = [], 0
+    for line in text.split("\n"):
+        if used + len(line) + 1 > budget:
+            if not out:  # a single huge line: cut it
+                out.append(line[:max(0, budget)])
+            break
+        out.append(line)
+        used += len(line) + 1
+    out.append(TRUNCATED)
+    return "\n".join(out)
+
+
+def fit_chunks(chunks, max_tokens, sep="\n"):
+    """
+    Chunks (most relevant first) that fit in max_tokens when joined with
+    sep. Only whole chunks are kept, except that an oversized first chunk is
+    line-trimmed rather than dropped.
+    """
+    kept, used = [], 0
+    for chunk in chunks:
+        cost = estimate_tokens(chunk + sep)
+        if used + cost > max_tokens:
+            if not kept:
+                kept.append(fit_lines(chunk, max_tokens))
+            break
+        kept.append(chunk)
+        used += cost
+    return kept
+
+
+def fit_table(text, max_tokens):
+    """
+    Trim a rendered SQL result (markdown table, optional stats footer after a
+    blank line) to max_tokens, keeping the header and footer and dropping
+    rows from the end.
+    """
+    text = text or ""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    body, _, footer = text.partition("\n\n")
+    lines = body.split("\n")
+    header, rows = lines[:2], lines[2:]
+    budget = max_tokens * CHARS_PER_TOKEN - len(footer) - 64
+    used = sum(len(line) + 1 for line in header)
+    shown = 0
+    for row in rows:
+        if shown and used + len(row) + 1 > budget:
+            break
+        used += len(row) + 1
+        shown += 1
+    note = f"(showing {shown} of {len(rows)} returned rows)"
+    if footer.startswith("(showing"):
+        # Already truncated once at render time: keep its total + stats.
+        note, _, footer = footer.partition("\n")
+        note = f"(showing {shown} of " + note.split(" of ", 1)[1]
+    out = "\n".join(header + rows[:shown]) + "\n\n" + note
+    return fit_lines(out + ("\n" + footer if footer else ""), max_tokens)
+
+
+def fit_inputs(name, inputs):
+    """
+    Apply FIELD_BUDGETS[name] to string inputs. Returns (inputs, report)
+    where report has per-field token counts, the total budget and the
+    fields that had to be cut.
+    """
+    budgets = FIELD_BUDGETS.get(name, {})
+    fitted, fields, trimmed, limit = {}, {}, [], 0
+    for field, value in inputs.items():
+        if not isinstance(value, str):
+            fitted[field] = value
+            continue
+        max_tokens = budgets.get(field, DEFAULT_FIELD_BUDGET)
+        limit += max_tokens
+        if estimate_tokens(value) > max_tokens:
+            value = fit_lines(value, max_tokens)
+            trimmed.append(field)
+        fitted[field] = value
+        fields[field] = estimate_tokens(value)
+    report = {"fields": fields, "used": sum(fields.values()), "budget": limit, "trimmed": trimmed}
+    return fitted, report
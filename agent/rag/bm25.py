@@ -0,0 +1,105 @@
+from array import array
+from collections import Counter
+
+import numpy as np
+from scipy import sparse
+
+
+class SparseBM25:
+    """
+    Okapi BM25 over a precomputed sparse term-document weight matrix.
+
+    Scores match rank_bm25.BM25Okapi (same idf flooring and length
+    normalisation), but every per-(doc, term) weight is computed once at fit
+    time, so scoring a query is a single sparse mat-vec and scoring a batch of
+    queries is a single sparse mat-mat. Top-k uses argpartition over the
+    non-zero scores only.
+    """
+
+    def __init__(self, corpus, k1=1.5, b=0.75, epsilon=0.25):
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.vocab = {}
+
+        # corpus may be any iterable (e.g. a generator streaming chunks).
+        rows, cols, tfs = array("q"), array("q"), array("d")
+        lengths = array("d")
+        for d, tokens in enumerate(corpus):
+            lengths.append(len(tokens))
+            for term, count in Counter(tokens).items():
+                rows.append(d)
+                cols.append(self.vocab.setdefault(term, len(self.vocab)))
+                tfs.append(count)
+
+        self.corpus_size = len(lengths)
+        doc_len = np.frombuffer(lengths, dtype=np.float64) if lengths else np.zeros(0)
+        rows = np.frombuffer(rows, dtype=np.int64) if rows else np.zeros(0, dtype=np.int64)
+        cols = np.frombuffer(cols, dtype=np.int64) if cols else np.zeros(0, dtype=np.int64)
+        tf = np.frombuffer(tfs, dtype=np.float64) if tfs else np.zeros(0)
+        n_terms = len(self.vocab)
+
+        self.avgdl = doc_len.sum() / self.corpus_size if self.corpus_size else 0.0
+        df = np.bincount(cols, minlength=n_terms).astype(np.float64)
+        idf = np.log(self.corpus_size - df + 0.5) - np.log(df + 0.5)
+        if n_terms:
+            # Same flooring as rank_bm25: negative idf -> epsilon * mean idf.
+            idf[idf < 0] = self.epsilon * idf.mean()
+        self.idf = idf
+
+        norm = self.k1 * (1 - self.b + self.b * doc_len[rows] / (self.avgdl or 1.0))
+        weights = idf[cols] * tf * (self.k1 + 1) / (tf + norm)
+        # terms x docs, so a (queries x terms) matrix times this is (queries x docs).
+        self._term_doc = sparse.csr_matrix(
+            (weights, (cols, rows)), shape=(n_terms, self.corpus_size)
+        )
+
+    def _query_matrix(self, tokenized_queries):
+        rows, cols, vals = [], [], []
+        for qi, tokens in enumerate(tokenized_queries):
+            # Repeated query terms count repeatedly, as in BM25Okapi.get_scores;
+            # a {term: weight} dict gives weighted query terms.
+            counts = tokens if isinstance(tokens, dict) else Counter(tokens)
+            for term, count in counts.items():
+                j = self.vocab.get(term)
+                if j is not None:
+                    rows.append(qi)
+                    cols.append(j)
+                    vals.append(count)
+        return sparse.csr_matrix(
+            (np.asarray(vals, dtype=np.float64), (rows, cols)),
+            shape=(len(tokenized_queries), len(self.vocab)),
+        )
+
+    def get_scores(self, tokenized_query):
+        """Dense score vector for one query (drop-in for BM25Okapi.get_scores)."""
+        return self.score_many([tokenized_query]).toarray().ravel()
+
+    def score_many(self, tokenized_queries):
+        """Sparse (queries x docs) score matrix; zero entries are non-matching docs."""
+        return (self._query_matrix(tokenized_queries) @ self._term_doc).tocsr()
+
+    def top_k(self, tokenized_queries, k):
+        """
+        For each query, the top-k (doc_index, score) pairs with score > 0,
+        best first; ties keep corpus order.
+        """
+        scores = self.score_many(tokenized_queries)
+        out = []
+        for qi in range(scores.shape[0]):
+            start, end = scores.indptr[qi], scores.indptr[qi + 1]
+            docs = scores.indices[start:end]
+            vals = scores.data[start:end]
+            keep = vals > 0
+            docs, vals = docs[keep], vals[keep]
+
+            if k < len(vals):
+                # Everything tied with the k-th best stays in, so ties are
+                # broken by corpus order exactly like a full stable sort.
+                kth = vals[np.argpartition(-vals, k - 1)[k - 1]]
+                cand = vals >= kth
+                docs, vals = docs[cand], vals[cand]
+
+            order = np.lexsort((docs, -vals))[:k]
+            out.append([(int(docs[i]), float(vals[i])) for i in order])
+        return out
@@ -0,0 +1,125 @@
+import json
+from collections import deque
+from functools import lru_cache
+
+# Synonym / expansion dictionary (see QueryExpander for the format).
+EXPANSIONS_PATH = "data/query_expansions.json"
+# Distinct queries whose expansion is memoized per expander.
+EXPANSION_CACHE_SIZE = 4096
+
+
+def _is_word_char(ch):
+    return ch.isalnum() or ch == "_"
+
+
+class QueryExpander:
+    """
+    Appends weighted domain terms to queries that mention known triggers.
+
+    Rules come from a JSON file:
+
+        {"expansions": [
+            {"match": ["return", "policy"], "expand": ["returns", "policy", "days"]},
+            {"match": ["kpi"], "expand": {"definition": 1.0, "metric": 0.5}, "word": true}
+        ]}
+
+    A rule fires once when any of its triggers occurs in the lowercased
+    query (as a substring, or only as whole words with "word": true) and adds
+    its terms, each with weight 1.0 unless given. All triggers are compiled
+    into one Aho-Corasick automaton, so a query is scanned once no matter how
+    many rules there are, and the result for repeated queries is cached.
+    """
+
+    def __init__(self, rules=(), cache_size=EXPANSION_CACHE_SIZE):
+        self.rules = []
+        # Automaton: goto[state] = {char: state}, fail[state], out[state] = [(rule, trigger length, word)]
+        self._goto, self._fail, self._out = [{}], [0], [[]]
+        for rule in rules:
+            self._add_rule(rule)
+        self._build_links()
+        self.terms = lru_cache(maxsize=cache_size)(self._terms)
+
+    @classmethod
+    def load(cls, path=EXPANSIONS_PATH):
+        """Expander for the rules in path; no expansion if the file is missing."""
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                rules = json.load(f).get("expansions", [])
+        except (OSError, ValueError) as e:
+            print(f"[expansion] no query expansion ({path}: {e})")
+            rules = []
+        return cls(rules)
+
+    def _add_rule(self, rule):
+        expand = rule.get("expand", [])
+        if not isinstance(expand, dict):
+            expand = {term: 1.0 for term in expand}
+        terms = tuple((term.lower(), float(weight)) for term, weight in expand.items())
+        index = len(self.rules)
+        self.rules.append(terms)
+        word = bool(rule.get("word", False))
+        for trigger in rule.get("match", []):
+            trigger = trigger.lower()
+            if not trigger:
+                continue
+            state = 0
+            for ch in trigger:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                state = nxt
+            self._out[state].append((index, len(trigger), word))
+
+    def _build_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def matches(self, text):
+        """Indexes of the rules whose triggers occur in text (lowercased), in rule order."""
+        fired, state = set(), 0
+        goto, fail, out = self._goto, self._fail, self._out
+        for i, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for rule, length, word in out[state]:
+                if word and ((i - length >= 0 and _is_word_char(text[i - length]))
+                             or (i + 1 < len(text) and _is_word_char(text[i + 1]))):
+                    continue
+                fired.add(rule)
+        return sorted(fired)
+
+    def _terms(self, query):
+        expansion = []
+        for rule in self.matches(query.lower()):
+            expansion.extend(self.rules[rule])
+        return tuple(expansion)
+
+    def expand(self, query):
+        """Lowercased query with the expansion terms appended (weights dropped)."""
+        query = query.lower()
+        terms = self.terms(query)
+        return " ".join([query] + [term for term, _ in terms]) if terms else query
+
+    def weighted_tokens(self, query):
+        """{token: weight} for BM25: query tokens count 1 each, plus expansion weights."""
+        weights = {}
+        query = query.lower()
+        for token in query.split():
+            weights[token] = weights.get(token, 0.0) + 1.0
+        for term, weight in self.terms(query):
+            for token in term.split():
+                weights[token] = weights.get(token, 0.0) + weight
+        return weights
@@ -1,90 +1,407 @@
-import os
 import glob
-from rank_bm25 import BM25Okapi
+import hashlib
+import mmap
+import multiprocessing
+import os
+import pickle
+import threading
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from agent.rag.bm25 import SparseBM25
+from agent.rag.expansion import EXPANSIONS_PATH, QueryExpander
+
+# On-disk index: per-file chunk offsets and the fitted BM25 model, so a
+# process start only re-chunks docs that were added or changed.
+INDEX_DIR = "data/cache"
+INDEX_VERSION = 3
+
+# Chunks longer than this (bytes of UTF-8) are split into overlapping windows;
+# every window after the first is prefixed with the nearest markdown header.
+MAX_CHUNK_BYTES = 1200
+CHUNK_OVERLAP_BYTES = 200
+# Files are parsed in a process pool once there are at least this many to
+# (re)ingest; below that, process start-up costs more than it saves.
+INGEST_PARALLEL_MIN_FILES = 32
+INGEST_WORKERS = None  # None = os.cpu_count()
+# Doc files kept memory-mapped at once (least recently used are unmapped).
+MAX_OPEN_MAPS = 256
+
+_WHITESPACE = b" \t\n\r\x0b\x0c"
+_NO_HEADER = (0, 0)
+
+
+def _strip(data, start, end):
+    """(start, end) with surrounding whitespace removed."""
+    while start < end and data[start:start + 1] in _WHITESPACE:
+        start += 1
+    while end > start and data[end - 1:end] in _WHITESPACE:
+        end -= 1
+    return start, end
+
+
+def _first_line(data, start, end):
+    """Span of the first line of data[start:end] if it is a markdown header."""
+    if data[start:start + 1] != b"#":
+        return None
+    nl = data.find(b"\n", start, end)
+    return _strip(data, start, end if nl < 0 else nl)
+
+
+def _split(data, sep, start=0, end=None):
+    """Spans of data[start:end].split(sep), without copying the parts."""
+    end = len(data) if end is None else end
+    while True:
+        i = data.find(sep, start, end)
+        if i < 0:
+            yield start, end
+            return
+        yield start, i
+        start = i + len(sep)
+
+
+def _iter_sections(data):
+    """
+    (part number, header span or None, body span, prefix every window) in
+    document order, for the three split strategies: markdown sections (##),
+    paragraphs, or one chunk per bullet line with the preceding header kept
+    for context. Windows of an oversized body after the first are always
+    prefixed with the header span.
+    """
+    size = len(data)
+    # Strategy 1: Split by markdown headers (## )
+    if data.find(b"\n## ") >= 0:
+        for i, (start, end) in enumerate(_split(data, b"\n## ")):
+            if i > 0:
+                start -= 3  # Re-add header marker
+            start, end = _strip(data, start, end)
+            if start < end:
+                yield i, _first_line(data, start, end), (start, end), False
+
+    # Strategy 2: Split by paragraphs (double newline)
+    elif data.find(b"\n\n") >= 0:
+        header = None
+        for i, (start, end) in enumerate(_split(data, b"\n\n")):
+            start, end = _strip(data, start, end)
+            if start < end:
+                header = _first_line(data, start, end) or header
+                yield i, header, (start, end), False
+
+    # Strategy 3: For bullet lists (like product_policy.md), split by lines
+    else:
+        header = None
+        for i, (start, end) in enumerate(_split(data, b"\n", 0, size)):
+            line = _strip(data, start, end)
+            if line[0] == line[1]:
+                continue
+            if data[start:start + 1] == b"#":
+                header = line
+            elif data[start:start + 1] == b"-":
+                # Each bullet becomes a chunk WITH the header for context
+                yield i, header, line, True
+            else:
+                # Regular paragraph
+                yield i, header, line, False
+
+
+def _boundary(data, pos):
+    """Move pos back to the start of a UTF-8 character."""
+    while pos > 0 and data[pos] & 0xC0 == 0x80:
+        pos -= 1
+    return pos
+
+
+def _windows(data, start, end, max_bytes=MAX_CHUNK_BYTES, overlap=CHUNK_OVERLAP_BYTES):
+    """Spans of at most max_bytes covering data[start:end], overlapping by ~overlap."""
+    if end - start <= max_bytes:
+        yield start, end
+        return
+    overlap = min(overlap, max_bytes // 4)
+    pos = start
+    while pos < end:
+        stop = pos + max_bytes
+        if stop >= end:
+            stop = end
+        else:
+            # Prefer breaking at a line, then a word, in the second half of the window.
+            cut = data.rfind(b"\n", pos + max_bytes // 2, stop)
+            if cut < 0:
+                cut = data.rfind(b" ", pos + max_bytes // 2, stop)
+            stop = cut if cut > 0 else _boundary(data, stop)
+        yield _strip(data, pos, stop)
+        if stop >= end:
+            return
+        nxt = stop - overlap
+        space = data.find(b" ", nxt, stop)
+        nxt = space + 1 if space >= 0 else _boundary(data, nxt)
+        pos = nxt if nxt > pos else stop
+
+
+def _iter_chunks(data, max_bytes=MAX_CHUNK_BYTES, overlap=CHUNK_OVERLAP_BYTES):
+    """
+    Stream (part, window, header span, body span) for one document. Nothing
+    is copied: spans are byte offsets into data; header is (0, 0) when the
+    chunk has no prefix.
+    """
+    for part, header, (start, end), prefix_all in _iter_sections(data):
+        budget = max_bytes
+        if header is not None:
+            budget = max(max_bytes - (header[1] - header[0]) - 1, max_bytes // 2)
+        for window, (ws, we) in enumerate(_windows(data, start, end, budget, overlap)):
+            if ws < we:
+                prefix = header if header is not None and (prefix_all or window > 0) else _NO_HEADER
+                yield part, window, prefix, (ws, we)
+
+
+def _chunk_text(data, hstart, hend, start, end):
+    body = data[start:end].decode("utf-8", errors="replace")
+    if hstart == hend:
+        return body
+    return data[hstart:hend].decode("utf-8", errors="replace") + "\n" + body
+
+
+def _tokenize(text):
+    return text.lower().split()
+
+
+def _map_file(path):
+    """Read-only memory map of path (b"" for an empty file)."""
+    with open(path, "rb") as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _ingest_file(path):
+    """
+    Chunk one markdown file into an index entry: a flat array of
+    (header start, header end, start, end) byte offsets and one of
+    (part, window) labels per chunk. Runs in worker processes.
+    """
+    st = os.stat(path)
+    data = _map_file(path)
+    try:
+        spans, labels = array("q"), array("q")
+        for part, window, header, body in _iter_chunks(data):
+            spans.extend((*header, *body))
+            labels.extend((part, window))
+        sha1 = hashlib.sha1(data).hexdigest()
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+    return {
+        "mtime_ns": st.st_mtime_ns,
+        "size": st.st_size,
+        "sha1": sha1,
+        "spans": spans,
+        "labels": labels,
+    }
+
+
+def _iter_ingest(paths, workers=INGEST_WORKERS):
+    """
+    Yield (path, entry) for every path, parsing in a process pool for large
+    batches. Workers are spawned, not forked: the caller may already run
+    threads (batch workers, the LM client loop), and forking a threaded
+    process can deadlock the children on locks held at fork time.
+    """
+    paths = list(paths)
+    if len(paths) < INGEST_PARALLEL_MIN_FILES:
+        for path in paths:
+            yield path, _ingest_file(path)
+        return
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        chunksize = max(1, len(paths) // (4 * (workers or os.cpu_count() or 1)))
+        yield from zip(paths, pool.map(_ingest_file, paths, chunksize=chunksize))
+
+
+def _index_path(docs_path):
+    key = hashlib.sha1(os.path.abspath(docs_path).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(INDEX_DIR, f"bm25_{key}.pkl")
+
+
+class _ChunkView:
+    """
+    Read-only sequence over chunk texts or doc ids. Texts are decoded on
+    access from memory-mapped doc files, so the corpus is never held in
+    memory as Python strings.
+    """
+
+    def __init__(self, retriever, doc_ids=False):
+        self._retriever = retriever
+        self._doc_ids = doc_ids
+
+    def __len__(self):
+        return len(self._retriever._chunk_file)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if self._doc_ids:
+            return self._retriever.doc_id(i)
+        return self._retriever.chunk_text(i)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
 
 class LocalRetriever:
-    def __init__(self, docs_path="docs/"):
-        self.chunks = []
-        self.doc_ids = []
-        self._load_docs(docs_path)
+    def __init__(self, docs_path="docs/", persist=True, expansions_path=EXPANSIONS_PATH):
+        self.expander = QueryExpander.load(expansions_path)
+        # Per chunk: file index, (header start, header end, start, end) byte
+        # offsets and (part, window) labels. Texts live in the doc files.
+        self._files, self._stems = [], []
+        self._chunk_file = array("I")
+        self._spans = array("q")
+        self._labels = array("q")
+        self._maps = OrderedDict()
+        self._maps_lock = threading.Lock()
+        self.chunks = _ChunkView(self)
+        self.doc_ids = _ChunkView(self, doc_ids=True)
+        self.index_stats = {"loaded": 0, "added": 0, "changed": 0, "removed": 0}
+
+        if persist:
+            self._load_index(docs_path)
+        else:
+            self._load_docs(docs_path)
+            self.bm25 = self._fit_bm25()
+
+    def _add_file(self, path, entry):
+        file_idx = len(self._files)
+        self._files.append(path)
+        self._stems.append(os.path.basename(path).replace(".md", ""))
+        self._chunk_file.extend([file_idx] * (len(entry["labels"]) // 2))
+        self._spans.extend(entry["spans"])
+        self._labels.extend(entry["labels"])
 
-        # Tokenize for BM25
-        tokenized_corpus = [doc.lower().split() for doc in self.chunks]
-        self.bm25 = BM25Okapi(tokenized_corpus)
+    def _map(self, file_idx):
+        data = self._maps.get(file_idx)
+        if data is None:
+            data = _map_file(self._files[file_idx])
+            self._maps[file_idx] = data
+            if len(self._maps) > MAX_OPEN_MAPS:
+                _, old = self._maps.popitem(last=False)
+                if isinstance(old, mmap.mmap):
+                    old.close()
+        else:
+            self._maps.move_to_end(file_idx)
+        return data
+
+    def chunk_text(self, i):
+        """Text of chunk i, read from its memory-mapped doc file."""
+        with self._maps_lock:
+            return _chunk_text(self._map(self._chunk_file[i]), *self._spans[4 * i:4 * i + 4])
+
+    def doc_id(self, i):
+        """'<file stem>::chunk<part>', plus '.<window>' for later windows of a split chunk."""
+        part, window = self._labels[2 * i], self._labels[2 * i + 1]
+        suffix = f".{window}" if window else ""
+        return f"{self._stems[self._chunk_file[i]]}::chunk{part}{suffix}"
+
+    def _fit_bm25(self):
+        """Fit BM25 by streaming every chunk through the tokenizer."""
+        if not len(self._chunk_file):
+            return None
+        return SparseBM25(_tokenize(self.chunk_text(i)) for i in range(len(self._chunk_file)))
 
     def _load_docs(self, path):
-        """Improved chunking: split by sections (##) OR paragraphs (\\n\\n) OR bullet lists"""
+        """Full ingestion of every markdown file under path (no index)."""
         files = glob.glob(os.path.join(path, "*.md"))
+        for f, entry in _iter_ingest(files):
+            self._add_file(f, entry)
+
+    def _load_index(self, docs_path):
+        """
+        Load the persisted index and bring it up to date with docs_path.
+
+        Files whose (mtime, size) match the index are reused as-is; the rest
+        are re-chunked (in a process pool when there are many) and the
+        content hash decides whether they actually changed. BM25 is only
+        refitted when the set of files or their contents changed.
+        """
+        index_file = _index_path(docs_path)
+        index = None
+        try:
+            with open(index_file, 'rb') as fh:
+                index = pickle.load(fh)
+            if index.get("version") != INDEX_VERSION:
+                index = None
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            index = None
+        old_files = index["files"] if index else {}
+
+        files = glob.glob(os.path.join(docs_path, "*.md"))
+        entries, stale, dirty = {}, [], index is None
         for f in files:
-            fname = os.path.basename(f).replace(".md", "")
-            with open(f, 'r') as file:
-                content = file.read()
-                
-                # Strategy 1: Split by markdown headers (## )
-                if '\n## ' in content:
-                    parts = content.split('\n## ')
-                    # Keep the title with the first part
-                    for i, part in enumerate(parts):
-                        if i > 0:
-                            part = '## ' + part  # Re-add header marker
-                        if part.strip():
-                            self.chunks.append(part.strip())
-                            self.doc_ids.append(f"{fname}::chunk{i}")
-                
-                # Strategy 2: Split by paragraphs (double newline)
-                elif '\n\n' in content:
-                    parts = content.split('\n\n')
-                    for i, part in enumerate(parts):
-                        if part.strip():
-                            self.chunks.append(part.strip())
-                            self.doc_ids.append(f"{fname}::chunk{i}")
-                
-                # Strategy 3: For bullet lists (like product_policy.md), split by lines
-                else:
-                    lines = content.split('\n')
-                    # Group header + all bullet points as separate chunks
-                    header = ""
-                    for i, line in enumerate(lines):
-                        if line.strip():
-                            if line.startswith('#'):
-                                header = line.strip()
-                            elif line.startswith('-'):
-                                # Each bullet becomes a chunk WITH the header for context
-                                chunk_text = f"{header}\n{line.strip()}"
-                                self.chunks.append(chunk_text)
-                                self.doc_ids.append(f"{fname}::chunk{i}")
-                            else:
-                                # Regular paragraph
-                                self.chunks.append(line.strip())
-                                self.doc_ids.append(f"{fname}::chunk{i}")
+            name = os.path.basename(f)
+            old = old_files.get(name)
+            st = os.stat(f)
+            if old and (old["mtime_ns"], old["size"]) == (st.st_mtime_ns, st.st_size):
+                entries[name] = old
+                self.index_stats["loaded"] += 1
+            else:
+                stale.append(f)
+
+        for f, entry in _iter_ingest(stale):
+            name = os.path.basename(f)
+            old = old_files.get(name)
+            dirty = True
+            if old and old["sha1"] == entry["sha1"]:
+                # Touched but unchanged: keep cached chunks, refresh the stat key.
+                old.update(mtime_ns=entry["mtime_ns"], size=entry["size"])
+                entries[name] = old
+                self.index_stats["loaded"] += 1
+                continue
+            entries[name] = entry
+            self.index_stats["changed" if old else "added"] += 1
+
+        self.index_stats["removed"] = len(set(old_files) - set(entries))
+        order = [os.path.basename(f) for f in files]
+        for f, name in zip(files, order):
+            self._add_file(f, entries[name])
+
+        needs_refit = (index is None or self.index_stats["added"] or self.index_stats["changed"]
+                       or self.index_stats["removed"] or index.get("order") != order)
+        if needs_refit:
+            self.bm25 = self._fit_bm25()
+        else:
+            self.bm25 = index["bm25"]
+
+        if dirty or needs_refit:
+            self._save_index(index_file, {
+                "version": INDEX_VERSION,
+                "order": order,
+                "files": entries,
+                "bm25": self.bm25,
+            })
+        print(f"[retriever] index {self.index_stats} chunks={len(self.chunks)}")
+
+    def _save_index(self, index_file, index):
+        try:
+            os.makedirs(os.path.dirname(index_file), exist_ok=True)
+            tmp = index_file + ".tmp"
+            with open(tmp, 'wb') as fh:
+                pickle.dump(index, fh, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, index_file)
+        except OSError as e:
+            print(f"[retriever] could not write index {index_file}: {e}")
+
+    def expand_query(self, query):
+        """Lowercase the query and append domain synonyms for better recall."""
+        return self.expander.expand(query)
 
     def search(self, query, k=3):
         """Returns list of (content, doc_id, score) for top-k matches with query expansion."""
-        # Query expansion for better recall
-        expanded_query = query.lower()
-        
-        # Expand key retail terms
-        if 'return' in expanded_query or 'policy' in expanded_query:
-            expanded_query += ' returns policy days window'
-        if 'beverage' in expanded_query:
-            expanded_query += ' beverages drinks unopened opened'
-        if 'aov' in expanded_query or 'average order value' in expanded_query:
-            expanded_query += ' aov order value revenue'
-        if 'kpi' in expanded_query:
-            expanded_query += ' kpi definition formula metric'
-        if 'summer' in expanded_query or 'winter' in expanded_query:
-            expanded_query += ' marketing calendar campaign dates'
-        if 'category' in expanded_query or 'categories' in expanded_query:
-            expanded_query += ' category categories product beverages dairy confections'
-        
-        tokenized_query = expanded_query.split()
-        scores = self.bm25.get_scores(tokenized_query)
-        
-        # Get top k indices
-        top_n = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:k]
-
-        results = []
-        for i in top_n:
-            if scores[i] > 0:  # Only return relevant
-                results.append((self.chunks[i], self.doc_ids[i], float(scores[i])))
-        return results
\ No newline at end of file
+        return self.search_many([query], k)[0]
+
+    def search_many(self, queries, k=3):
+        """Batched search: one sparse matrix product scores every query at once."""
+        if self.bm25 is None:
+            return [[] for _ in queries]
+
+        tokenized = [self.expander.weighted_tokens(q) for q in queries]
+        return [
+            [(self.chunks[i], self.doc_ids[i], score) for i, score in hits]
+            for hits in self.bm25.top_k(tokenized, k)
+        ]
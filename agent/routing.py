@@ -0,0 +1,167 @@
+"""
+Local route classifier (TF-IDF + logistic regression) used as a fast path in
+front of the LLM router, plus the routing decision log it is trained from.
+
+Train / retrain from the log (and optionally a labelled batch whose ids are
+prefixed with the route, like sample_questions_hybrid_eval.jsonl):
+
+    python -m agent.routing --train --seed sample_questions_hybrid_eval.jsonl
+"""
+import argparse
+import json
+import os
+import pickle
+import threading
+import time
+
+ROUTES = ("rag", "sql", "hybrid")
+ROUTE_LOG_PATH = "data/routing/route_log.jsonl"
+ROUTE_MODEL_PATH = "data/routing/route_classifier.pkl"
+
+# Use the classifier's answer only when its top class probability reaches this.
+ROUTER_CONFIDENCE_THRESHOLD = 0.8
+MIN_TRAIN_EXAMPLES = 6
+
+# Decisions made by the classifier itself are logged but not trained on,
+# so it never reinforces its own mistakes.
+TRAINABLE_SOURCES = ("llm", "rule", "label")
+
+_log_lock = threading.Lock()
+_log_enabled = True
+
+
+class RouteClassifier:
+    """TF-IDF (word 1-2 grams) + logistic regression over rag/sql/hybrid."""
+
+    def __init__(self):
+        from sklearn.feature_extraction.text import TfidfVectorizer
+        from sklearn.linear_model import LogisticRegression
+        from sklearn.pipeline import make_pipeline
+
+        self.pipeline = make_pipeline(
+            TfidfVectorizer(lowercase=True, ngram_range=(1, 2), sublinear_tf=True),
+            LogisticRegression(max_iter=1000, C=10.0),
+        )
+        self.trained_on = 0
+
+    def fit(self, questions, routes):
+        self.pipeline.fit(questions, routes)
+        self.trained_on = len(questions)
+        return self
+
+    def predict(self, question):
+        """Return (route, confidence) for one question."""
+        probs = self.pipeline.predict_proba([question])[0]
+        best = probs.argmax()
+        return str(self.pipeline.classes_[best]), float(probs[best])
+
+    def save(self, path=ROUTE_MODEL_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as fh:
+            pickle.dump(self, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def load(path=ROUTE_MODEL_PATH):
+        """Load a saved classifier, or None if there is none (or sklearn is missing)."""
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "rb") as fh:
+                return pickle.load(fh)
+        except Exception as e:
+            print(f"[routing] could not load {path}: {e}")
+            return None
+
+
+def normalize_route(route):
+    """Map free-form router output onto one of ROUTES (default: rag, like router_edge)."""
+    r = (route or "").lower()
+    for name in ("hybrid", "sql", "rag"):
+        if name in r:
+            return name
+    return "rag"
+
+
+def set_route_logging(enabled: bool):
+    """Turn the decision log on/off (e.g. off for benchmarks with a stub LM)."""
+    global _log_enabled
+    _log_enabled = enabled
+
+
+def log_route(question, route, source, confidence=None, path=ROUTE_LOG_PATH):
+    """Append one routing decision to the JSONL log."""
+    if not _log_enabled:
+        return
+    record = {
+        "ts": round(time.time(), 3),
+        "question": question,
+        "route": route,
+        "source": source,
+        "confidence": None if confidence is None else round(confidence, 4),
+    }
+    try:
+        with _log_lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+    except OSError as e:
+        print(f"[routing] could not write log {path}: {e}")
+
+
+def load_training_data(log_path=ROUTE_LOG_PATH, seed_paths=()):
+    """(questions, routes) from the decision log + labelled batches (latest label wins)."""
+    labels = {}
+    if os.path.exists(log_path):
+        with open(log_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                if rec.get("source") in TRAINABLE_SOURCES and rec.get("route") in ROUTES:
+                    labels[rec["question"]] = rec["route"]
+
+    # Hand-labelled batches override whatever the router decided.
+    for seed in seed_paths:
+        with open(seed, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                q = json.loads(line)
+                prefix = str(q.get("id", "")).split("_", 1)[0]
+                if prefix in ROUTES:
+                    labels[q["question"]] = prefix
+
+    return list(labels), list(labels.values())
+
+
+def train_classifier(log_path=ROUTE_LOG_PATH, seed_paths=(), model_path=ROUTE_MODEL_PATH):
+    """Fit and persist a RouteClassifier; returns it, or None if data is insufficient."""
+    questions, routes = load_training_data(log_path, seed_paths)
+    if len(questions) < MIN_TRAIN_EXAMPLES or len(set(routes)) < 2:
+        print(f"[routing] not enough labelled questions to train ({len(questions)}, classes={sorted(set(routes))})")
+        return None
+    clf = RouteClassifier().fit(questions, routes)
+    clf.save(model_path)
+    print(f"[routing] trained on {len(questions)} questions -> {model_path}")
+    return clf
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the local route classifier.")
+    parser.add_argument("--train", action="store_true")
+    parser.add_argument("--log", default=ROUTE_LOG_PATH)
+    parser.add_argument("--seed", action="append", default=[],
+                        help="Labelled JSONL batch whose ids start with rag_/sql_/hybrid_")
+    parser.add_argument("--model", default=ROUTE_MODEL_PATH)
+    args = parser.parse_args()
+    if args.train:
+        # Train through the imported module so the pickle refers to
+        # agent.routing.RouteClassifier, not __main__.RouteClassifier.
+        from agent import routing
+
+        routing.train_classifier(args.log, args.seed, args.model)
+    else:
+        parser.print_help()
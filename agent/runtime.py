@@ -0,0 +1,187 @@
+"""
+Lazily-initialised runtime for the agent.
+
+Importing agent.graph_hybrid must stay cheap and side-effect free, so the
+expensive pieces (DSPy LM + predictors, the BM25 retriever) live on an
+AgentRuntime that builds each component on first use and shares it across
+every `build_app()` call. Heavy dependencies (dspy, langgraph, scipy)
+are only imported when the component that needs them is built.
+
+`python -m agent.runtime` measures the import time of agent.graph_hybrid in a
+fresh interpreter and fails if it exceeds IMPORT_BUDGET_S.
+"""
+import subprocess
+import sys
+import threading
+
+from agent.routing import ROUTE_MODEL_PATH, ROUTER_CONFIDENCE_THRESHOLD
+
+LM_MODEL = "ollama_chat/llama3.1:8b"
+LM_API_BASE = "http://localhost:11434"
+# "litellm" (dspy.LM) or "ollama" (agent.ollama_lm.OllamaLM: pooled async
+# client with a priority queue and keep_alive).
+LM_BACKEND = "litellm"
+DOCS_PATH = "docs/"
+
+# Budget for `import agent.graph_hybrid` in a fresh interpreter.
+IMPORT_BUDGET_S = 0.25
+
+
+class AgentRuntime:
+    """Shared, lazily-built agent components (LM, predictors, retriever)."""
+
+    def __init__(self, model=LM_MODEL, api_base=LM_API_BASE, docs_path=DOCS_PATH,
+                 lm_backend=LM_BACKEND, lm_options=None):
+        self.model = model
+        self.api_base = api_base
+        self.lm_backend = lm_backend
+        self.lm_options = dict(lm_options or {})  # extra OllamaLM kwargs
+        self.docs_path = docs_path
+        self.router_threshold = ROUTER_CONFIDENCE_THRESHOLD
+        self._components = {}
+        self._lock = threading.RLock()
+
+    def _get(self, name, factory):
+        if name not in self._components:
+            with self._lock:
+                if name not in self._components:
+                    self._components[name] = factory()
+        return self._components[name]
+
+    def _build_lm(self):
+        import dspy
+
+        # An LM configured explicitly beforehand (e.g. a benchmark stub) wins.
+        if dspy.settings.lm is not None:
+            return dspy.settings.lm
+        if self.lm_backend == "ollama":
+            from agent.ollama_lm import OllamaLM
+            lm = OllamaLM(self.model, api_base=self.api_base, **self.lm_options)
+        else:
+            lm = dspy.LM(self.model, api_base=self.api_base, api_key="")
+        dspy.configure(lm=lm)
+        return lm
+
+    def _build_router(self):
+        import dspy
+        from agent.dspy_signatures import RouterSignature
+        return dspy.Predict(RouterSignature)
+
+    def _build_planner(self):
+        import dspy
+        from agent.dspy_signatures import PlannerSignature
+        return dspy.Predict(PlannerSignature)
+
+    def _build_sql_gen(self):
+        import dspy
+        from agent.dspy_signatures import GenerateSQL
+        return dspy.ChainOfThought(GenerateSQL)
+
+    def _build_plan_sql(self):
+        import dspy
+        from agent.dspy_signatures import PlanAndGenerateSQL
+        return dspy.ChainOfThought(PlanAndGenerateSQL)
+
+    def _build_synthesizer(self):
+        import dspy
+        from agent.dspy_signatures import SynthesizeAnswer
+        return dspy.Predict(SynthesizeAnswer)
+
+    def _build_retriever(self):
+        from agent.rag.retrieval import LocalRetriever
+        return LocalRetriever(self.docs_path)
+
+    def _build_route_classifier(self):
+        from agent.routing import RouteClassifier
+        return RouteClassifier.load(ROUTE_MODEL_PATH)
+
+    @property
+    def lm(self):
+        return self._get("lm", self._build_lm)
+
+    @property
+    def router(self):
+        return self._get("router", self._build_router)
+
+    @property
+    def planner(self):
+        return self._get("planner", self._build_planner)
+
+    @property
+    def sql_gen(self):
+        return self._get("sql_gen", self._build_sql_gen)
+
+    @property
+    def plan_sql(self):
+        """Fused planner + SQL generator (build_app(fused_plan_sql=True))."""
+        return self._get("plan_sql", self._build_plan_sql)
+
+    @property
+    def synthesizer(self):
+        return self._get("synthesizer", self._build_synthesizer)
+
+    @property
+    def retriever(self):
+        return self._get("retriever", self._build_retriever)
+
+    @property
+    def route_classifier(self):
+        """Local router fast path, or None when no trained model exists."""
+        return self._get("route_classifier", self._build_route_classifier)
+
+    def model_id(self):
+        """Id of the LM predictions currently come from (used in cache keys)."""
+        import dspy
+
+        lm = dspy.settings.lm or self.lm
+        return getattr(lm, "model", type(lm).__name__)
+
+    def warm_up(self):
+        """Build every component now instead of on the first question."""
+        for name in ("lm", "router", "planner", "sql_gen", "plan_sql", "synthesizer", "retriever"):
+            getattr(self, name)
+        if hasattr(self.lm, "warm"):
+            try:
+                self.lm.warm()  # load the model now and keep it resident
+            except Exception as e:
+                print(f"[runtime] LM warm-up failed: {e}")
+        return self
+
+
+_runtime = None
+_runtime_lock = threading.Lock()
+
+
+def get_runtime():
+    """The process-wide AgentRuntime (created, but not built, on first call)."""
+    global _runtime
+    if _runtime is None:
+        with _runtime_lock:
+            if _runtime is None:
+                _runtime = AgentRuntime()
+    return _runtime
+
+
+def set_runtime(runtime):
+    """Swap the process-wide runtime (e.g. for benchmarks); returns the old one."""
+    global _runtime
+    with _runtime_lock:
+        old, _runtime = _runtime, runtime
+    return old
+
+
+def measure_import_time(module="agent.graph_hybrid"):
+    """Seconds to import `module` in a fresh interpreter."""
+    code = (
+        "import time; t = time.perf_counter(); "
+        f"import {module}; print(time.perf_counter() - t)"
+    )
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    elapsed = measure_import_time()
+    status = "OK" if elapsed <= IMPORT_BUDGET_S else "OVER BUDGET"
+    print(f"import agent.graph_hybrid: {elapsed * 1000:.1f} ms (budget {IMPORT_BUDGET_S * 1000:.0f} ms) {status}")
+    sys.exit(0 if elapsed <= IMPORT_BUDGET_S else 1)
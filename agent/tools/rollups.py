@@ -0,0 +1,519 @@
+"""
+Indexes and pre-aggregated daily rollups for the Northwind order data.
+
+Generated KPI queries filter with `date(o.OrderDate) BETWEEN ...` and
+aggregate revenue / quantity / order counts, which scans the whole order
+history every time. The maintenance command
+
+    python -m agent.tools.rollups --build
+
+(1) adds expression indexes on the base tables (`date(OrderDate)` matches the
+filter the SQL generator is told to write, so SQLite can use the index), and
+(2) materialises daily rollups by product, category and customer into a
+sidecar SQLite file (ROLLUP_DB_PATH).
+
+At query time, execute_query() asks rewrite_for_rollups() whether a query is
+one of the simple aggregate shapes the rollups can answer (SUM of
+revenue / quantity, COUNT(DISTINCT OrderID), date range + equality filters,
+GROUP BY on product / category / customer columns, every non-aggregate
+output column grouped). If so it runs the rewritten query against the
+sidecar under the original output column names; results match the base
+tables up to floating-point summation order. Joins to dimension tables are
+only rewritten when the build verified that they neither drop nor repeat
+order lines. Anything else, a stale sidecar or a failing rewrite falls
+through to the main database unchanged.
+"""
+import argparse
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from agent.tools.sqlite_tool import DB_PATH, ConnectionPool, _db_version, canonicalize_sql
+
+ROLLUP_DB_PATH = "data/cache/northwind_rollups.sqlite"
+ROLLUPS_ENABLED = True
+
+# (index name, logical table, expression). The table is resolved to the real
+# base table, since indexes cannot be created on the compatibility views.
+INDEXES = [
+    ("idx_orders_order_day", "orders", "date(OrderDate)"),
+    ("idx_orders_customer", "orders", "CustomerID"),
+    ("idx_order_lines_product", "order_lines", "ProductID"),
+]
+_BASE_TABLES = {
+    "orders": ("Orders", "orders"),
+    "order_lines": ("Order Details", "order_items"),
+}
+
+_LINES_SQL = """
+    SELECT date(o.OrderDate) AS day, o.OrderID AS order_id, o.CustomerID AS customer_id,
+           oi.ProductID AS product_id, oi.Quantity AS quantity,
+           oi.UnitPrice * oi.Quantity * (1 - COALESCE(oi.Discount, 0)) AS revenue
+    FROM src.orders o JOIN src.order_items oi ON oi.OrderID = o.OrderID
+"""
+
+# rollup table -> (dimension columns, SELECT building it from `lines`)
+ROLLUP_TABLES = {
+    "daily_sales": ((), """
+        SELECT day, COUNT(DISTINCT order_id) AS orders, SUM(quantity) AS quantity,
+               SUM(revenue) AS revenue
+        FROM lines GROUP BY day"""),
+    "daily_product_sales": (("ProductID", "ProductName", "CategoryID", "CategoryName"), """
+        SELECT l.day, l.product_id AS ProductID, p.ProductName, p.CategoryID, c.CategoryName,
+               COUNT(DISTINCT l.order_id) AS orders, SUM(l.quantity) AS quantity,
+               SUM(l.revenue) AS revenue
+        FROM lines l LEFT JOIN src.products p ON p.ProductID = l.product_id
+        LEFT JOIN src.Categories c ON c.CategoryID = p.CategoryID
+        GROUP BY l.day, l.product_id"""),
+    "daily_category_sales": (("CategoryID", "CategoryName"), """
+        SELECT l.day, p.CategoryID, c.CategoryName,
+               COUNT(DISTINCT l.order_id) AS orders, SUM(l.quantity) AS quantity,
+               SUM(l.revenue) AS revenue
+        FROM lines l LEFT JOIN src.products p ON p.ProductID = l.product_id
+        LEFT JOIN src.Categories c ON c.CategoryID = p.CategoryID
+        GROUP BY l.day, p.CategoryID"""),
+    "daily_customer_sales": (("CustomerID", "CompanyName"), """
+        SELECT l.day, l.customer_id AS CustomerID, cu.CompanyName,
+               COUNT(DISTINCT l.order_id) AS orders, SUM(l.quantity) AS quantity,
+               SUM(l.revenue) AS revenue
+        FROM lines l LEFT JOIN src.customers cu ON cu.CustomerID = l.customer_id
+        GROUP BY l.day, l.customer_id"""),
+}
+
+# Table kind -> number of order lines an inner join to it would drop or
+# repeat (unmatched or duplicate keys). A query joining the table is only
+# answered from the rollups when this is 0; for orders, the rollups already
+# inner-join it, so it matters for queries that leave orders out.
+_JOIN_CHECKS = {
+    "orders": """
+        SELECT (SELECT COUNT(*) FROM src.order_items) - (SELECT COUNT(*) FROM lines)""",
+    "products": """
+        SELECT COUNT(*) FROM lines l
+        WHERE (SELECT COUNT(*) FROM src.products p WHERE p.ProductID = l.product_id) != 1""",
+    "categories": """
+        SELECT COUNT(*) FROM lines l JOIN src.products p ON p.ProductID = l.product_id
+        WHERE (SELECT COUNT(*) FROM src.Categories c WHERE c.CategoryID = p.CategoryID) != 1""",
+    "customers": """
+        SELECT COUNT(*) FROM lines l
+        WHERE (SELECT COUNT(*) FROM src.customers cu WHERE cu.CustomerID = l.customer_id) != 1""",
+}
+
+
+# ---------------------------------------------------------------------------
+# Maintenance
+# ---------------------------------------------------------------------------
+
+def _resolve_table(conn, logical):
+    for name in _BASE_TABLES[logical]:
+        row = conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = ? COLLATE NOCASE",
+            (name,)).fetchone()
+        if row:
+            return row[0]
+    raise RuntimeError(f"No base table found for {logical} (tried {_BASE_TABLES[logical]})")
+
+
+def build_indexes(db_path=DB_PATH):
+    """Create the expression / lookup indexes on the base tables and ANALYZE."""
+    conn = sqlite3.connect(db_path)
+    try:
+        for name, logical, expr in INDEXES:
+            table = _resolve_table(conn, logical)
+            conn.execute(f'CREATE INDEX IF NOT EXISTS {name} ON "{table}"({expr})')
+            print(f"[rollups] index {name} on {table}({expr})")
+        conn.execute("ANALYZE")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def build_rollups(db_path=DB_PATH, out_path=ROLLUP_DB_PATH):
+    """Materialise ROLLUP_TABLES into out_path (built in a temp file, then swapped in)."""
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    tmp = out_path + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+
+    start = time.perf_counter()
+    conn = sqlite3.connect(tmp)
+    try:
+        conn.execute("ATTACH DATABASE ? AS src", (os.path.abspath(db_path),))
+        conn.execute(f"CREATE TEMP TABLE lines AS {_LINES_SQL}")
+        for table, (dims, select) in ROLLUP_TABLES.items():
+            conn.execute(f"CREATE TABLE {table} AS {select}")
+            conn.execute(f"CREATE INDEX idx_{table}_day ON {table}(day)")
+            for dim in dims[:1]:
+                conn.execute(f"CREATE INDEX idx_{table}_{dim.lower()} ON {table}({dim}, day)")
+            count = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            print(f"[rollups] {table}: {count} rows")
+
+        lossless = [kind for kind, check in _JOIN_CHECKS.items()
+                    if conn.execute(check).fetchone()[0] == 0]
+        print(f"[rollups] lossless joins: {', '.join(lossless) or 'none'}")
+
+        mtime_ns, size = _db_version(db_path)
+        conn.execute("CREATE TABLE rollup_meta(key TEXT PRIMARY KEY, value TEXT)")
+        conn.executemany("INSERT INTO rollup_meta VALUES (?, ?)", [
+            ("source_mtime_ns", str(mtime_ns)),
+            ("source_size", str(size)),
+            ("lossless_joins", ",".join(lossless)),
+            ("built_at", time.strftime("%Y-%m-%dT%H:%M:%S")),
+        ])
+        conn.commit()
+        conn.execute("DETACH DATABASE src")
+        conn.execute("ANALYZE")
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp, out_path)
+    close_rollup_pool()
+    print(f"[rollups] wrote {out_path} in {time.perf_counter() - start:.2f}s")
+
+
+# ---------------------------------------------------------------------------
+# Query routing
+# ---------------------------------------------------------------------------
+
+_rollup_pool = None
+_rollup_state = {"key": None, "fresh": False, "lossless": frozenset()}
+_rollup_lock = threading.Lock()
+_stats_lock = threading.Lock()  # route_query runs on the batch worker threads
+_stats = {"routed": 0}
+
+
+def set_rollups(enabled: bool):
+    """Turn transparent rollup routing on/off."""
+    global ROLLUPS_ENABLED
+    ROLLUPS_ENABLED = enabled
+
+
+def rollup_stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+def close_rollup_pool():
+    global _rollup_pool
+    with _rollup_lock:
+        pool, _rollup_pool = _rollup_pool, None
+        _rollup_state["key"] = None
+    if pool is not None:
+        pool.close()
+
+
+def _rollups_fresh(db_version):
+    """True when the sidecar exists and was built from the current DB file."""
+    side_version = _db_version(ROLLUP_DB_PATH)
+    if side_version is None or db_version is None:
+        return False
+    key = (db_version, side_version)
+    if _rollup_state["key"] != key:
+        with _rollup_lock:
+            try:
+                conn = sqlite3.connect(f"file:{os.path.abspath(ROLLUP_DB_PATH)}?mode=ro", uri=True)
+                try:
+                    meta = dict(conn.execute("SELECT key, value FROM rollup_meta").fetchall())
+                finally:
+                    conn.close()
+                fresh = (int(meta["source_mtime_ns"]), int(meta["source_size"])) == tuple(db_version)
+                lossless = frozenset(filter(None, meta.get("lossless_joins", "").split(",")))
+            except (sqlite3.Error, KeyError, ValueError):
+                fresh, lossless = False, frozenset()
+            if not fresh:
+                print(f"[rollups] {ROLLUP_DB_PATH} is stale; run `python -m agent.tools.rollups --build`")
+            _rollup_state.update(key=key, fresh=fresh, lossless=lossless)
+    return _rollup_state["fresh"]
+
+
+def get_rollup_pool():
+    global _rollup_pool
+    if _rollup_pool is None:
+        with _rollup_lock:
+            if _rollup_pool is None:
+                _rollup_pool = ConnectionPool(ROLLUP_DB_PATH)
+    return _rollup_pool
+
+
+_QUERY_RE = re.compile(
+    r"^select (?P<select>.+?) from (?P<from>.+?)"
+    r"(?: where (?P<where>.+?))?(?: group by (?P<group>.+?))?"
+    r"(?: order by (?P<order>.+?))?(?: limit (?P<limit>\d+))?$")
+_TABLE_RE = re.compile(r'^(?P<table>\w+|"order details")(?: as)?(?: (?P<alias>\w+))?(?: on (?P<on>.+))?$')
+_ON_RE = re.compile(r"^(\w+)\.(\w+)=(\w+)\.(\w+)$")
+_DATE_RANGE_RE = re.compile(r"date\((\w+)\.orderdate\) between ('\d{4}-\d{2}-\d{2}') and ('\d{4}-\d{2}-\d{2}')")
+_STRFTIME_RE = re.compile(r"strftime\(('(?:%[Ymd]|-)+'),(\w+)\.orderdate\)")
+_IDENT_RE = re.compile(r"'(?:[^']|'')*'|[a-z_][\w.]*")
+_QUOTED_RE = re.compile(r"('(?:[^']|'')*')")
+_KEYWORD_RE = re.compile(r"\b(from|where|group by|order by|limit|as|and|or|between|join|on|in|asc|desc)\b")
+
+_TABLE_KIND = {"orders": "orders", "order_items": "lines", '"order details"': "lines",
+               "products": "products", "categories": "categories", "customers": "customers"}
+_JOIN_KEYS = {"orderid", "productid", "categoryid", "customerid"}
+# (table kind, column) -> (rollup column, grain)
+_DIMS = {
+    ("products", "productid"): ("ProductID", "product"),
+    ("lines", "productid"): ("ProductID", "product"),
+    ("products", "productname"): ("ProductName", "product"),
+    ("products", "categoryid"): ("CategoryID", "category"),
+    ("categories", "categoryid"): ("CategoryID", "category"),
+    ("categories", "categoryname"): ("CategoryName", "category"),
+    ("orders", "customerid"): ("CustomerID", "customer"),
+    ("customers", "customerid"): ("CustomerID", "customer"),
+    ("customers", "companyname"): ("CompanyName", "customer"),
+}
+_GRAIN_TABLE = {None: "daily_sales", "product": "daily_product_sales",
+                "category": "daily_category_sales", "customer": "daily_customer_sales"}
+_GRAIN_KEYS = {"product": {"ProductID", "ProductName"}, "category": {"CategoryID", "CategoryName"},
+               "customer": {"CustomerID", "CompanyName"}}
+_ALLOWED_WORDS = {"sum", "round", "as", "and", "or", "in", "asc", "desc", "between", "strftime",
+                  "day", "revenue", "quantity", "orders", "null", "is", "not"}
+
+
+def _spaced(q):
+    """canonicalize_sql() drops spaces next to punctuation; put them back around keywords."""
+    parts = _QUOTED_RE.split(q)
+    for i in range(0, len(parts), 2):  # even parts are outside quotes
+        parts[i] = _KEYWORD_RE.sub(r" \1 ", parts[i])
+    return re.sub(r" +", " ", "".join(parts)).strip()
+
+
+def _split_top(text, sep=","):
+    """Split on sep outside parentheses and quotes."""
+    parts, depth, quote, cur = [], 0, False, ""
+    for ch in text:
+        if ch == "'":
+            quote = not quote
+        elif not quote and ch == "(":
+            depth += 1
+        elif not quote and ch == ")":
+            depth -= 1
+        if ch == sep and depth == 0 and not quote:
+            parts.append(cur)
+            cur = ""
+        else:
+            cur += ch
+    parts.append(cur)
+    return [p.strip() for p in parts]
+
+
+def _parse_from(clause):
+    """alias -> table kind, or None if the joins are not the plain key joins."""
+    aliases = {}
+    for i, part in enumerate(re.split(r" (?:inner )?join ", clause)):
+        m = _TABLE_RE.match(part)
+        if not m or m.group("table") not in _TABLE_KIND or (i > 0) != bool(m.group("on")):
+            return None
+        aliases[m.group("alias") or m.group("table")] = _TABLE_KIND[m.group("table")]
+        if m.group("on"):
+            on = _ON_RE.match(m.group("on"))
+            if not on or on.group(2) != on.group(4) or on.group(2) not in _JOIN_KEYS \
+                    or on.group(1) not in aliases or on.group(3) not in aliases:
+                return None
+    return aliases
+
+
+_SOURCE_TOKEN_RE = re.compile(r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\]|\w+|\s+|.""", re.S)
+_ALIAS_RE = re.compile(r"""\s+as\s+(\w+|"(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\])$""", re.I)
+_COLUMN_RE = re.compile(r"\w+\.\w+")
+
+
+def _select_items(sql):
+    """Output expressions of a single SELECT exactly as written in sql (SQLite names columns after them)."""
+    items, depth, cur, started = [], 0, "", False
+    for tok in _SOURCE_TOKEN_RE.findall(sql):
+        low = tok.lower()
+        if not started:
+            started = low == "select"
+            continue
+        if depth == 0 and low == "from":
+            items.append(cur.strip())
+            return items
+        if tok == "(":
+            depth += 1
+        elif tok == ")":
+            depth -= 1
+        if tok == "," and depth == 0:
+            items.append(cur.strip())
+            cur = ""
+        else:
+            cur += tok
+    return None
+
+
+def _output_name(text):
+    """Alias that keeps SQLite's column name for the select item text, or None for plain columns."""
+    alias = _ALIAS_RE.search(text)
+    if alias:
+        return alias.group(1)
+    if _COLUMN_RE.fullmatch(text):
+        return None  # named after the column, which the rollups keep
+    return '"' + text.replace('"', '""') + '"'
+
+
+def _is_aggregate(expr):
+    return "sum(" in expr
+
+
+def rewrite_for_rollups(sql, lossless=()):
+    """
+    Rollup-table equivalent of sql, or None when the query is not a shape
+    the rollups answer exactly. Works on canonicalize_sql() output.
+
+    Only aggregates are rewritten: at least one measure, and every other
+    output or ORDER BY expression grouped. `lossless` lists the table kinds
+    (see _JOIN_CHECKS) whose joins the build verified; queries joining any
+    other dimension table, or leaving out orders unless it is listed, are
+    not rewritten.
+    """
+    q = _spaced(canonicalize_sql(sql))
+    m = _QUERY_RE.match(q)
+    if not m or q.count("select") != 1 or " having " in q or " union " in q:
+        return None
+    aliases = _parse_from(m.group("from"))
+    if not aliases or "lines" not in aliases.values():
+        return None
+    kinds = list(aliases.values())
+    if len(set(kinds)) != len(kinds):
+        return None  # self-joins repeat lines
+    joined = set(kinds) - {"lines"}
+    if "orders" not in joined and "orders" not in lossless:
+        return None
+    if any(kind not in lossless for kind in joined - {"orders"}):
+        return None
+    line = next(a for a, kind in aliases.items() if kind == "lines")
+    order = [a for a, kind in aliases.items() if kind == "orders"]
+
+    # Measures.
+    revenue_terms = [f"{line}.unitprice\\*{line}.quantity", f"{line}.quantity\\*{line}.unitprice"]
+    discount = f"(?:coalesce\\({line}.discount,0\\)|{line}.discount)"
+    measures = [
+        (re.compile(f"sum\\((?:{'|'.join(revenue_terms)})\\*\\(1-{discount}\\)\\)"), "sum(revenue)"),
+        (re.compile(f"sum\\({line}.quantity\\)"), "sum(quantity)"),
+        (re.compile(f"count\\(distinct (?:{'|'.join([line] + order)}).orderid\\)"), "sum(orders)"),
+    ]
+    if order:
+        measures.append((re.compile(f"date\\({order[0]}.orderdate\\)"), "day"))
+        measures.append((_STRFTIME_RE, lambda s: f"strftime({s.group(1)},day)"
+                         if s.group(2) == order[0] else s.group(0)))
+
+    used_grains, used_dims = set(), set()
+
+    def rewrite(expr):
+        for pattern, repl in measures:
+            expr = pattern.sub(repl, expr)
+
+        def dim(match):
+            tok = match.group(0)
+            if "." not in tok or tok.startswith("'"):
+                return tok
+            alias, col = tok.split(".", 1)
+            target = _DIMS.get((aliases.get(alias), col))
+            if target is None:
+                raise ValueError(tok)
+            used_dims.add(target[0])
+            used_grains.add(target[1])
+            return target[0]
+        return _IDENT_RE.sub(dim, expr)
+
+    try:
+        select = [rewrite(item) for item in _split_top(m.group("select"))]
+        output_names = {item.rsplit(" as ", 1)[1] for item in select if " as " in item}
+        where_sql = m.group("where")
+        filters = []
+        if where_sql:
+            where_sql = _DATE_RANGE_RE.sub(
+                lambda d: f"day between {d.group(2)} and {d.group(3)}" if d.group(1) in order else d.group(0),
+                where_sql)
+            where_sql = rewrite(where_sql)
+            filters = [f for f in re.split(r" and (?!'\d{4}-\d{2}-\d{2}')", where_sql)]
+        group = [rewrite(g) for g in _split_top(m.group("group"))] if m.group("group") else []
+        order_by = rewrite(m.group("order")) if m.group("order") else None
+    except ValueError:
+        return None
+
+    if used_grains == {"product", "category"}:
+        used_grains = {"product"}  # product rollup rows carry their category
+    if len(used_grains) > 1:
+        return None
+    grain = next(iter(used_grains), None)
+
+    # Every remaining identifier must be a rollup column, function or output alias.
+    allowed = _ALLOWED_WORDS | {d.lower() for d in used_dims} | output_names
+    for part in select + filters + group + [order_by or ""]:
+        for tok in _IDENT_RE.findall(part.lower()):
+            if not tok.startswith("'") and tok not in allowed:
+                return None
+
+    # Aggregates only: every non-aggregate output and sort key is grouped.
+    grouped = set(group)
+    if not any(_is_aggregate(item) for item in select):
+        return None
+    for item in select:
+        expr, _, alias = item.partition(" as ")
+        if not _is_aggregate(expr) and expr not in grouped and alias not in grouped:
+            return None
+    select_exprs = {item.partition(" as ")[0] for item in select}
+    for term in _split_top(order_by) if order_by else []:
+        term = re.sub(r" (?:asc|desc)$", "", term)
+        if not (_is_aggregate(term) or term.isdigit() or term in grouped
+                or term in select_exprs or term in output_names):
+            return None
+
+    # Keep the base query's column names: SQLite names an unaliased
+    # expression after its source text, which the rewrite changes.
+    original = _select_items(sql)
+    if original is None or len(original) != len(select):
+        return None
+    for i, (item, text) in enumerate(zip(select, original)):
+        name = _output_name(text)
+        if name is not None:
+            select[i] = f"{item.partition(' as ')[0]} AS {name}"
+
+    # Order counts are only additive across rows of one grain value.
+    if grain and any("sum(orders)" in s for s in select + [order_by or ""]):
+        pinned = set(group) | {f.split("=")[0] for f in filters if "=" in f and " or " not in f}
+        if not (pinned & _GRAIN_KEYS[grain]):
+            return None
+
+    out = f"SELECT {', '.join(select)} FROM {_GRAIN_TABLE[grain]}"
+    if where_sql:
+        out += f" WHERE {where_sql}"
+    if group:
+        out += f" GROUP BY {', '.join(group)}"
+    if order_by:
+        out += f" ORDER BY {order_by}"
+    if m.group("limit"):
+        out += f" LIMIT {m.group('limit')}"
+    return out
+
+
+def route_query(sql, db_version):
+    """(rewritten sql, rollup pool) when the rollups can answer sql, else None."""
+    if not ROLLUPS_ENABLED or not _rollups_fresh(db_version):
+        return None
+    rewritten = rewrite_for_rollups(sql, _rollup_state["lossless"])
+    if rewritten is None:
+        return None
+    with _stats_lock:
+        _stats["routed"] += 1
+    return rewritten, get_rollup_pool()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build indexes and daily rollups for the Northwind DB.")
+    parser.add_argument("--build", action="store_true", help="Create indexes and (re)build the rollups")
+    parser.add_argument("--no-indexes", action="store_true", help="Only rebuild the rollup file")
+    parser.add_argument("--db", default=DB_PATH)
+    parser.add_argument("--out", default=ROLLUP_DB_PATH)
+    parser.add_argument("--explain", metavar="SQL", help="Show the rollup rewrite of a query")
+    args = parser.parse_args()
+    if args.build:
+        if not args.no_indexes:
+            build_indexes(args.db)
+        build_rollups(args.db, args.out)
+    elif args.explain:
+        print(rewrite_for_rollups(args.explain) or "Not eligible for rollups.")
+    else:
+        parser.print_help()
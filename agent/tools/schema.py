@@ -0,0 +1,249 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+from contextlib import closing
+
+from agent.prompt_budget import estimate_tokens, fit_lines
+from agent.tools.sqlite_tool import DB_PATH, _readonly_uri
+
+# Tables/views exposed to the SQL generator.
+SCHEMA_TABLES = ['orders', 'order_items', 'products', 'customers']
+
+# Columns with at most this many distinct values get a few example values in
+# the snapshot (e.g. ShipCountry, CategoryID), which helps the generator
+# pick real filter literals instead of inventing them.
+LOW_CARDINALITY_MAX = 25
+SAMPLE_VALUES = 5
+
+SCHEMA_CACHE_DIR = "data/cache"
+SNAPSHOT_VERSION = 1
+
+_memory_cache = {}
+_lock = threading.Lock()
+
+
+def _file_version(db_path):
+    st = os.stat(db_path)
+    return st.st_mtime_ns, st.st_size
+
+
+def _cache_path(db_path):
+    key = hashlib.sha1(os.path.abspath(db_path).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(SCHEMA_CACHE_DIR, f"schema_{key}.json")
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _base_table(cursor, name):
+    """For a simple `CREATE VIEW v AS SELECT ... FROM t` return (kind, t)."""
+    cursor.execute("SELECT type, sql FROM sqlite_master WHERE name = ? COLLATE NOCASE", (name,))
+    row = cursor.fetchone()
+    if row is None:
+        return None, None
+    kind, sql = row
+    if kind != "view" or not sql:
+        return kind, name
+    m = re.search(r'\bFROM\s+("[^"]+"|\[[^\]]+\]|\w+)', sql, re.IGNORECASE)
+    return kind, (m.group(1).strip('"[]') if m else None)
+
+
+def _foreign_keys(cursor, table, alias_of):
+    if not table:
+        return []
+    cursor.execute(f"PRAGMA foreign_key_list({_quote(table)})")
+    fks = []
+    for row in cursor.fetchall():
+        # (id, seq, table, from, to, on_update, on_delete, match)
+        ref_table = alias_of.get(row[2].lower(), row[2])
+        fks.append({"column": row[3], "ref_table": ref_table, "ref_column": row[4]})
+    return fks
+
+
+def build_snapshot(db_path=DB_PATH, tables=None):
+    """Introspect db_path once: columns, types, FKs, row counts and sample values."""
+    tables = tables or SCHEMA_TABLES
+    mtime_ns, size = _file_version(db_path)
+
+    with closing(sqlite3.connect(_readonly_uri(db_path), uri=True)) as conn:
+        cursor = conn.cursor()
+
+        kinds, bases = {}, {}
+        for t in tables:
+            kinds[t], bases[t] = _base_table(cursor, t)
+        # Map underlying table names back to the names the generator sees,
+        # e.g. "Order Details" -> order_items.
+        alias_of = {b.lower(): t for t, b in bases.items() if b}
+
+        snapshot_tables = []
+        for t in tables:
+            cursor.execute(f"PRAGMA table_info({_quote(t)})")
+            columns = [{"name": c[1], "type": c[2] or "", "pk": bool(c[5])} for c in cursor.fetchall()]
+
+            cursor.execute(f"SELECT COUNT(*) FROM {_quote(t)}")
+            row_count = cursor.fetchone()[0]
+
+            samples = {}
+            for col in columns:
+                if col["pk"]:
+                    continue
+                q = _quote(col["name"])
+                cursor.execute(f"SELECT COUNT(DISTINCT {q}) FROM {_quote(t)}")
+                distinct = cursor.fetchone()[0]
+                if 0 < distinct <= LOW_CARDINALITY_MAX:
+                    cursor.execute(
+                        f"SELECT {q} FROM {_quote(t)} WHERE {q} IS NOT NULL "
+                        f"GROUP BY {q} ORDER BY COUNT(*) DESC, {q} LIMIT {SAMPLE_VALUES}"
+                    )
+                    samples[col["name"]] = [r[0] for r in cursor.fetchall()]
+
+            snapshot_tables.append({
+                "name": t,
+                "kind": kinds[t] or "table",
+                "row_count": row_count,
+                "columns": columns,
+                "foreign_keys": _foreign_keys(cursor, bases[t], alias_of),
+                "samples": samples,
+            })
+
+    return {
+        "version": SNAPSHOT_VERSION,
+        "db_path": os.path.abspath(db_path),
+        "mtime_ns": mtime_ns,
+        "size": size,
+        "tables": snapshot_tables,
+    }
+
+
+def render_schema(snapshot, samples=True, omit=()):
+    """
+    Compact, LLM-friendly text form of a snapshot, optionally without sample
+    values and without the (table, column) pairs in omit.
+    """
+    schema_str = ""
+    for t in snapshot["tables"]:
+        kept = [c for c in t["columns"] if (t["name"], c["name"]) not in omit]
+        cols = ", ".join(f"{c['name']} {c['type']}".strip() for c in kept)
+        if len(kept) < len(t["columns"]):
+            cols += f", ... ({len(t['columns']) - len(kept)} more)"
+        schema_str += f"Table: {t['name']} ({t['row_count']} rows)\nColumns: {cols}\n"
+        if t["foreign_keys"]:
+            fks = ", ".join(f"{fk['column']} -> {fk['ref_table']}.{fk['ref_column']}" for fk in t["foreign_keys"])
+            schema_str += f"Foreign keys: {fks}\n"
+        if samples and t["samples"]:
+            vals = "; ".join(
+                f"{col}: {', '.join(repr(v) for v in values)}" for col, values in t["samples"].items()
+            )
+            schema_str += f"Sample values: {vals}\n"
+        schema_str += "\n"
+    return schema_str
+
+
+def _load_from_disk(path, db_path, version):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            snap = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if (snap.get("version") == SNAPSHOT_VERSION
+            and snap.get("db_path") == os.path.abspath(db_path)
+            and (snap.get("mtime_ns"), snap.get("size")) == version):
+        return snap
+    return None
+
+
+def _save_to_disk(path, snap):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(snap, f)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"[schema] could not write cache {path}: {e}")
+
+
+def get_schema_snapshot(db_path=DB_PATH):
+    """
+    Return the schema snapshot for db_path.
+
+    Served from memory, then from the on-disk cache, and only rebuilt when the
+    DB file's mtime or size no longer match the cached snapshot.
+    """
+    key = os.path.abspath(db_path)
+    version = _file_version(db_path)
+
+    cached = _memory_cache.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    with _lock:
+        cached = _memory_cache.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        path = _cache_path(db_path)
+        snap = _load_from_disk(path, db_path, version)
+        if snap is None:
+            snap = build_snapshot(db_path)
+            _save_to_disk(path, snap)
+            print(f"[schema] built snapshot for {db_path} ({len(snap['tables'])} tables)")
+        snap["rendered"] = render_schema(snap)
+        _memory_cache[key] = (version, snap)
+        return snap
+
+
+def _droppable_columns(snapshot):
+    """
+    (table, column) pairs that can go when the schema is over budget: not
+    keys, not foreign keys, not *ID. Last columns first, round-robin over
+    tables, so every table keeps its leading columns longest.
+    """
+    per_table = []
+    for t in snapshot["tables"]:
+        keys = {fk["column"] for fk in t["foreign_keys"]}
+        per_table.append([(t["name"], c["name"]) for c in reversed(t["columns"])
+                          if not c["pk"] and c["name"] not in keys and not c["name"].lower().endswith("id")])
+    order = []
+    for i in range(max(map(len, per_table), default=0)):
+        order.extend(cols[i] for cols in per_table if i < len(cols))
+    return order
+
+
+def _fit_schema(snapshot, max_tokens):
+    """Schema text within max_tokens: drop samples, then non-key columns, then trailing lines."""
+    text = render_schema(snapshot, samples=False)
+    omit = set()
+    for column in _droppable_columns(snapshot):
+        if estimate_tokens(text) <= max_tokens:
+            return text
+        omit.add(column)
+        text = render_schema(snapshot, samples=False, omit=omit)
+    return fit_lines(text, max_tokens)
+
+
+def get_schema_string(db_path=DB_PATH, max_tokens=None):
+    """
+    Returns a compact schema string for the LLM (cached per DB version).
+
+    Over max_tokens, sample values are dropped first, then non-key columns
+    (marked "... (N more)"), and only then trailing lines. The result
+    depends only on the DB, so it stays a stable prompt prefix.
+    """
+    snap = get_schema_snapshot(db_path)
+    if max_tokens is None or estimate_tokens(snap["rendered"]) <= max_tokens:
+        return snap["rendered"]
+    key = f"rendered_{max_tokens}"
+    if key not in snap:
+        snap[key] = _fit_schema(snap, max_tokens)
+    return snap[key]
+
+
+def clear_schema_cache():
+    """Drop in-memory snapshots (on-disk cache is invalidated by file version)."""
+    with _lock:
+        _memory_cache.clear()
@@ -0,0 +1,450 @@
+"""
+Rule-based repair of mechanical SQLite errors before an LLM retry.
+
+execute_sql_node hands a failed query to run_with_repair(), which classifies
+the error and rewrites the query locally:
+
+* "ambiguous column name: X"  -> prefix X with the alias of a table that has it,
+                                 if all tables with X are joined on it (a join
+                                 key such as ProductID); otherwise the choice
+                                 changes the answer (oi.UnitPrice is the sale
+                                 price, p.UnitPrice the list price) and the
+                                 LLM decides;
+* "no such column: [a.]X"     -> fix the alias or the column's spelling, or
+                                 insert the JOINs that bring in a table with X
+                                 (foreign keys, or <Table>ID primary keys);
+* "no such function: YEAR"    -> strftime('%Y', ...) (MONTH, DAY likewise) and
+                                 renames such as LEN -> length;
+* "no such table: X"          -> the table whose name matches up to case,
+                                 spaces and underscores.
+
+Rewrites work on a token list (quoted strings and identifiers are never
+split), so the rest of the query keeps its formatting. The fixed query is
+re-executed, up to MAX_REPAIR_STEPS rewrites per query; only when no rule
+applies or the result still fails does the LLM repair loop take over.
+repair_stats() reports the local fix rate.
+"""
+import re
+import sqlite3
+import threading
+from collections import deque
+from contextlib import closing
+
+from agent.tools.schema import SCHEMA_TABLES
+from agent.tools.sqlite_tool import DB_PATH, _db_version, _readonly_uri, execute_query
+from agent.tracing import span
+
+SQL_REPAIR_ENABLED = True
+MAX_REPAIR_STEPS = 3
+
+# Functions SQLite lacks -> strftime format (date parts) or SQLite name.
+DATE_PART_FUNCTIONS = {"year": "%Y", "month": "%m", "day": "%d"}
+# isnull/nvl map to coalesce, not ifnull: the GenerateSQL prompt forbids IFNULL.
+FUNCTION_RENAMES = {"len": "length", "isnull": "coalesce", "nvl": "coalesce", "substring": "substr",
+                    "ceiling": "ceil", "getdate": "datetime", "now": "datetime"}
+
+_TOKEN_RE = re.compile(r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\]|\s+|[A-Za-z_][\w$]*|\d+(?:\.\d+)?|.""")
+_ERROR_RES = [
+    ("ambiguous_column", re.compile(r"ambiguous column name: (?:(\w+)\.)?(\w+)", re.IGNORECASE)),
+    ("missing_column", re.compile(r"no such column: (?:(\w+)\.)?(\w+)", re.IGNORECASE)),
+    ("missing_function", re.compile(r"no such function: (\w+)", re.IGNORECASE)),
+    ("missing_table", re.compile(r"no such table: (?:main\.)?(.+)$", re.IGNORECASE)),
+]
+_CLAUSE_END = {"where", "group", "order", "limit", "having", "union", "except", "intersect", "window"}
+_NOT_ALIAS = _CLAUSE_END | {"join", "inner", "left", "right", "full", "cross", "outer", "natural",
+                            "on", "using", "as", "select", "from"}
+
+_PREFERRED = {t.lower() for t in SCHEMA_TABLES}
+
+_stats_lock = threading.Lock()
+_stats = {"errors": 0, "fixed": 0, "by_rule": {}}
+_catalog = {"version": None}
+
+
+def set_sql_repair(enabled: bool):
+    """Turn local SQL repair on/off (off = every SQL error goes to the LLM)."""
+    global SQL_REPAIR_ENABLED
+    SQL_REPAIR_ENABLED = enabled
+
+
+def repair_stats():
+    """{errors, fixed, local_fix_rate, by_rule} since the process started."""
+    with _stats_lock:
+        return {
+            "errors": _stats["errors"],
+            "fixed": _stats["fixed"],
+            "local_fix_rate": round(_stats["fixed"] / _stats["errors"], 3) if _stats["errors"] else 0.0,
+            "by_rule": dict(_stats["by_rule"]),
+        }
+
+
+def _record(rules):
+    with _stats_lock:
+        _stats["errors"] += 1
+        if rules:
+            _stats["fixed"] += 1
+            for rule in rules:
+                _stats["by_rule"][rule] = _stats["by_rule"].get(rule, 0) + 1
+
+
+# -- catalog -----------------------------------------------------------------
+
+def _unquote(name):
+    if name[:1] in "\"`[" and len(name) > 1:
+        return name[1:-1].replace('""', '"')
+    return name
+
+
+def _load_catalog(db_path):
+    """{tables: {lower name: name}, columns: {lower table: {lower col: col}}, pks, edges}."""
+    tables, columns, pks, edges = {}, {}, {}, {}
+    with closing(sqlite3.connect(_readonly_uri(db_path), uri=True)) as conn:
+        names = [r[0] for r in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type IN ('table', 'view') AND name NOT LIKE 'sqlite_%'")]
+        for name in names:
+            quoted = '"' + name.replace('"', '""') + '"'
+            info = conn.execute(f"PRAGMA table_info({quoted})").fetchall()
+            tables[name.lower()] = name
+            columns[name.lower()] = {c[1].lower(): c[1] for c in info}
+            pks[name.lower()] = {c[1].lower() for c in info if c[5]}
+            for fk in conn.execute(f"PRAGMA foreign_key_list({quoted})").fetchall():
+                edges.setdefault(name.lower(), set()).add((fk[2].lower(), fk[3], fk[4] or fk[3]))
+    # Views carry no keys; join on <X>ID columns that are another table's primary key.
+    for t, cols in columns.items():
+        for other, keys in pks.items():
+            if other != t:
+                for key in keys & set(cols):
+                    edges.setdefault(t, set()).add((other, cols[key], columns[other][key]))
+    # Joins work both ways.
+    for t, refs in list(edges.items()):
+        for other, col, ref_col in list(refs):
+            if other in columns:
+                edges.setdefault(other, set()).add((t, ref_col, col))
+    return {"tables": tables, "columns": columns, "pks": pks, "edges": edges}
+
+
+def _get_catalog(db_path=DB_PATH):
+    version = _db_version(db_path)
+    if _catalog["version"] != version:
+        try:
+            _catalog.update(_load_catalog(db_path), version=version)
+        except sqlite3.Error as e:
+            print(f"[sql_repair] could not read the catalog: {e}")
+            _catalog.update(tables={}, columns={}, pks={}, edges={}, version=version)
+    return _catalog
+
+
+# -- query model ---------------------------------------------------------------
+
+def _is_ident(tok):
+    return bool(tok) and (tok[0].isalpha() or tok[0] == "_" or tok[0] in "\"`[")
+
+
+def _next(tokens, i):
+    """Index of the next non-whitespace token after i (len(tokens) if none)."""
+    i += 1
+    while i < len(tokens) and tokens[i].isspace():
+        i += 1
+    return i
+
+
+def _prev(tokens, i):
+    i -= 1
+    while i >= 0 and tokens[i].isspace():
+        i -= 1
+    return i
+
+
+def _table_refs(tokens):
+    """[(qualifier, lower table name, index after the ref, depth)] for FROM / JOIN items."""
+    refs, depth = [], 0
+    expect = False
+    for i, tok in enumerate(tokens):
+        low = tok.lower()
+        if tok == "(":
+            depth += 1
+        elif tok == ")":
+            depth -= 1
+        if low in ("from", "join") or (tok == "," and expect):
+            j = _next(tokens, i)
+            if j >= len(tokens) or not _is_ident(tokens[j]) or tokens[j].lower() in _NOT_ALIAS:
+                expect = False
+                continue
+            table = _unquote(tokens[j]).lower()
+            end = j + 1
+            alias = _unquote(tokens[j])
+            k = _next(tokens, j)
+            if k < len(tokens) and tokens[k].lower() == "as":
+                k = _next(tokens, k)
+            if k < len(tokens) and _is_ident(tokens[k]) and tokens[k].lower() not in _NOT_ALIAS:
+                alias, end = _unquote(tokens[k]), k + 1
+            refs.append((alias, table, end, depth))
+            expect = True
+        elif low in _CLAUSE_END or low == "on":
+            expect = False
+    return refs
+
+
+def _column_refs(tokens, name):
+    """Indexes of identifier tokens equal to name (case-insensitive), with their qualifier index or None."""
+    out = []
+    for i, tok in enumerate(tokens):
+        if not _is_ident(tok) or _unquote(tok).lower() != name.lower():
+            continue
+        p = _prev(tokens, i)
+        n = _next(tokens, i)
+        if n < len(tokens) and tokens[n] in (".", "("):
+            continue  # a qualifier or a function name
+        if p >= 0 and tokens[p].lower() == "as":
+            continue  # an output alias
+        q = _prev(tokens, p) if p >= 0 and tokens[p] == "." else None
+        out.append((i, q))
+    return out
+
+
+def _from_end(tokens, refs):
+    """Index just after the outermost FROM clause (its last JOIN ... ON included)."""
+    outer = min(depth for _, _, _, depth in refs)
+    i = max(end for _, _, end, depth in refs if depth == outer)
+    depth = 0
+    while i < len(tokens):
+        tok = tokens[i]
+        if tok == "(":
+            depth += 1
+        elif tok == ")":
+            depth -= 1
+            if depth < 0:
+                break
+        elif depth == 0 and (tok == ";" or tok.lower() in _CLAUSE_END):
+            break
+        i += 1
+    return _prev(tokens, i) + 1
+
+
+def _has_column(catalog, table, column):
+    return column.lower() in catalog["columns"].get(table, {})
+
+
+def _join_equated(tokens, owners, column):
+    """True when `a.column = b.column` conditions link every owner alias to the others."""
+    owners = {o.lower() for o in owners}
+    if len(owners) < 2:
+        return bool(owners)
+    parent = {o: o for o in owners}
+
+    def find(a):
+        while parent[a] != a:
+            a = parent[a]
+        return a
+
+    sig = [i for i, tok in enumerate(tokens) if not tok.isspace()]
+    for n in range(len(sig) - 6):
+        a, dot1, c1, eq, b, dot2, c2 = (tokens[i] for i in sig[n:n + 7])
+        if (eq == "=" and dot1 == dot2 == "." and _unquote(c1).lower() == _unquote(c2).lower() == column.lower()
+                and _unquote(a).lower() in parent and _unquote(b).lower() in parent):
+            parent[find(_unquote(a).lower())] = find(_unquote(b).lower())
+    return len({find(o) for o in owners}) == 1
+
+
+# -- rules -------------------------------------------------------------------
+
+def _fix_ambiguous(tokens, catalog, refs, qualifier, column):
+    owners = [alias for alias, table, _, _ in refs if _has_column(catalog, table, column)]
+    if not owners or not _join_equated(tokens, owners, column):
+        return None
+    changed = False
+    for i, q in _column_refs(tokens, column):
+        if q is None:
+            tokens[i] = f"{owners[0]}.{tokens[i]}"
+            changed = True
+    return tokens if changed else None
+
+
+def _join_path(catalog, start_tables, column):
+    """Shortest list of (from table, from col, to table, to col) joins reaching a table with column."""
+    queue = deque((t, []) for t in start_tables)
+    seen = set(start_tables)
+    while queue:
+        table, path = queue.popleft()
+        if path and _has_column(catalog, table, column):
+            return path
+        if len(path) >= 2:
+            continue
+        # Prefer the tables/views the SQL generator is shown.
+        edges = sorted(catalog["edges"].get(table, ()), key=lambda e: (e[0] not in _PREFERRED, e))
+        for other, col, ref_col in edges:
+            if other not in seen:
+                seen.add(other)
+                queue.append((other, path + [(table, col, other, ref_col)]))
+    return None
+
+
+def _new_alias(table, used):
+    base = re.sub(r"\W", "", table)[:1].lower() or "t"
+    alias, n = base, 2
+    while alias.lower() in used:
+        alias, n = f"{base}{n}", n + 1
+    used.add(alias.lower())
+    return alias
+
+
+def _fix_missing_column(tokens, catalog, refs, qualifier, column):
+    by_alias = {alias.lower(): (alias, table) for alias, table, _, _ in refs}
+    owners = [alias for alias, table, _, _ in refs if _has_column(catalog, table, column)]
+    occurrences = [(i, q) for i, q in _column_refs(tokens, column)
+                   if (q is None) == (qualifier is None)
+                   and (q is None or _unquote(tokens[q]).lower() == qualifier.lower())]
+    if not occurrences:
+        return None, None
+
+    # Right column, wrong table alias.
+    if qualifier is not None and owners:
+        if not _join_equated(tokens, owners, column):
+            return None, None
+        for i, q in occurrences:
+            tokens[q] = owners[0]
+        return tokens, "wrong_alias"
+
+    # Misspelled column (CategoryId vs CategoryID is fine; Category_ID is not).
+    squashed = column.lower().replace("_", "")
+    scope = [by_alias[qualifier.lower()]] if qualifier and qualifier.lower() in by_alias else by_alias.values()
+    for alias, table in scope:
+        for col in catalog["columns"].get(table, {}).values():
+            if col.lower().replace("_", "") == squashed:
+                for i, _ in occurrences:
+                    tokens[i] = col
+                return tokens, "column_name"
+
+    # Column of a table the query does not join yet.
+    start = [table for _, table, _, _ in refs]
+    path = _join_path(catalog, start, column)
+    if not path:
+        return None, None
+    insert_at = _from_end(tokens, refs)
+    used = set(by_alias) | {qualifier.lower()} if qualifier else set(by_alias)
+    alias_of = {table: alias for alias, table, _, _ in reversed(refs)}
+    # An unbound qualifier (p.ProductName with no p in FROM) names the new
+    # table, so its other p.* references resolve in the same step.
+    free = qualifier is not None and qualifier.lower() not in by_alias
+    joins = []
+    for src, src_col, dst, dst_col in path:
+        alias_of[dst] = qualifier if free and dst == path[-1][2] else _new_alias(catalog["tables"][dst], used)
+        name = catalog["tables"][dst]
+        quoted = name if re.fullmatch(r"\w+", name) else f'"{name}"'
+        joins.append(f" JOIN {quoted} {alias_of[dst]} ON {alias_of[src]}.{src_col} = {alias_of[dst]}.{dst_col}")
+    target = alias_of[path[-1][2]]
+    for i, q in occurrences:
+        if q is not None:
+            tokens[q] = target
+        else:
+            tokens[i] = f"{target}.{tokens[i]}"
+    tokens.insert(insert_at, "".join(joins))
+    return tokens, "join_insertion"
+
+
+def _fix_function(tokens, name):
+    low = name.lower()
+    changed = False
+    i = 0
+    while i < len(tokens):
+        n = _next(tokens, i)
+        if tokens[i].lower() == low and n < len(tokens) and tokens[n] == "(":
+            p = _prev(tokens, i)
+            if p >= 0 and tokens[p] == ".":
+                i += 1
+                continue
+            if low in DATE_PART_FUNCTIONS:
+                # YEAR(x) -> CAST(strftime('%Y', x) AS INTEGER)
+                depth, j = 0, n
+                while j < len(tokens):
+                    depth += tokens[j] == "("
+                    depth -= tokens[j] == ")"
+                    if depth == 0:
+                        break
+                    j += 1
+                if j >= len(tokens):
+                    return None
+                tokens[i:j + 1] = ["CAST(strftime('" + DATE_PART_FUNCTIONS[low] + "', "
+                                   + "".join(tokens[n + 1:j]) + ") AS INTEGER)"]
+            elif low in ("getdate", "now"):
+                tokens[i] = "datetime"
+                tokens.insert(n + 1, "'now'")
+            else:
+                tokens[i] = FUNCTION_RENAMES[low]
+            changed = True
+        i += 1
+    return tokens if changed else None
+
+
+def _fix_table(tokens, catalog, name):
+    squashed = re.sub(r"[\s_]", "", _unquote(name.strip())).lower()
+    matches = [t for t in catalog["tables"].values() if re.sub(r"[\s_]", "", t).lower() == squashed]
+    if len(matches) != 1:
+        return None
+    target = matches[0] if re.fullmatch(r"\w+", matches[0]) else f'"{matches[0]}"'
+    changed = False
+    for i, tok in enumerate(tokens):
+        if _is_ident(tok) and _unquote(tok).lower() == _unquote(name.strip()).lower():
+            p = _prev(tokens, i)
+            if p >= 0 and tokens[p].lower() in ("from", "join", ","):
+                tokens[i] = target
+                changed = True
+    return tokens if changed else None
+
+
+def repair_sql(sql, error, db_path=DB_PATH):
+    """(fixed SQL, rule name) for a mechanical SQLite error, or None."""
+    for kind, pattern in _ERROR_RES:
+        m = pattern.search(error or "")
+        if m:
+            break
+    else:
+        return None
+    tokens = _TOKEN_RE.findall(sql)
+    catalog = _get_catalog(db_path)
+
+    if kind == "missing_function":
+        if m.group(1).lower() not in DATE_PART_FUNCTIONS and m.group(1).lower() not in FUNCTION_RENAMES:
+            return None
+        fixed, rule = _fix_function(tokens, m.group(1)), "function_rewrite"
+    elif kind == "missing_table":
+        fixed, rule = _fix_table(tokens, catalog, m.group(1)), "table_name"
+    else:
+        refs = _table_refs(tokens)
+        if not refs:
+            return None
+        if kind == "ambiguous_column":
+            fixed, rule = _fix_ambiguous(tokens, catalog, refs, m.group(1), m.group(2)), "alias_prefix"
+        else:
+            fixed, rule = _fix_missing_column(tokens, catalog, refs, m.group(1), m.group(2))
+    if fixed is None:
+        return None
+    fixed_sql = "".join(fixed)
+    return (fixed_sql, rule) if fixed_sql != sql else None
+
+
+def run_with_repair(sql, error):
+    """
+    Repair and re-execute a failed query locally. Returns (sql, result) for
+    the first rewrite that runs, or None when the LLM has to repair it.
+    """
+    if not SQL_REPAIR_ENABLED:
+        return None
+    rules = []
+    with span("sql_repair", "sql") as attrs:
+        for _ in range(MAX_REPAIR_STEPS):
+            repaired = repair_sql(sql, error)
+            if repaired is None:
+                break
+            sql, rule = repaired
+            rules.append(rule)
+            print(f"[sql_repair] {rule}: {sql}")
+            result, error = execute_query(sql)
+            if not error:
+                attrs["rules"] = rules
+                _record(rules)
+                return sql, result
+        attrs["rules"] = rules
+        attrs["failed"] = True
+        _record(None)
+        return None
@@ -0,0 +1,374 @@
+"""
+Deterministic SQL for known KPI question shapes.
+
+Most questions are one of a handful of shapes (AOV, revenue for a category
+and date range, top-N products by revenue, gross margin by customer, top
+category by quantity). For those, match_template() fills a parameterized
+query from the question's period and category (the planner's date range
+for marketing-calendar periods) instead of asking the LLM.
+
+A template is only used when it accounts for the whole question: the
+matched shape, period, category, top-N and known restatements of the KPI
+definitions are removed, and anything left that could change the answer
+(another year or date, a comparison, a count or average, a customer /
+product / country / other dimension word, a name found in the database, a
+quoted string) sends the question to the LLM. The SQL generator is also the
+fallback when the parameters cannot be resolved unambiguously, or when a
+template query failed and the repair loop runs.
+
+The queries follow the GenerateSQL examples, so the rollup router in
+agent.tools.rollups can serve most of them.
+"""
+import calendar
+import re
+import threading
+from contextlib import closing
+
+from agent.tools.sqlite_tool import DB_PATH, _db_version, get_pool
+
+SQL_TEMPLATES_ENABLED = True
+
+# Per the KPI docs / README assumption: CostOfGoods ~= 70% of UnitPrice.
+COST_OF_GOODS_RATIO = 0.7
+
+REVENUE = "oi.UnitPrice * oi.Quantity * (1 - COALESCE(oi.Discount, 0))"
+
+# Questions that ask for more than a template expresses go to the LLM.
+_DISQUALIFIERS = re.compile(
+    r"\b(per (month|week|day|year)|monthly|by (month|country|year|employee|supplier)|compar|"
+    r"difference|growth|ratio|percent|share|excluding|except|without|versus|vs\.?|median|"
+    r"second|lowest|least|bottom|each|per (category|customer|product|order|employee))\b")
+# Scalar templates (AOV, revenue) do not apply to "which category had the
+# highest revenue" style questions.
+_RANKING = re.compile(r"\b(which|who|top|highest|most|best|rank|list|by (customer|product|category))\b")
+_ISO_DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2}")
+_MONTHS = {name.lower(): i for i, name in enumerate(calendar.month_name) if name}
+_MONTH_RE = re.compile(r"\b(?:(?:in|during|for) )?(" + "|".join(_MONTHS) + r")(?:,)? (19\d{2}|20\d{2})\b")
+_YEAR_RE = re.compile(r"\b(?:(?:in|during|for|of) )?(?:the year )?(19\d{2}|20\d{2})\b(?!-\d)")
+_ISO_RANGE_RE = re.compile(r"\b(?:(?:between|from) )?(\d{4}-\d{2}-\d{2}) (?:and|to|through|-) (\d{4}-\d{2}-\d{2})\b")
+# A marketing-calendar period: a quoted name with a year, resolved by the planner.
+_CAMPAIGN_RE = re.compile(r"\b(?:(?:during|in|for) )?'[^']*\b(?:19|20)\d{2}\b[^']*'(?: dates)?"
+                          r"|\bas defined in the marketing calendar\b")
+_CATEGORY_ID_RE = re.compile(r"categoryid\s*=\s*(\d+)", re.IGNORECASE)
+_TOP_N_RE = re.compile(r"\btop[ -](\d+)\b")
+
+# Restatements of definitions the templates already implement.
+_FILLER_RE = re.compile(
+    r"\busing the [\w ]+? definition from the kpi docs,?|\bper the kpi definition of [\w ]+?,"
+    r"|\baccording to the kpi (?:docs|definitions?),?|\ball[- ]time\b"
+    r"|\brevenue uses order details: ?sum\(unitprice ?\* ?quantity ?\* ?\(1 ?- ?discount\)\)\.?")
+_COST_RE = re.compile(r"\bassume costofgoods is approximated by (\d+)% of unitprice(?: if not available)?\.?")
+# Left over after the slots are consumed, any of these could change the answer.
+_UNCONSUMED = re.compile(
+    r"\b(?:19|20)\d{2}\b|'[^']*'|\"[^\"]*\"|[<>=]|\b(?:above|below|over|under|more than|less than|"
+    r"greater|fewer|at least|at most|exceed\w*|between|after|before|since|until|how many|number of|"
+    r"count|average|mean|avg|per|only|customers?|clients?|compan(?:y|ies)|products?|suppliers?|"
+    r"vendors?|employees?|shippers?|orders?|countr(?:y|ies)|cit(?:y|ies)|regions?|territor(?:y|ies)|"
+    r"ship\w*|discontinued|categor(?:y|ies)|quarter|q[1-4]|season|summer|winter|spring|autumn|"
+    r"week|month|last|this|previous|recent)\b")
+# Planner filters may only name the category (or say there is none).
+_EMPTY_FILTER_WORDS = {"none", "null", "n", "a", "no", "filter", "filters", "category", "categories",
+                       "categoryname", "categoryid", "name", "all"}
+# Database values that name an entity a template cannot filter on.
+_ENTITY_COLUMNS = [
+    ("Products", "ProductName"), ("Customers", "CustomerID"), ("Customers", "CompanyName"),
+    ("Customers", "Country"), ("Customers", "City"), ("Orders", "ShipCountry"), ("Orders", "ShipCity"),
+    ("Suppliers", "CompanyName"), ("Employees", "LastName"), ("Shippers", "CompanyName"),
+]
+
+_stats_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "by_template": {}}
+_categories = {"version": None, "by_name": {}}
+_entities = {"version": None, "pattern": None}
+
+
+def set_sql_templates(enabled: bool):
+    """Turn the template fast path on/off (off = always use the LLM generator)."""
+    global SQL_TEMPLATES_ENABLED
+    SQL_TEMPLATES_ENABLED = enabled
+
+
+def template_stats():
+    """{hits, misses, hit_rate, by_template} since the process started."""
+    with _stats_lock:
+        total = _stats["hits"] + _stats["misses"]
+        return {
+            "hits": _stats["hits"],
+            "misses": _stats["misses"],
+            "hit_rate": round(_stats["hits"] / total, 3) if total else 0.0,
+            "by_template": dict(_stats["by_template"]),
+        }
+
+
+def _record(name):
+    with _stats_lock:
+        if name is None:
+            _stats["misses"] += 1
+        else:
+            _stats["hits"] += 1
+            _stats["by_template"][name] = _stats["by_template"].get(name, 0) + 1
+
+
+def _category_names():
+    """{lowercased CategoryName: CategoryID}, re-read when the DB file changes."""
+    version = _db_version(DB_PATH)
+    if _categories["version"] != version:
+        by_name = {}
+        try:
+            with get_pool().connection() as conn, \
+                    closing(conn.execute("SELECT CategoryID, CategoryName FROM Categories")) as cur:
+                by_name = {str(name).lower(): cid for cid, name in cur.fetchall() if name}
+        except Exception as e:
+            print(f"[sql_templates] could not load categories: {e}")
+        _categories.update(version=version, by_name=by_name)
+    return _categories["by_name"]
+
+
+def _entity_pattern():
+    """Regex matching any _ENTITY_COLUMNS value, re-read when the DB file changes."""
+    version = _db_version(DB_PATH)
+    if _entities["version"] != version:
+        names = set()
+        try:
+            with get_pool().connection() as conn:
+                for table, column in _ENTITY_COLUMNS:
+                    try:
+                        with closing(conn.execute(f"SELECT DISTINCT {column} FROM {table}")) as cur:
+                            names.update(str(v).lower() for (v,) in cur.fetchall() if v and str(v).strip())
+                    except Exception:
+                        continue  # not every Northwind copy has every table
+        except Exception as e:
+            print(f"[sql_templates] could not load entity names: {e}")
+        names = sorted(names, key=len, reverse=True)
+        pattern = re.compile(r"(?<!\w)(?:" + "|".join(map(re.escape, names)) + r")(?!\w)") if names else None
+        _entities.update(version=version, pattern=pattern)
+    return _entities["pattern"]
+
+
+def parse_plan(plan):
+    """{'date_range': ..., 'filters': ..., 'logic': ...} from planner_node's plan string."""
+    fields = {}
+    for line in (plan or "").splitlines():
+        key, _, value = line.partition(":")
+        fields[key.strip().lower().replace(" ", "_")] = value.strip()
+    return fields
+
+
+def _consume(pattern, text):
+    return pattern.sub(" ", text)
+
+
+def _date_range(question, plan_fields):
+    """
+    ((start, end) or () for all-time, question with the period removed), or
+    None when the period cannot be resolved without the LLM (e.g. an
+    unresolved campaign name, or more than one period).
+    """
+    if _CAMPAIGN_RE.search(question) or "campaign" in question:
+        dates = _ISO_DATE_RE.findall(plan_fields.get("date_range", ""))
+        if len(dates) < 2:
+            return None
+        return (dates[0], dates[1]), _consume(_CAMPAIGN_RE, question)
+    ranges = set(_ISO_RANGE_RE.findall(question))
+    if ranges:
+        if len(ranges) > 1:
+            return None
+        return ranges.pop(), _consume(_ISO_RANGE_RE, question)
+    months = set(_MONTH_RE.findall(question))
+    if months:
+        if len(months) > 1:
+            return None
+        name, year = months.pop()
+        month = _MONTHS[name]
+        last = calendar.monthrange(int(year), month)[1]
+        return (f"{year}-{month:02d}-01", f"{year}-{month:02d}-{last:02d}"), _consume(_MONTH_RE, question)
+    years = set(_YEAR_RE.findall(question))
+    if years:
+        if len(years) > 1:
+            return None
+        year = years.pop()
+        return (f"{year}-01-01", f"{year}-12-31"), _consume(_YEAR_RE, question)
+    return (), question
+
+
+def _filter_category(filters):
+    """CategoryID named by the planner's filters, None if none, False for anything else."""
+    text = filters.lower()
+    found = {int(cid) for cid in _CATEGORY_ID_RE.findall(text)}
+    text = _CATEGORY_ID_RE.sub(" ", text)
+    for name, cid in _category_names().items():
+        pattern = re.compile(rf"\b{re.escape(name)}\b")
+        if pattern.search(text):
+            found.add(cid)
+            text = pattern.sub(" ", text)
+    if set(re.findall(r"\w+", text)) - _EMPTY_FILTER_WORDS or len(found) > 1:
+        return False
+    return found.pop() if found else None
+
+
+def _category_id(question, plan_fields):
+    """
+    (CategoryID the question is restricted to or None, question with the
+    category removed), or None when the category is ambiguous or the planner
+    filters ask for something else.
+    """
+    planned = _filter_category(plan_fields.get("filters", ""))
+    if planned is False:
+        return None
+    found = {}
+    for name, cid in _category_names().items():
+        pattern = re.compile(rf"'?\b{re.escape(name)}\b'?")
+        if pattern.search(question):
+            found[cid] = pattern
+    if len(found) > 1:
+        return None
+    if found:
+        cid, pattern = found.popitem()
+        if planned not in (None, cid):
+            return None
+        return cid, re.sub(r"\bcategor(?:y|ies)\b", " ", _consume(pattern, question))
+    if "categor" in question:
+        return None
+    return planned, question
+
+
+def _unconsumed(rest):
+    """First part of rest that the template would ignore, or None."""
+    m = _UNCONSUMED.search(rest)
+    if m:
+        return m.group(0)
+    entities = _entity_pattern()
+    m = entities.search(rest) if entities else None
+    return m.group(0) if m else None
+
+
+def _where(dates, category_id=None):
+    clauses = []
+    if category_id is not None:
+        clauses.append(f"p.CategoryID = {int(category_id)}")
+    if dates:
+        clauses.append(f"date(o.OrderDate) BETWEEN '{dates[0]}' AND '{dates[1]}'")
+    return f" WHERE {' AND '.join(clauses)}" if clauses else ""
+
+
+def _aov(question, dates, category_id):
+    join = " JOIN products p ON oi.ProductID = p.ProductID" if category_id is not None else ""
+    return (f"SELECT ROUND(SUM({REVENUE}) / COUNT(DISTINCT o.OrderID), 2) as aov "
+            f"FROM orders o JOIN order_items oi ON o.OrderID = oi.OrderID{join}"
+            f"{_where(dates, category_id)};")
+
+
+def _revenue(question, dates, category_id):
+    join = " JOIN products p ON oi.ProductID = p.ProductID" if category_id is not None else ""
+    return (f"SELECT ROUND(SUM({REVENUE}), 2) as revenue "
+            f"FROM order_items oi JOIN orders o ON oi.OrderID = o.OrderID{join}"
+            f"{_where(dates, category_id)};")
+
+
+def _top_products(question, dates, category_id):
+    m = _TOP_N_RE.search(question)
+    if not m and re.search(r"\bproducts\b", question):
+        return None  # "top products" without a count is ambiguous
+    limit = int(m.group(1)) if m else 1
+    join = " JOIN orders o ON oi.OrderID = o.OrderID" if dates else ""
+    return (f"SELECT p.ProductName as product, ROUND(SUM({REVENUE}), 2) as revenue "
+            f"FROM order_items oi JOIN products p ON oi.ProductID = p.ProductID{join}"
+            f"{_where(dates, category_id)} "
+            f"GROUP BY p.ProductName ORDER BY revenue DESC LIMIT {limit};")
+
+
+def _customer_margin(question, dates, category_id):
+    m = _TOP_N_RE.search(question)
+    if not m and re.search(r"\bcustomers\b", question):
+        return None
+    limit = int(m.group(1)) if m else 1
+    join = " JOIN products p ON oi.ProductID = p.ProductID" if category_id is not None else ""
+    margin = (f"(oi.UnitPrice - {COST_OF_GOODS_RATIO} * oi.UnitPrice) * oi.Quantity "
+              "* (1 - COALESCE(oi.Discount, 0))")
+    return (f"SELECT c.CompanyName as customer, ROUND(SUM({margin}), 2) as margin "
+            "FROM orders o JOIN order_items oi ON o.OrderID = oi.OrderID "
+            f"JOIN customers c ON o.CustomerID = c.CustomerID{join}"
+            f"{_where(dates, category_id)} "
+            f"GROUP BY c.CustomerID ORDER BY margin DESC LIMIT {limit};")
+
+
+def _top_category_quantity(question, dates, category_id):
+    return ("SELECT cat.CategoryName as category, SUM(oi.Quantity) as quantity "
+            "FROM orders o JOIN order_items oi ON o.OrderID = oi.OrderID "
+            "JOIN products p ON oi.ProductID = p.ProductID "
+            "JOIN Categories cat ON p.CategoryID = cat.CategoryID"
+            f"{_where(dates)} "
+            "GROUP BY cat.CategoryName ORDER BY quantity DESC LIMIT 1;")
+
+
+# (name, question pattern, words the shape accounts for, builder, uses a
+# category filter, scalar). First match wins, so the more specific shapes
+# come first. Builders return None when the question is too ambiguous to
+# fill the template.
+TEMPLATES = [
+    ("top_category_by_quantity",
+     re.compile(r"\bcategor(y|ies)\b.*\b(highest|most|top)\b.*\bquantity\b"
+                r"|\b(highest|most|top)\b.*\bquantity\b.*\bcategor"),
+     re.compile(r"\b(?:product )?categor(?:y|ies)\b|\b(?:total )?quantity(?: sold)?\b"),
+     _top_category_quantity, False, False),
+    ("customer_gross_margin",
+     re.compile(r"\bgross margin\b.*\bcustomers?\b|\bcustomers?\b.*\bgross margin\b"),
+     re.compile(r"\bcustomers?\b|\bgross margin\b"), _customer_margin, True, False),
+    ("top_products_by_revenue",
+     re.compile(r"\btop\b.*\bproducts?\b.*\brevenue\b"),
+     re.compile(r"\bproducts?\b|\b(?:total )?revenue\b"), _top_products, True, False),
+    ("aov",
+     re.compile(r"\baverage order value\b|\baov\b"),
+     re.compile(r"\baverage order value\b|\baov\b"), _aov, True, True),
+    ("revenue",
+     re.compile(r"\b(total )?revenue\b"),
+     re.compile(r"\b(?:total )?revenue\b"), _revenue, True, True),
+]
+
+
+def _fill(question, plan_fields, name, words, build, filterable):
+    """SQL for one template, or None unless its slots account for the whole question."""
+    rest = _consume(_FILLER_RE, question)
+    cost = _COST_RE.search(rest)
+    if cost:
+        if name != "customer_gross_margin" or int(cost.group(1)) != round(COST_OF_GOODS_RATIO * 100):
+            return None
+        rest = _consume(_COST_RE, rest)
+    period = _date_range(rest, plan_fields)
+    if period is None:
+        return None
+    dates, rest = period
+    category_id = None
+    if filterable:
+        category = _category_id(rest, plan_fields)
+        if category is None:
+            return None
+        category_id, rest = category
+    rest = _consume(_TOP_N_RE, _consume(words, rest))
+    left = _unconsumed(rest)
+    if left is not None:
+        print(f"[sql_templates] {name}: not using the template, question also says {left!r}")
+        return None
+    return build(question, dates, category_id)
+
+
+def match_template(question, plan=""):
+    """(template name, SQL) for a known question shape, or None (use the LLM)."""
+    if not SQL_TEMPLATES_ENABLED:
+        return None
+    q = (question or "").lower()
+    # Ignore the answer-format instruction ("Return list[{product:str, ...}]").
+    q = re.split(r"\breturn (a|an|the|list|\{)", q)[0]
+    match = None
+    if not _DISQUALIFIERS.search(q):
+        plan_fields = parse_plan(plan)
+        for name, pattern, words, build, filterable, scalar in TEMPLATES:
+            if not pattern.search(q):
+                continue
+            if scalar and _RANKING.search(q):
+                break
+            sql = _fill(q, plan_fields, name, words, build, filterable)
+            match = (name, sql) if sql else None
+            break
+    _record(match[0] if match else None)
+    return match
@@ -1,41 +1,566 @@
+import atexit
+import os
+import re
 import sqlite3
-import pandas as pd
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+
+from agent.tracing import span
 
 DB_PATH = "data/northwind.sqlite"
 
-def get_schema_string():
-    """Returns a compact schema string for the LLM."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # We only care about our views/tables
-    tables = ['orders', 'order_items', 'products', 'customers']
-    schema_str = ""
-    
-    for t in tables:
-        cursor.execute(f"PRAGMA table_info({t})")
-        columns = cursor.fetchall()
-        col_names = [c[1] for c in columns]
-        schema_str += f"Table: {t}\nColumns: {', '.join(col_names)}\n\n"
-        
-    conn.close()
-    return schema_str
-
-def execute_query(sql: str):
-    """Executes SQL and returns results + column names or error."""
+# Read-only connection tuning. The agent never writes to the DB, so we can
+# open it with mode=ro and give each connection a large page cache + mmap.
+# Set DB_IMMUTABLE = True only when the file is guaranteed not to change while
+# the process runs (SQLite then skips all locking and change detection).
+DB_IMMUTABLE = False
+DB_PRAGMAS = {
+    "mmap_size": 256 * 1024 * 1024,  # bytes
+    "cache_size": -64 * 1024,        # negative = KiB (64 MiB)
+    "temp_store": "MEMORY",
+    "query_only": 1,
+}
+POOL_MAX_CONNECTIONS = 8
+
+# Per-query guard rails enforced by SQLite itself (see _guard_connection).
+SQL_TIMEOUT_S = 10.0
+PROGRESS_HANDLER_OPS = 10_000  # VM instructions between deadline checks
+# EXPLAIN QUERY PLAN pre-check for nested full scans (cartesian products):
+# "off", "warn" (log + trace attribute) or "block" (return an error).
+SQL_PLAN_CHECK = "warn"
+
+UNSAFE_QUERY_ERROR = "Error: Unsafe query detected: only read-only SELECT statements are allowed"
+TIMEOUT_ERROR = "Error: Query timed out"
+
+# Result cache bounds (entries and approximate bytes of cached result text).
+SQL_CACHE_MAX_ENTRIES = 2048
+SQL_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Result fetching / rendering. Rows are streamed from the cursor in chunks;
+# at most SQL_MAX_ROWS are kept (the rest are only counted and summarised),
+# and the rendered table is trimmed to fit SQL_RESULT_TOKEN_BUDGET.
+SQL_FETCH_CHUNK = 500
+SQL_MAX_ROWS = 1000
+SQL_RESULT_TOKEN_BUDGET = 1500
+CHARS_PER_TOKEN = 4  # rough estimate, good enough for budgeting
+
+
+def _readonly_uri(db_path, immutable=False):
+    """Build a `file:` URI that opens db_path read-only."""
+    uri = Path(db_path).resolve().as_uri() + "?mode=ro"
+    if immutable:
+        uri += "&immutable=1"
+    return uri
+
+
+_READ_ACTIONS = {
+    sqlite3.SQLITE_SELECT,
+    sqlite3.SQLITE_READ,
+    sqlite3.SQLITE_FUNCTION,
+    getattr(sqlite3, "SQLITE_RECURSIVE", 33),
+}
+_FORBIDDEN_FUNCTIONS = {"load_extension", "readfile", "writefile"}
+_guard_state = threading.local()
+
+
+def _read_only_authorizer(action, arg1, arg2, db_name, source):
+    """Allow only what a plain SELECT needs; deny writes, ATTACH, PRAGMA, DDL, ..."""
+    if action in _READ_ACTIONS and not (
+            action == sqlite3.SQLITE_FUNCTION and (arg2 or "").lower() in _FORBIDDEN_FUNCTIONS):
+        return sqlite3.SQLITE_OK
+    _guard_state.denied = (action, arg1 or arg2)
+    return sqlite3.SQLITE_DENY
+
+
+def _progress_check():
+    # A non-zero return makes SQLite abort the running statement ("interrupted").
+    deadline = getattr(_guard_state, "deadline", None)
+    return 1 if deadline is not None and time.monotonic() > deadline else 0
+
+
+def _guard_connection(conn):
+    """Install the read-only authorizer and the per-query timeout hook."""
+    conn.set_authorizer(_read_only_authorizer)
+    conn.set_progress_handler(_progress_check, PROGRESS_HANDLER_OPS)
+
+
+@contextmanager
+def _deadline(timeout_s):
+    """Abort queries on this thread that run longer than timeout_s."""
+    _guard_state.deadline = time.monotonic() + timeout_s if timeout_s else None
+    try:
+        yield
+    finally:
+        _guard_state.deadline = None
+
+
+class ConnectionPool:
+    """
+    Bounded pool of read-only SQLite connections shared by all threads.
+
+    At most `max_connections` connections are ever open. A checkout reuses an
+    idle connection, opens a new one while under the limit, and otherwise
+    blocks until another thread returns one. Connections are not tied to a
+    thread, so threads that exit leave nothing behind. Use
+    `pool.connection()` as a context manager and `pool.close()` on shutdown.
+    """
+
+    def __init__(self, db_path=DB_PATH, max_connections=POOL_MAX_CONNECTIONS,
+                 immutable=DB_IMMUTABLE, pragmas=None):
+        self.db_path = db_path
+        self.immutable = immutable
+        self.pragmas = dict(DB_PRAGMAS if pragmas is None else pragmas)
+        self.max_connections = max_connections
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._idle = []
+        self._all = []
+        self._closed = False
+        self._stats = {"hits": 0, "opens": 0, "waits": 0, "wait_time_s": 0.0}
+
+    def _open(self):
+        conn = sqlite3.connect(
+            _readonly_uri(self.db_path, self.immutable),
+            uri=True,
+            check_same_thread=False,  # handed between threads, one at a time
+        )
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        _guard_connection(conn)
+        return conn
+
+    def _checkout(self):
+        with self._lock:
+            start = None
+            while True:
+                if self._closed:
+                    raise RuntimeError("Connection pool is closed.")
+                if self._idle:
+                    self._stats["hits"] += 1
+                    conn = self._idle.pop()
+                    break
+                if len(self._all) < self.max_connections:
+                    self._all.append(None)  # reserve the slot while opening
+                    conn = None
+                    break
+                if start is None:
+                    start = time.perf_counter()
+                    self._stats["waits"] += 1
+                self._available.wait()
+            if start is not None:
+                self._stats["wait_time_s"] += time.perf_counter() - start
+        if conn is not None:
+            return conn
+        try:
+            conn = self._open()
+        except Exception:
+            with self._lock:
+                self._all.remove(None)
+                self._available.notify()
+            raise
+        with self._lock:
+            self._all[self._all.index(None)] = conn
+            self._stats["opens"] += 1
+        return conn
+
+    def _checkin(self, conn):
+        with self._lock:
+            if self._closed:
+                conn.close()
+                return
+            self._idle.append(conn)
+            self._available.notify()
+
+    @contextmanager
+    def connection(self):
+        """Yield a pooled connection, blocking while all of them are in use."""
+        conn = self._checkout()
+        try:
+            yield conn
+        finally:
+            self._checkin(conn)
+
+    def stats(self):
+        """Snapshot of pool counters (hits, opens, waits, wait_time_s, open)."""
+        with self._lock:
+            out = dict(self._stats)
+            out["open"] = sum(c is not None for c in self._all)
+        return out
+
+    def close(self):
+        """Close idle connections now and busy ones when they are returned."""
+        with self._lock:
+            self._closed = True
+            idle, self._idle, self._all = self._idle, [], []
+            self._available.notify_all()
+        for conn in idle:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the shared pool for DB_PATH, creating it on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DB_PATH)
+    return _pool
+
+
+def close_pool():
+    """Close the shared pool; the next query transparently opens a new one."""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.close()
+
+
+def pool_stats():
+    """Counters of the shared pool (empty dict if it was never used)."""
+    return _pool.stats() if _pool is not None else {}
+
+
+atexit.register(close_pool)
+
+
+# String literals / quoted identifiers are kept verbatim, comments count as
+# whitespace, everything else is case- and whitespace-insensitive in SQLite.
+# Operators are single-character tokens so that "5 - -3" and "5--3" (a
+# comment) never collapse to the same text.
+_SQL_TOKEN_RE = re.compile(r"""--[^\n]*|/\*.*?(?:\*/|$)|'(?:[^']|'')*(?:'|$)|"(?:[^"]|"")*(?:"|$)"""
+                           r"""|`[^`]*`|\[[^\]]*\]|\s+|[^\s'"`\[(),;=<>!+\-*/%|&~]+|.""", re.S)
+_SQL_PUNCT = set("(),;=<>!+-*/%|&~")
+
+
+def canonicalize_sql(sql: str):
+    """
+    Canonical form of a query for cache keys: comments dropped, whitespace
+    collapsed (and dropped next to punctuation, except between two
+    operators), keywords and identifiers lowercased outside quotes, trailing
+    semicolons dropped.
+    """
+    tokens = []
+    for tok in _SQL_TOKEN_RE.findall(sql):
+        if tok.isspace() or tok.startswith(("--", "/*")):
+            if tokens and tokens[-1] != " ":
+                tokens.append(" ")
+        elif tok[0] in "'\"`[":
+            tokens.append(tok)
+        else:
+            tokens.append(tok.lower())
+    while tokens and tokens[-1] in (" ", ";"):
+        tokens.pop()
+
+    out = []
+    for i, tok in enumerate(tokens):
+        if tok == " ":
+            prev = out[-1] if out else ""
+            nxt = tokens[i + 1]
+            if not prev or (prev[-1] in _SQL_PUNCT) != (nxt[0] in _SQL_PUNCT) \
+                    or prev in "(),;" or nxt in "(),;":
+                continue
+        out.append(tok)
+    return "".join(out)
+
+
+def _db_version(db_path):
+    try:
+        st = os.stat(db_path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+class SQLResultCache:
+    """
+    Bounded-memory LRU of query results, keyed by canonical SQL.
+
+    The cache is scoped to one version (mtime, size) of the database file and
+    is emptied as soon as the file changes.
+    """
+
+    def __init__(self, max_entries=SQL_CACHE_MAX_ENTRIES, max_bytes=SQL_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._version = None
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def _check_version(self, version):
+        if version != self._version:
+            if self._data:
+                self._stats["invalidations"] += 1
+            self._data.clear()
+            self._bytes = 0
+            self._version = version
+
+    def get(self, key, version):
+        with self._lock:
+            self._check_version(version)
+            entry = self._data.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._data.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry[0]
+
+    def put(self, key, version, value):
+        size = len(key) + sum(len(v) for v in value if isinstance(v, str))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._check_version(version)
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._data[key] = (value, size)
+            self._bytes += size
+            while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted) = self._data.popitem(last=False)
+                self._bytes -= evicted
+                self._stats["evictions"] += 1
+
+    def stats(self):
+        with self._lock:
+            out = dict(self._stats)
+            out["entries"] = len(self._data)
+            out["bytes"] = self._bytes
+        lookups = out["hits"] + out["misses"]
+        out["hit_rate"] = round(out["hits"] / lookups, 3) if lookups else 0.0
+        return out
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+
+_result_cache = SQLResultCache()
+
+
+def sql_cache_stats():
+    """Hit/miss counters and size of the query result cache."""
+    return _result_cache.stats()
+
+
+def clear_sql_cache():
+    _result_cache.clear()
+
+
+_SCAN_SUFFIX_RE = re.compile(r" (?:USING |VIRTUAL TABLE |\()")
+
+
+def _scan_target(detail):
+    """Table (or alias) a plan row scans: "SCAN Order Details USING ..." -> "Order Details"."""
+    target = detail.split(" ", 1)[1]
+    if target.startswith("TABLE "):  # SQLite < 3.36: "SCAN TABLE x [AS y]"
+        target = target[6:]
+    target = _SCAN_SUFFIX_RE.split(target, 1)[0]
+    if " AS " in target:
+        target = target.rsplit(" AS ", 1)[1]
+    return f'"{target}"' if " " in target else target
+
+
+def _cartesian_scans(plan_rows):
+    """Tables full-scanned as nested loops under the same plan node."""
+    scans = {}
+    for _id, parent, _unused, detail in plan_rows:
+        if detail.startswith("SCAN ") and not detail.startswith(("SCAN CONSTANT", "SCAN SUBQUERY", "SCAN (")):
+            scans.setdefault(parent, []).append(_scan_target(detail))
+    return [tables for tables in scans.values() if len(tables) > 1]
+
+
+def _is_denied(error):
+    """Authorizer denials, plus SQLITE_AUTH errors raised without a callback (e.g. VACUUM)."""
+    return (getattr(_guard_state, "denied", None) is not None
+            or getattr(error, "sqlite_errorcode", None) == sqlite3.SQLITE_AUTH
+            or str(error) in ("not authorized", "authorization denied"))
+
+
+def _check_query(conn, sql, attrs):
+    """
+    Prepare-only validation via EXPLAIN QUERY PLAN: compile errors and
+    authorizer denials surface here, before any row is read. Optionally flags
+    cartesian plans. Returns an error string or None.
+    """
+    _guard_state.denied = None
+    try:
+        plan = conn.execute("EXPLAIN QUERY PLAN " + sql).fetchall()
+    except sqlite3.Error as e:
+        return UNSAFE_QUERY_ERROR if _is_denied(e) else str(e)
+
+    if SQL_PLAN_CHECK != "off":
+        cartesian = _cartesian_scans(plan)
+        if cartesian:
+            attrs["cartesian_scan"] = cartesian
+            msg = ("Error: Query plan is a cartesian product (full scans of "
+                   + " x ".join(cartesian[0]) + "); add JOIN ... ON conditions")
+            if SQL_PLAN_CHECK == "block":
+                return msg
+            print(f"[execute_sql] warning: {msg[7:]}")
+    return None
+
+
+def _fmt(value):
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return format(value, ".15g")
+    return str(value).replace("|", "\\|").replace("\n", " ")
+
+
+def _table_row(cells):
+    return "| " + " | ".join(cells) + " |"
+
+
+class _ColumnStats:
+    """Running count/min/max/sum of the numeric values in one column."""
+
+    __slots__ = ("count", "min", "max", "sum")
+
+    def __init__(self):
+        self.count, self.min, self.max, self.sum = 0, None, None, 0.0
+
+    def add(self, value):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            self.count += 1
+            self.sum += value
+            self.min = value if self.min is None or value < self.min else self.min
+            self.max = value if self.max is None or value > self.max else self.max
+
+
+def _fetch(cursor, max_rows=SQL_MAX_ROWS, chunk=SQL_FETCH_CHUNK):
+    """
+    Stream a cursor in chunks. Returns (columns, kept_rows, total_rows,
+    stats): only the first max_rows rows are kept, but every row is counted
+    and folded into per-column numeric stats.
+    """
+    columns = [d[0] for d in cursor.description or ()]
+    stats = [_ColumnStats() for _ in columns]
+    rows, total = [], 0
+    while True:
+        batch = cursor.fetchmany(chunk)
+        if not batch:
+            break
+        total += len(batch)
+        if len(rows) < max_rows:
+            rows.extend(batch[:max_rows - len(rows)])
+        for row in batch:
+            for st, value in zip(stats, row):
+                st.add(value)
+    return columns, rows, total, stats
+
+
+def render_result(columns, rows, total, stats, token_budget=SQL_RESULT_TOKEN_BUDGET):
+    """
+    Markdown table of as many rows as fit in token_budget. When rows are left
+    out, a footer gives the total row count and numeric column stats (over
+    all rows, not just the ones shown).
+    """
+    header = [_table_row(columns), _table_row(["---"] * len(columns))]
+    body = [_table_row([_fmt(v) for v in row]) for row in rows]
+    budget = token_budget * CHARS_PER_TOKEN
+    if len(body) == total and sum(len(line) + 1 for line in header + body) <= budget:
+        return "\n".join(header + body)
+
+    footer = []
+    for name, st in zip(columns, stats):
+        if st.count:
+            footer.append(f"{name}: min={_fmt(st.min)} max={_fmt(st.max)} "
+                          f"sum={_fmt(round(st.sum, 6))} mean={_fmt(round(st.sum / st.count, 6))}")
+    used = sum(len(line) + 1 for line in header + footer) + 40  # + "showing" line
+    shown = 0
+    for line in body:
+        if shown and used + len(line) + 1 > budget:
+            break
+        used += len(line) + 1
+        shown += 1
+    return "\n".join(header + body[:shown] + [f"\n(showing {shown} of {total} rows)"] + footer)
+
+
+def _execute_on(pool, sql, attrs, timeout_s):
     try:
-        conn = sqlite3.connect(DB_PATH)
-        # Safety: Read only allowed logic (basic check)
-        if "drop" in sql.lower() or "delete" in sql.lower():
-            return None, "Error: Unsafe query detected."
-            
-        df = pd.read_sql_query(sql, conn)
-        conn.close()
-        
-        if df.empty:
+        with pool.connection() as conn:
+            error = _check_query(conn, sql, attrs)
+            if error:
+                return None, error
+            with _deadline(timeout_s):
+                cursor = conn.execute(sql)
+                try:
+                    columns, rows, total, stats = _fetch(cursor)
+                finally:
+                    cursor.close()
+
+        attrs["rows"] = total
+        if not total:
             return "No results found.", None
-            
-        return df.to_markdown(index=False), None
-        
+
+        return render_result(columns, rows, total, stats), None
+
     except Exception as e:
-        return None, str(e)
\ No newline at end of file
+        if "interrupted" in str(e):
+            return None, f"{TIMEOUT_ERROR} after {timeout_s}s"
+        if isinstance(e, sqlite3.DatabaseError) and _is_denied(e):
+            return None, UNSAFE_QUERY_ERROR
+        return None, str(e)
+
+
+def _run_query(sql: str, attrs=None, timeout_s=None, use_rollups=True):
+    attrs = {} if attrs is None else attrs
+    timeout_s = SQL_TIMEOUT_S if timeout_s is None else timeout_s
+    if use_rollups:
+        from agent.tools.rollups import route_query  # imports this module
+
+        routed = route_query(sql, _db_version(DB_PATH))
+        if routed is not None:
+            attrs["rollup"] = True
+            result, error = _execute_on(routed[1], routed[0], attrs, timeout_s)
+            if error is None or error.startswith(TIMEOUT_ERROR):
+                return result, error
+            # The rewrite is only an optimisation; the base tables decide.
+            print(f"[rollups] rollup query failed ({error}); using the base tables")
+            attrs["rollup"] = False
+    return _execute_on(get_pool(), sql, attrs, timeout_s)
+
+
+def execute_query(sql: str, use_cache: bool = True, timeout_s: float = None, use_rollups: bool = True):
+    """
+    Executes SQL and returns results + column names or error.
+
+    Safety is enforced by SQLite: pooled connections carry a read-only
+    authorizer and a progress-handler timeout (SQL_TIMEOUT_S by default).
+    Aggregate queries the daily rollups can answer are transparently run
+    against them (see agent.tools.rollups).
+    """
+    with span("execute_query", "sql") as attrs:
+        if not use_cache:
+            return _run_query(sql, attrs, timeout_s, use_rollups)
+
+        # Errors are cached too: for a fixed DB version the same SQL fails the
+        # same way, which short-circuits repeated bad SQL in the repair loop.
+        # Timeouts are not cached since they depend on load.
+        key = canonicalize_sql(sql)
+        version = _db_version(DB_PATH)
+        cached = _result_cache.get(key, version)
+        attrs["cache_hit"] = cached is not None
+        if cached is not None:
+            return cached
+
+        result = _run_query(sql, attrs, timeout_s, use_rollups)
+        if not (result[1] or "").startswith(TIMEOUT_ERROR):
+            _result_cache.put(key, version, result)
+        return result
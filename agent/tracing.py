@@ -0,0 +1,166 @@
+"""
+Per-question tracing for the LangGraph pipeline.
+
+Spans are recorded for every graph node, LLM call and SQL execution with
+wall time plus attributes (token counts, cache hits, retry number, ...).
+They are streamed to a JSONL file and to a Chrome trace-event file
+(open in chrome://tracing or Perfetto), and per-span percentiles are kept for
+the end-of-batch summary. When no tracer is active, span() is a no-op.
+"""
+import contextvars
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+_question_id = contextvars.ContextVar("trace_question_id", default=None)
+_tracer = None
+
+
+def _percentile(sorted_vals, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_vals:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100.0 * len(sorted_vals)))
+    return sorted_vals[min(rank, len(sorted_vals)) - 1]
+
+
+class Tracer:
+    """Collects spans; writes JSONL + Chrome trace events as they finish."""
+
+    def __init__(self, out_dir=None):
+        self.out_dir = out_dir
+        self._lock = threading.Lock()
+        self._t0 = time.perf_counter()
+        self._durations = {}
+        self._jsonl = None
+        self._chrome = None
+        self._first_event = True
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+            self._jsonl = open(os.path.join(out_dir, "trace.jsonl"), "w", encoding="utf-8")
+            # JSON Array Format; a missing closing bracket is tolerated by
+            # the viewers, so a crashed run still leaves a loadable trace.
+            self._chrome = open(os.path.join(out_dir, "trace.chrome.json"), "w", encoding="utf-8")
+            self._chrome.write("[\n")
+
+    def record(self, name, kind, start, end, attrs):
+        dur_ms = (end - start) * 1000.0
+        qid = _question_id.get()
+        with self._lock:
+            self._durations.setdefault(f"{kind}:{name}", []).append(dur_ms)
+            if self._jsonl is not None:
+                self._jsonl.write(json.dumps({
+                    "question_id": qid,
+                    "name": name,
+                    "kind": kind,
+                    "start_ms": round((start - self._t0) * 1000.0, 3),
+                    "dur_ms": round(dur_ms, 3),
+                    **attrs,
+                }, default=str) + "\n")
+            if self._chrome is not None:
+                event = {
+                    "name": name,
+                    "cat": kind,
+                    "ph": "X",
+                    "ts": round((start - self._t0) * 1e6, 1),
+                    "dur": round((end - start) * 1e6, 1),
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "args": {"question_id": qid, **attrs},
+                }
+                self._chrome.write(("" if self._first_event else ",\n") + json.dumps(event, default=str))
+                self._first_event = False
+
+    def summary(self):
+        """{ "kind:name": {count, total_ms, p50_ms, p95_ms, p99_ms} }"""
+        with self._lock:
+            items = {k: sorted(v) for k, v in self._durations.items()}
+        return {
+            key: {
+                "count": len(vals),
+                "total_ms": round(sum(vals), 1),
+                "p50_ms": round(_percentile(vals, 50), 1),
+                "p95_ms": round(_percentile(vals, 95), 1),
+                "p99_ms": round(_percentile(vals, 99), 1),
+            }
+            for key, vals in sorted(items.items())
+        }
+
+    def format_summary(self):
+        lines = [f"{'span':<32}{'count':>7}{'total_ms':>12}{'p50':>10}{'p95':>10}{'p99':>10}"]
+        for key, s in self.summary().items():
+            lines.append(f"{key:<32}{s['count']:>7}{s['total_ms']:>12.1f}"
+                         f"{s['p50_ms']:>10.1f}{s['p95_ms']:>10.1f}{s['p99_ms']:>10.1f}")
+        return "\n".join(lines)
+
+    def close(self):
+        with self._lock:
+            if self._jsonl is not None:
+                self._jsonl.close()
+                self._jsonl = None
+            if self._chrome is not None:
+                self._chrome.write("\n]\n")
+                self._chrome.close()
+                self._chrome = None
+
+
+def start_tracing(out_dir=None):
+    """Install a process-wide tracer (optionally writing files to out_dir)."""
+    global _tracer
+    _tracer = Tracer(out_dir)
+    return _tracer
+
+
+def stop_tracing():
+    """Close and uninstall the active tracer; returns it for summaries."""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None:
+        tracer.close()
+    return tracer
+
+
+def get_tracer():
+    return _tracer
+
+
+@contextmanager
+def trace_question(question_id):
+    """Tag every span recorded inside this block with question_id."""
+    token = _question_id.set(question_id)
+    try:
+        yield
+    finally:
+        _question_id.reset(token)
+
+
+@contextmanager
+def span(name, kind="node", **attrs):
+    """
+    Time a block. Yields a dict the block can add attributes to
+    (e.g. prompt_tokens, cache_hit); errors are recorded and re-raised.
+    """
+    tracer = _tracer
+    if tracer is None:
+        yield attrs
+        return
+    start = time.perf_counter()
+    try:
+        yield attrs
+    except Exception as e:
+        attrs["error"] = type(e).__name__
+        raise
+    finally:
+        tracer.record(name, kind, start, time.perf_counter(), attrs)
+
+
+def traced_node(name, fn):
+    """Wrap a LangGraph node function so each invocation is a span."""
+    def node(state):
+        with span(name, "node", retry=state.get("retry_count", 0)):
+            return fn(state)
+    node.__name__ = getattr(fn, "__name__", name)
+    return node
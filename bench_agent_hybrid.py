@@ -0,0 +1,274 @@
+"""
+Offline benchmark for the hybrid agent (no Ollama needed).
+
+Replaces the DSPy LM with bench_stub_lm.StubLM (canned or replayed answers,
+configurable artificial latency), drives build_app() over the eval batch
+and/or a synthetic scaled-up batch, and reports end-to-end questions/sec,
+per-node latency, retriever and SQLite microbenchmarks and peak memory.
+Results are saved as JSON so runs can be compared across commits:
+
+    python bench_agent_hybrid.py --scale 200 --workers 4 --latency-ms 50
+    python bench_agent_hybrid.py --compare data/bench/<previous>.json
+
+--fake-ollama serves the same canned answers from a local HTTP server
+(bench_stub_lm.FakeOllamaServer) through agent.ollama_lm.OllamaLM, so the
+pooled client, queue and retries are part of the measurement.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import dspy
+
+from agent.graph_hybrid import build_app, configure_llm_cache, set_max_llm_calls, speculation_stats
+from agent.routing import set_route_logging
+from agent.ollama_lm import OllamaLM
+from agent.runtime import get_runtime
+from bench_stub_lm import FakeOllamaServer, StubLM, _canned_sql
+from agent.tools.sql_repair import repair_stats, set_sql_repair
+from agent.tools.sql_templates import set_sql_templates, template_stats
+from agent.tools.sqlite_tool import DB_PATH, clear_sql_cache, execute_query
+from agent.tracing import start_tracing, stop_tracing
+from run_agent_hybrid import iter_questions, run_ordered
+
+BENCH_DIR = "data/bench"
+
+_MONTHS = [("January", "01", "31"), ("March", "03", "31"), ("June", "06", "30"),
+           ("September", "09", "30"), ("December", "12", "31")]
+_CATEGORIES = ["Beverages", "Condiments", "Confections", "Dairy Products", "Seafood", "Produce"]
+
+
+def synthetic_questions(n, seed=0):
+    """n deterministic questions shaped like the eval batch (distinct texts)."""
+    rng = random.Random(seed)
+    out = []
+    for i in range(n):
+        month, mm, last = rng.choice(_MONTHS)
+        year = rng.choice([1996, 1997, 1998])
+        cat = rng.choice(_CATEGORIES)
+        shape = i % 5
+        if shape == 0:
+            q = (f"What was the Average Order Value in {month} {year}? Return a float rounded to 2 decimals.", "float")
+        elif shape == 1:
+            q = (f"Top {rng.randint(2, 10)} products by total revenue all-time (variant {i}). "
+                 "Return list[{product:str, revenue:float}].", "list[{product:str, revenue:float}]")
+        elif shape == 2:
+            q = (f"Total revenue from the '{cat}' category between {year}-{mm}-01 and {year}-{mm}-{last}. "
+                 "Return a float rounded to 2 decimals.", "float")
+        elif shape == 3:
+            q = (f"According to the product policy, what is the return window (days) for {cat} (case {i})? "
+                 "Return an integer.", "int")
+        else:
+            q = (f"During {month} {year}, which product category had the highest total quantity sold? "
+                 "Return {category:str, quantity:int}.", "{category:str, quantity:int}")
+        out.append({"id": f"synthetic_{i}", "question": q[0], "format_hint": q[1]})
+    return out
+
+
+def _peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # KiB on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def _timeit(fn, reps):
+    samples = []
+    for _ in range(reps):
+        t = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t) * 1e6)
+    return {"mean_us": round(statistics.fmean(samples), 2), "p50_us": round(statistics.median(samples), 2)}
+
+
+def bench_end_to_end(app, questions, workers, use_tracemalloc=False):
+    clear_sql_cache()
+    tracer = start_tracing(None)
+    if use_tracemalloc:
+        tracemalloc.start()
+    start = time.perf_counter()
+    results = list(run_ordered(app, questions, workers))
+    elapsed = time.perf_counter() - start
+    py_peak = None
+    if use_tracemalloc:
+        py_peak = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 1)
+        tracemalloc.stop()
+    stop_tracing()
+    return {
+        "questions": len(results),
+        "elapsed_s": round(elapsed, 3),
+        "questions_per_s": round(len(results) / elapsed, 3) if elapsed else None,
+        "errors": sum(1 for r in results if r.get("final_answer") == "Error"),
+        "python_peak_mb": py_peak,
+        "per_span": tracer.summary(),
+    }
+
+
+def bench_retriever(questions, reps=200):
+    retriever = get_runtime().retriever
+    texts = [q["question"] for q in questions] or ["return policy"]
+    single = _timeit(lambda: [retriever.search(t) for t in texts], max(1, reps // len(texts)))
+    batched = _timeit(lambda: retriever.search_many(texts), max(1, reps // len(texts)))
+    return {
+        "chunks": len(retriever.chunks),
+        "queries": len(texts),
+        "search_us_per_query": round(single["mean_us"] / len(texts), 2),
+        "search_many_us_per_query": round(batched["mean_us"] / len(texts), 2),
+    }
+
+
+def bench_sqlite(reps=50):
+    if not os.path.exists(DB_PATH):
+        return {"skipped": f"{DB_PATH} not found"}
+    queries = [
+        _canned_sql({"question": "top products"}),
+        _canned_sql({"question": "which category", "plan": "1997-06-01 AND 1997-06-30"}),
+        _canned_sql({"question": "aov", "plan": "1997-12-01 AND 1997-12-31"}),
+    ]
+    out = {}
+    for i, sql in enumerate(queries):
+        execute_query(sql)  # warm pool + cache
+        out[f"q{i}"] = {
+            "uncached": _timeit(lambda: execute_query(sql, use_cache=False), reps),
+            "cached": _timeit(lambda: execute_query(sql), reps),
+        }
+    return out
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def _compare(current, previous):
+    """Print headline metric deltas vs a previous result file."""
+    def pick(r):
+        e2e = r.get("end_to_end", {})
+        ret = r.get("retriever", {})
+        return {
+            "questions_per_s": e2e.get("questions_per_s"),
+            "search_us_per_query": ret.get("search_us_per_query"),
+            "search_many_us_per_query": ret.get("search_many_us_per_query"),
+            "peak_rss_mb": r.get("peak_rss_mb"),
+        }
+    cur, prev = pick(current), pick(previous)
+    print(f"Comparison vs {previous.get('commit')} ({previous.get('timestamp')}):")
+    for k in cur:
+        a, b = cur[k], prev.get(k)
+        delta = f"{(a - b) / b * 100:+.1f}%" if isinstance(a, (int, float)) and b else "n/a"
+        print(f"   {k:<26} {b!s:>12} -> {a!s:>12}  ({delta})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark with a stub LM.")
+    parser.add_argument("--batch", default="sample_questions_hybrid_eval.jsonl")
+    parser.add_argument("--scale", type=int, default=0, help="Add N synthetic questions")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--max-llm-calls", type=int, default=1)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Stub LM latency per call")
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--responses", default=None, help="Recorded completions to replay (JSONL)")
+    parser.add_argument("--llm-cache", action="store_true", help="Keep the persistent LLM cache on")
+    parser.add_argument("--fused-plan-sql", action="store_true", help="Benchmark the fused planner+SQL graph")
+    parser.add_argument("--no-prefetch", action="store_true", help="Sequential router -> retrieval graph")
+    parser.add_argument("--speculative-plan", action="store_true", help="Speculative planning for likely-hybrid questions")
+    parser.add_argument("--no-sql-templates", action="store_true", help="Disable the SQL template fast path")
+    parser.add_argument("--no-sql-repair", action="store_true", help="Disable local rule-based SQL repair")
+    parser.add_argument("--fake-ollama", action="store_true",
+                        help="Go through OllamaLM and a local fake Ollama server instead of the in-process stub")
+    parser.add_argument("--tracemalloc", action="store_true", help="Also report Python heap peak (slower)")
+    parser.add_argument("--save", default=None, help="Result file (default: data/bench/bench_<commit>_<ts>.json)")
+    parser.add_argument("--compare", default=None, help="Previous result file to compare against")
+    parser.add_argument("--verbose", action="store_true", help="Show per-node agent output")
+    args = parser.parse_args()
+
+    server = None
+    if args.fake_ollama:
+        server = FakeOllamaServer(latency_s=args.latency_ms / 1000.0).start()
+        lm = OllamaLM(get_runtime().model, api_base=server.url, max_concurrency=max(1, args.max_llm_calls))
+        dspy.configure(lm=lm)
+    else:
+        lm = StubLM(args.responses, latency_s=args.latency_ms / 1000.0, jitter_s=args.jitter_ms / 1000.0)
+        dspy.configure(lm=lm)
+    if not args.llm_cache:
+        configure_llm_cache(enabled=False)
+    set_route_logging(False)
+    set_sql_templates(not args.no_sql_templates)
+    set_sql_repair(not args.no_sql_repair)
+    set_max_llm_calls(args.max_llm_calls)
+
+    questions = list(iter_questions(args.batch)) if os.path.exists(args.batch) else []
+    questions += synthetic_questions(args.scale)
+
+    t = time.perf_counter()
+    get_runtime().warm_up()
+    app = build_app(fused_plan_sql=args.fused_plan_sql, prefetch=not args.no_prefetch,
+                    speculative_plan=args.speculative_plan)
+    startup_s = time.perf_counter() - t
+
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with quiet:
+        e2e = bench_end_to_end(app, questions, max(1, args.workers), args.tracemalloc)
+        retr = bench_retriever(questions)
+        sql = bench_sqlite()
+
+    result = {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {k: v for k, v in vars(args).items() if k not in ("save", "compare", "verbose")},
+        "startup_s": round(startup_s, 3),
+        "end_to_end": e2e,
+        "retriever": retr,
+        "sqlite": sql,
+        "stub_lm": {**lm.stats(), "server": server.stats()} if server else lm.stats(),
+        "sql_templates": template_stats(),
+        "sql_repair": repair_stats(),
+        "speculation": speculation_stats(),
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+    print(f"End-to-end: {e2e['questions']} questions in {e2e['elapsed_s']}s "
+          f"({e2e['questions_per_s']} q/s, errors={e2e['errors']})")
+    print(f"Retriever: {retr['search_us_per_query']} us/query single, "
+          f"{retr['search_many_us_per_query']} us/query batched ({retr['chunks']} chunks)")
+    print(f"SQLite: {json.dumps(sql)}")
+    print(f"SQL templates: hit rate {result['sql_templates']['hit_rate']} {result['sql_templates']['by_template']}")
+    print(f"SQL local repair: fix rate {result['sql_repair']['local_fix_rate']} "
+          f"({result['sql_repair']['fixed']}/{result['sql_repair']['errors']}) {result['sql_repair']['by_rule']}")
+    print(f"Peak RSS: {result['peak_rss_mb']} MB")
+    print("Per span (ms):")
+    for key, s in e2e["per_span"].items():
+        print(f"   {key:<32} n={s['count']:<6} p50={s['p50_ms']:<9} p95={s['p95_ms']:<9} p99={s['p99_ms']}")
+
+    path = args.save or os.path.join(BENCH_DIR, f"bench_{result['commit']}_{int(time.time())}.json")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+    print(f"Saved benchmark results to {path}")
+
+    if server:
+        print(f"LM client: {result['stub_lm']}")
+        lm.close()
+        server.stop()
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            _compare(result, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+"""
+Deterministic stand-in LMs for offline benchmarks and tests (not part of
+the agent package).
+
+StubLM answers DSPy ChatAdapter prompts without a model server. It replays
+recorded completions when it has them and otherwise builds canned,
+well-formed answers from the prompt (valid SQLite for the SQL generator,
+answers that satisfy the format_hint for the synthesizer). It can add
+artificial latency. RecordingLM wraps a real LM and records its completions
+so a later StubLM can replay them. FakeOllamaServer serves the same canned
+answers over Ollama's HTTP API, for exercising agent.ollama_lm.OllamaLM
+without a model.
+"""
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import dspy
+
+_OUTPUT_FIELDS_RE = re.compile(r"Your output fields are:(.*?)(?:All interactions|$)", re.DOTALL)
+_FIELD_NAME_RE = re.compile(r"`(\w+)`")
+_INPUT_RE = re.compile(r"\[\[ ## (\w+) ## \]\]\n(.*?)(?=\n\n\[\[ ## |\n\nRespond with|\Z)", re.DOTALL)
+_DATE_RE = re.compile(r"(\d{4}-\d{2}-\d{2})")
+
+
+def prompt_key(messages):
+    """Stable key of a chat prompt (system + current user message)."""
+    relevant = [m for m in messages if m.get("role") == "system"][:1] + \
+               [m for m in messages if m.get("role") == "user"][-1:]
+    blob = json.dumps(relevant, sort_keys=True)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def _completion(text, model, prompt_chars):
+    message = SimpleNamespace(content=text, tool_calls=None)
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=message, finish_reason="stop", logprobs=None)],
+        usage={
+            # ~4 characters per token is close enough for relative benchmarks.
+            "prompt_tokens": prompt_chars // 4,
+            "completion_tokens": len(text) // 4,
+            "total_tokens": (prompt_chars + len(text)) // 4,
+        },
+        model=model,
+    )
+
+
+def _canned_route(question):
+    # Ignore the trailing "Return an integer." style format instruction.
+    q = question.lower().split(" return ")[0]
+    if "policy" in q or "return" in q:
+        return "rag"
+    if any(k in q for k in ("calendar", "kpi", "summer", "winter", "definition")):
+        return "hybrid"
+    return "sql"
+
+
+def _canned_sql(inputs):
+    dates = _DATE_RE.findall(" ".join(inputs.get(k, "") for k in ("plan", "question", "context")))
+    if len(dates) >= 2:
+        start, end = dates[:2]
+    elif dates:
+        start = end = dates[0]
+    else:
+        start, end = "1997-01-01", "1997-12-31"
+    q = inputs.get("question", "").lower()
+    revenue = "oi.UnitPrice * oi.Quantity * (1 - COALESCE(oi.Discount, 0))"
+    if "top" in q and "product" in q:
+        return (f"SELECT p.ProductName as product, ROUND(SUM({revenue}), 2) as revenue "
+                "FROM order_items oi JOIN products p ON oi.ProductID = p.ProductID "
+                "GROUP BY p.ProductName ORDER BY revenue DESC LIMIT 3;")
+    if "categor" in q:
+        return ("SELECT p.CategoryID, SUM(oi.Quantity) as qty FROM orders o "
+                "JOIN order_items oi ON o.OrderID = oi.OrderID JOIN products p ON oi.ProductID = p.ProductID "
+                f"WHERE date(o.OrderDate) BETWEEN '{start}' AND '{end}' "
+                "GROUP BY p.CategoryID ORDER BY qty DESC LIMIT 1;")
+    return (f"SELECT ROUND(SUM({revenue}) / COUNT(DISTINCT o.OrderID), 2) as aov FROM orders o "
+            f"JOIN order_items oi ON o.OrderID = oi.OrderID WHERE date(o.OrderDate) BETWEEN '{start}' AND '{end}';")
+
+
+def _canned_answer(format_hint):
+    fh = format_hint.replace(" ", "")
+    if fh == "int":
+        return "14"
+    if fh == "float":
+        return "1234.56"
+    if fh.startswith("list["):
+        keys = re.findall(r"(\w+):(\w+)", fh)
+        item = {k: ("Stub" if t == "str" else 1.0 if t == "float" else 1) for k, t in keys}
+        return json.dumps([item])
+    if fh.startswith("{"):
+        keys = re.findall(r"(\w+):(\w+)", fh)
+        return json.dumps({k: ("Stub" if t == "str" else 1.0 if t == "float" else 1) for k, t in keys})
+    return "Stub answer"
+
+
+def canned_outputs(output_fields, inputs):
+    """Deterministic values for each requested output field."""
+    out = {}
+    for name in output_fields:
+        if name == "classification":
+            out[name] = _canned_route(inputs.get("question", ""))
+        elif name == "date_range":
+            dates = _DATE_RE.findall(inputs.get("context", ""))
+            out[name] = f"{dates[0]} AND {dates[1]}" if len(dates) >= 2 else "None"
+        elif name == "filters":
+            out[name] = "None"
+        elif name == "column_logic":
+            out[name] = "SUM(oi.UnitPrice * oi.Quantity * (1 - oi.Discount))"
+        elif name == "sql_query":
+            out[name] = _canned_sql(inputs)
+        elif name == "final_answer":
+            out[name] = _canned_answer(inputs.get("format_hint", ""))
+        elif name == "reasoning":
+            out[name] = "Stub reasoning."
+        else:
+            out[name] = "Stub."
+    return out
+
+
+def canned_completion(messages):
+    """ChatAdapter-formatted canned answer for a chat prompt."""
+    system = next((m["content"] for m in messages if m.get("role") == "system"), "")
+    user = next((m["content"] for m in reversed(messages) if m.get("role") == "user"), "")
+    m = _OUTPUT_FIELDS_RE.search(system)
+    fields = _FIELD_NAME_RE.findall(m.group(1)) if m else ["answer"]
+    inputs = {k: v.strip() for k, v in _INPUT_RE.findall(user)}
+    outputs = canned_outputs(fields, inputs)
+    return "\n\n".join(f"[[ ## {k} ## ]]\n{v}" for k, v in outputs.items()) + "\n\n[[ ## completed ## ]]"
+
+
+class StubLM(dspy.BaseLM):
+    """
+    Offline LM: replays recorded completions (by prompt key) or returns canned
+    ChatAdapter-formatted answers, after `latency_s` (+ up to `jitter_s`) of
+    simulated inference time. Deterministic for a given seed.
+    """
+
+    def __init__(self, responses_path=None, latency_s=0.0, jitter_s=0.0, seed=0, model="stub/offline"):
+        super().__init__(model=model)
+        self.latency_s = latency_s
+        self.jitter_s = jitter_s
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.responses = {}
+        self._stats = {"calls": 0, "replayed": 0, "canned": 0}
+        if responses_path and os.path.exists(responses_path):
+            with open(responses_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        rec = json.loads(line)
+                        self.responses[rec["key"]] = rec["text"]
+
+    def _sleep(self):
+        with self._lock:
+            delay = self.latency_s + (self._rng.random() * self.jitter_s if self.jitter_s else 0.0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def forward(self, prompt=None, messages=None, **kwargs):
+        messages = messages or [{"role": "user", "content": prompt or ""}]
+        key = prompt_key(messages)
+        text = self.responses.get(key)
+
+        with self._lock:
+            self._stats["calls"] += 1
+            self._stats["replayed" if text is not None else "canned"] += 1
+
+        if text is None:
+            text = canned_completion(messages)
+
+        self._sleep()
+        prompt_chars = sum(len(m.get("content") or "") for m in messages)
+        return _completion(text, self.model, prompt_chars)
+
+    def stats(self):
+        """Call counters (calls, replayed, canned)."""
+        with self._lock:
+            return dict(self._stats)
+
+
+class RecordingLM(dspy.BaseLM):
+    """Wraps a real LM and appends each (prompt key, completion text) to a JSONL file."""
+
+    def __init__(self, inner, path):
+        super().__init__(model=inner.model)
+        self.inner = inner
+        self.path = path
+        self._lock = threading.Lock()
+
+    def forward(self, prompt=None, messages=None, **kwargs):
+        response = self.inner.forward(prompt=prompt, messages=messages, **kwargs)
+        messages = messages or [{"role": "user", "content": prompt or ""}]
+        text = response.choices[0].message.content
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"key": prompt_key(messages), "text": text}) + "\n")
+        return response
+
+
+class FakeOllamaServer:
+    """
+    Local HTTP server speaking the subset of Ollama's API OllamaLM uses
+    (/api/chat, /api/generate) with canned answers and `latency_s` per chat
+    request. To exercise retries, the first `drop_first` requests get their
+    connection closed without a response (a transport error) and the next
+    `fail_first` get HTTP 503. Use as a context manager; `url` is the
+    api_base, chat_log() the last user message of each answered chat
+    request in order.
+    """
+
+    def __init__(self, latency_s=0.0, fail_first=0, drop_first=0, port=0):
+        self.latency_s = latency_s
+        self._stats = {"chat": 0, "generate": 0, "failed": 0, "dropped": 0, "connections": 0,
+                       "keep_alive": None}
+        self._fail_left = fail_first
+        self._drop_left = drop_first
+        self._log = []
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive
+            disable_nagle_algorithm = True  # headers and body go out as separate writes
+
+            def setup(self):
+                super().setup()
+                with server._lock:
+                    server._stats["connections"] += 1
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                req = json.loads(self.rfile.read(length) or b"{}")
+                with server._lock:
+                    server._stats["keep_alive"] = req.get("keep_alive")
+                    drop = server._drop_left > 0
+                    fail = not drop and server._fail_left > 0
+                    if drop:
+                        server._drop_left -= 1
+                        server._stats["dropped"] += 1
+                    elif fail:
+                        server._fail_left -= 1
+                        server._stats["failed"] += 1
+                if drop:
+                    self.close_connection = True
+                    return
+                if fail:
+                    return self._reply(503, {"error": "model is loading"})
+                if self.path == "/api/generate":
+                    with server._lock:
+                        server._stats["generate"] += 1
+                    return self._reply(200, {"model": req.get("model"), "done": True, "response": ""})
+                if self.path != "/api/chat":
+                    return self._reply(404, {"error": "not found"})
+                if server.latency_s:
+                    time.sleep(server.latency_s)
+                messages = req.get("messages") or []
+                text = canned_completion(messages)
+                prompt_chars = sum(len(m.get("content") or "") for m in messages)
+                with server._lock:
+                    server._stats["chat"] += 1
+                    server._log.append(next((m.get("content") for m in reversed(messages)
+                                             if m.get("role") == "user"), None))
+                self._reply(200, {
+                    "model": req.get("model"),
+                    "message": {"role": "assistant", "content": text},
+                    "done": True,
+                    "done_reason": "stop",
+                    "prompt_eval_count": prompt_chars // 4,
+                    "eval_count": len(text) // 4,
+                })
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self._httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._httpd.server_address[1]}"
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    def stats(self):
+        """Request counters (chat, generate, failed, dropped, connections) and the last keep_alive."""
+        with self._lock:
+            return dict(self._stats)
+
+    def chat_log(self):
+        with self._lock:
+            return list(self._log)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -1,20 +1,38 @@
 import argparse
+import hashlib
 import json
 import multiprocessing
-import re
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import dspy
 from dspy.teleprompt import BootstrapFewShot
 
-from agent.graph_hybrid import build_app, sql_gen as base_sql_gen, app as default_app
+import agent.graph_hybrid as graph
+from agent.graph_hybrid import build_app, configure_llm_cache, get_app, set_max_llm_calls
+from agent.answer_format import validate_answer
+from agent.ollama_lm import OLLAMA_KEEP_ALIVE
+from agent.routing import ROUTER_CONFIDENCE_THRESHOLD
+from agent.runtime import LM_BACKEND, get_runtime
+from agent.tools.rollups import rollup_stats
+from agent.tools.sql_repair import repair_stats, set_sql_repair
+from agent.tools.sql_templates import set_sql_templates, template_stats
+from agent.tools.sqlite_tool import sql_cache_stats
+from agent.tracing import span, start_tracing, stop_tracing, trace_question
 
 
+# build_app() keyword defaults; get_app() is reused when a run matches them.
+DEFAULT_GRAPH_OPTIONS = {"fused_plan_sql": False, "prefetch": True, "speculative_plan": False}
+
 # -- DSPy OPTIMIZATION --
-def optimize_sql_module():
-    print("   [Optimizer] Starting optimization...")
+SQL_PROGRAM_DIR = "data/cache"
+
 
+def _sql_trainset():
     # Training examples (Question -> Plan -> Correct SQL)
-    train_data = [
+    return [
         dspy.Example(
             question="Total revenue from all orders",
             plan="Calculate sum of (UnitPrice * Quantity * (1-Discount)) from order_items table.",
@@ -31,202 +49,343 @@ def optimize_sql_module():
         ).with_inputs("question", "plan", "db_schema", "previous_error"),
     ]
 
-    def sql_metric(gold, pred, trace=None):
-        """Very lightweight metric: reward non-empty SQL that compiles pattern-wise."""
-        try:
-            return isinstance(pred.sql_query, str) and "select" in pred.sql_query.lower()
-        except Exception:
-            return False
+
+def sql_metric(gold, pred, trace=None):
+    """Very lightweight metric: reward non-empty SQL that compiles pattern-wise."""
+    try:
+        return isinstance(pred.sql_query, str) and "select" in pred.sql_query.lower()
+    except Exception:
+        return False
+
+
+def sql_program_key(base_module, trainset):
+    """Hash of everything the compiled program depends on."""
+    sig = base_module.predict.signature if hasattr(base_module, "predict") else base_module.signature
+    payload = {
+        "trainset": [sorted(ex.toDict().items()) for ex in trainset],
+        "signature": {
+            "instructions": sig.instructions,
+            "fields": {name: (f.json_schema_extra or {}).get("desc") for name, f in sig.fields.items()},
+        },
+        "model": get_runtime().model_id(),
+        "dspy": dspy.__version__,
+    }
+    blob = json.dumps(payload, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()[:16]
+
+
+def optimize_sql_module(recompile=False):
+    """
+    Return the BootstrapFewShot-compiled SQL generator.
+
+    The compiled program is saved under SQL_PROGRAM_DIR keyed by
+    sql_program_key(); later runs load it instead of recompiling unless
+    recompile=True.
+    """
+    base = get_runtime().sql_gen
+    train_data = _sql_trainset()
+    path = os.path.join(SQL_PROGRAM_DIR, f"sql_program_{sql_program_key(base, train_data)}.json")
+
+    if not recompile and os.path.exists(path):
+        program = base.deepcopy()
+        program.load(path)
+        print(f"   [Optimizer] Loaded compiled program from {path}")
+        return program
+
+    print("   [Optimizer] Starting optimization...")
 
     # Note: On Windows, this step must be under freeze_support in __main__
     optimizer = BootstrapFewShot(metric=sql_metric, max_labeled_demos=2)
-    optimized_sql_gen = optimizer.compile(base_sql_gen, trainset=train_data)
+    optimized_sql_gen = optimizer.compile(base, trainset=train_data)
+
+    try:
+        os.makedirs(SQL_PROGRAM_DIR, exist_ok=True)
+        optimized_sql_gen.save(path)
+        print(f"   [Optimizer] Saved compiled program to {path}")
+    except Exception as e:
+        print(f"   [Optimizer] Warning: could not save compiled program ({e})")
 
     print("   [Optimizer] Optimization finished.")
     return optimized_sql_gen
 
 
-def _validate_and_fix_answer(raw_value, format_hint):
+# Synthesizer re-runs allowed when the answer does not match format_hint.
+FORMAT_RETRIES = 2
+
+
+def process_question(app, q_data):
     """
-    Validate and coerce final_answer to match the required format_hint.
-    Returns (ok: bool, fixed_value).
+    Run one question through the graph. A graph failure re-runs the graph;
+    an answer that does not match format_hint only re-runs the synthesizer
+    (with the validator's feedback) on the finished state.
     """
-    fh = format_hint.strip()
-    fh_canonical = fh.replace(" ", "")
-
-    # Simple scalar types
-    if fh == "int":
-        if isinstance(raw_value, int):
-            return True, raw_value
-        if isinstance(raw_value, (float,)):
-            return True, int(raw_value)
-        if isinstance(raw_value, str):
-            nums = re.findall(r"\d+", raw_value)
-            if nums:
-                return True, int(nums[0])
-        return False, raw_value
-
-    if fh == "float":
-        if isinstance(raw_value, (int, float)):
-            return True, float(raw_value)
-        if isinstance(raw_value, str):
-            nums = re.findall(r"[-+]?\d*\.\d+|\d+", raw_value)
-            if nums:
-                return True, float(nums[0])
-        return False, raw_value
-
-    # Known object formats for this assignment
-    if fh_canonical == "{category:str,quantity:int}":
-        # Expect dict with keys category (str) and quantity (int)
-        if isinstance(raw_value, dict):
-            cat = raw_value.get("category")
-            qty = raw_value.get("quantity")
-            if isinstance(cat, str) and isinstance(qty, (int, float)):
-                return True, {"category": cat, "quantity": int(qty)}
-        if isinstance(raw_value, str):
-            try:
-                obj = json.loads(raw_value)
-                cat = obj.get("category")
-                qty = obj.get("quantity")
-                if isinstance(cat, str) and isinstance(qty, (int, float)):
-                    return True, {"category": cat, "quantity": int(qty)}
-            except Exception:
-                pass
-        return False, raw_value
-
-    if fh_canonical == "{customer:str,margin:float}":
-        if isinstance(raw_value, dict):
-            cust = raw_value.get("customer")
-            marg = raw_value.get("margin")
-            if isinstance(cust, str) and isinstance(marg, (int, float)):
-                return True, {"customer": cust, "margin": float(marg)}
-        if isinstance(raw_value, str):
-            try:
-                obj = json.loads(raw_value)
-                cust = obj.get("customer")
-                marg = obj.get("margin")
-                if isinstance(cust, str) and isinstance(marg, (int, float)):
-                    return True, {"customer": cust, "margin": float(marg)}
-            except Exception:
-                pass
-        return False, raw_value
-
-    if fh_canonical == "list[{product:str,revenue:float}]":
-        # Expect list of dicts with product (str) and revenue (float)
-        if isinstance(raw_value, list):
-            fixed_list = []
-            for item in raw_value:
-                if not isinstance(item, dict):
-                    return False, raw_value
-                prod = item.get("product")
-                rev = item.get("revenue")
-                if not isinstance(prod, str) or not isinstance(rev, (int, float)):
-                    return False, raw_value
-                fixed_list.append({"product": prod, "revenue": float(rev)})
-            return True, fixed_list
-        if isinstance(raw_value, str):
+    inputs = {
+        "question": q_data["question"],
+        "format_hint": q_data["format_hint"],
+        "retry_count": 0,
+        "error": None,
+    }
+
+    out_state = None
+    last_exception = None
+    for attempt in range(3):
+        try:
+            out_state = app.invoke(inputs)
+            break
+        except Exception as e:
+            last_exception = e
+            inputs["retry_count"] = inputs.get("retry_count", 0) + 1
+            inputs["error"] = str(e)
+
+    if out_state is None:
+        final_res = _error_result(last_exception)
+        final_res["id"] = q_data["id"]
+        return final_res
+
+    # Validate and coerce final_answer based on format_hint
+    final_res = out_state["final_output"]
+    for attempt in range(FORMAT_RETRIES + 1):
+        raw = final_res.get("final_answer")
+        ok, fixed_val, problem = validate_answer(raw, q_data["format_hint"])
+        final_res["final_answer"] = fixed_val
+        if ok or attempt == FORMAT_RETRIES:
+            break
+        feedback = f"Previous final_answer {raw!r} was rejected: {problem}. Return exactly {q_data['format_hint']}."
+        print(f"   [format] {problem}; re-synthesizing")
+        try:
+            out_state = graph.resynthesize(out_state, feedback)
+        except Exception as e:
+            print(f"   [format] re-synthesis failed: {e}")
+            break
+        final_res = out_state["final_output"]
+
+    final_res["id"] = q_data["id"]
+    return final_res
+
+
+def _error_result(exc):
+    """Catastrophic failure fallback."""
+    return {
+        "final_answer": "Error",
+        "sql": "",
+        "explanation": str(exc) if exc else "Unknown error",
+        "citations": [],
+        "confidence": 0.0,
+    }
+
+
+def _safe_process(app, q_data):
+    """process_question that never raises, so one bad question can't sink a batch."""
+    print(f"   > Processing ID: {q_data.get('id')}...")
+    try:
+        with trace_question(q_data.get("id")), span("question", "question"):
+            return process_question(app, q_data)
+    except Exception as e:
+        res = _error_result(e)
+        res["id"] = q_data.get("id")
+        return res
+
+
+def iter_questions(path, skip_ids=()):
+    """Lazily yield question dicts from a JSONL file, skipping ids in skip_ids."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
             try:
-                arr = json.loads(raw_value)
-                if isinstance(arr, list):
-                    fixed_list = []
-                    for item in arr:
-                        prod = item.get("product")
-                        rev = item.get("revenue")
-                        if not isinstance(prod, str) or not isinstance(rev, (int, float)):
-                            return False, raw_value
-                        fixed_list.append({"product": prod, "revenue": float(rev)})
-                    return True, fixed_list
-            except Exception:
-                pass
-        return False, raw_value
-
-    # Fallback: assume it's acceptable as-is
-    return True, raw_value
+                q_data = json.loads(line)
+            except ValueError as e:
+                print(f"   Warning: skipping malformed line {line_no} in {path}: {e}")
+                continue
+            if q_data.get("id") in skip_ids:
+                continue
+            yield q_data
 
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--batch", required=True)
-    parser.add_argument("--out", required=True)
-    args = parser.parse_args()
+def read_done_ids(path):
+    """
+    Ids already present in an output JSONL file (for --resume).
 
-    # 1. Run Optimization and build graph
-    print("1. Optimizing DSPy SQL Module...")
-    try:
-        optimized_sql_gen = optimize_sql_module()
-        app = build_app(optimized_sql_gen)
-        print("   Success. Using optimized SQL generator.")
-    except Exception as e:
-        print(f"   Warning: Optimization failed ({e}). Continuing with base module.")
-        app = default_app
+    A trailing partial line left by a crash mid-write is truncated away so
+    appended results start on a fresh line.
+    """
+    if not os.path.exists(path):
+        return set()
+
+    with open(path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            keep = data.rfind(b"\n") + 1
+            f.truncate(keep)
+            data = data[:keep]
+
+    done = set()
+    for line in data.decode("utf-8").splitlines():
+        try:
+            done.add(json.loads(line)["id"])
+        except (ValueError, KeyError, TypeError):
+            continue
+    return done
 
-    # 2. Load Questions
-    try:
-        with open(args.batch, "r", encoding="utf-8") as f:
-            questions = [json.loads(line) for line in f if line.strip()]
-    except Exception as e:
-        print(f"CRITICAL ERROR reading JSONL file: {e}")
-        return
 
-    results = []
+class ResultWriter:
+    """Appends results to a JSONL file, flushing + fsyncing every `sync_every` rows."""
 
-    # 3. Process
-    print(f"2. Processing {len(questions)} questions...")
-    for q_data in questions:
-        print(f"   > Processing ID: {q_data['id']}...")
+    def __init__(self, path, append=False, sync_every=10):
+        self.f = open(path, "a" if append else "w", encoding="utf-8")
+        self.sync_every = max(1, sync_every)
+        self.count = 0
 
-        inputs = {
-            "question": q_data["question"],
-            "format_hint": q_data["format_hint"],
-            "retry_count": 0,
-            "error": None,
-        }
+    def write(self, result):
+        self.f.write(json.dumps(result) + "\n")
+        self.count += 1
+        if self.count % self.sync_every == 0:
+            self.sync()
 
-        final_res = None
-        last_exception = None
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
 
-        # Repair loop: up to 2 attempts on output shape in addition to SQL repair in-graph
-        for attempt in range(3):
-            try:
-                out_state = app.invoke(inputs)
-                final_res = out_state["final_output"]
-            except Exception as e:
-                last_exception = e
-                inputs["retry_count"] = inputs.get("retry_count", 0) + 1
-                inputs["error"] = str(e)
-                continue
+    def close(self):
+        self.sync()
+        self.f.close()
 
-            # Validate and coerce final_answer based on format_hint
-            ok, fixed_val = _validate_and_fix_answer(
-                final_res.get("final_answer"), q_data["format_hint"]
-            )
-            final_res["final_answer"] = fixed_val
-            if ok:
-                break
 
-            # Mark validation error and give the graph another chance
-            inputs["retry_count"] = inputs.get("retry_count", 0) + 1
-            inputs["error"] = "output_format_mismatch"
-
-        if final_res is None:
-            # Catastrophic failure fallback
-            final_res = {
-                "final_answer": "Error",
-                "sql": "",
-                "explanation": str(last_exception) if last_exception else "Unknown error",
-                "citations": [],
-                "confidence": 0.0,
-            }
+def run_ordered(app, questions, workers):
+    """
+    Yield results in input order while up to `workers` questions run at once.
 
-        final_res["id"] = q_data["id"]
-        results.append(final_res)
+    Only a small window of futures is kept in memory, so the question stream
+    is consumed lazily no matter how large the batch is.
+    """
+    if workers == 1:
+        for q_data in questions:
+            yield _safe_process(app, q_data)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        window = deque()
+        for q_data in questions:
+            window.append(pool.submit(_safe_process, app, q_data))
+            if len(window) >= workers * 2:
+                yield window.popleft().result()
+        while window:
+            yield window.popleft().result()
 
-    # 4. Save
-    with open(args.out, "w", encoding="utf-8") as f:
-        for r in results:
-            f.write(json.dumps(r) + "\n")
 
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch", required=True)
+    parser.add_argument("--out", required=True)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Questions processed concurrently (default: 1, sequential)")
+    parser.add_argument("--max-llm-calls", type=int, default=1,
+                        help="Max LLM calls in flight at once across workers (default: 1)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip ids already present in --out and append the rest")
+    parser.add_argument("--sync-every", type=int, default=10,
+                        help="Flush and fsync the output every N results (default: 10)")
+    parser.add_argument("--no-llm-cache", action="store_true",
+                        help="Always call the LLM instead of reusing cached responses")
+    parser.add_argument("--llm-cache-ttl", type=float, default=None,
+                        help="Expire cached LLM responses after N seconds (default: never)")
+    parser.add_argument("--trace-dir", default=None,
+                        help="Write per-span traces (trace.jsonl, trace.chrome.json) to this directory")
+    parser.add_argument("--recompile", action="store_true",
+                        help="Rebuild the compiled DSPy SQL program instead of loading the saved one")
+    parser.add_argument("--router-threshold", type=float, default=None,
+                        help="Min local-classifier confidence to skip the LLM router (default: %.2f)"
+                        % ROUTER_CONFIDENCE_THRESHOLD)
+    parser.add_argument("--fused-plan-sql", action="store_true",
+                        help="Plan and generate SQL in one LLM call instead of two")
+    parser.add_argument("--no-prefetch", action="store_true",
+                        help="Run retrieval after the router instead of in parallel with it")
+    parser.add_argument("--speculative-plan", action="store_true",
+                        help="Start planning before routing finishes for likely-hybrid questions")
+    parser.add_argument("--no-sql-templates", action="store_true",
+                        help="Always generate SQL with the LLM (skip the KPI template fast path)")
+    parser.add_argument("--no-sql-repair", action="store_true",
+                        help="Send every SQL error to the LLM (skip local rule-based repair)")
+    parser.add_argument("--lm-backend", choices=["litellm", "ollama"], default=LM_BACKEND,
+                        help="LM client: litellm (dspy.LM) or ollama (pooled async client with a "
+                             "priority queue; --max-llm-calls sets its concurrency) (default: %(default)s)")
+    parser.add_argument("--keep-alive", default=OLLAMA_KEEP_ALIVE,
+                        help="How long Ollama keeps the model loaded, ollama backend only (default: %(default)s)")
+    args = parser.parse_args()
+
+    if args.router_threshold is not None:
+        get_runtime().router_threshold = args.router_threshold
+    get_runtime().lm_backend = args.lm_backend
+    get_runtime().lm_options.update(keep_alive=args.keep_alive, max_concurrency=max(1, args.max_llm_calls))
+    if args.no_llm_cache:
+        configure_llm_cache(enabled=False)
+    elif args.llm_cache_ttl is not None:
+        configure_llm_cache(ttl_s=args.llm_cache_ttl)
+    if args.no_sql_templates:
+        set_sql_templates(False)
+    if args.no_sql_repair:
+        set_sql_repair(False)
+
+    if not os.path.exists(args.batch):
+        print(f"CRITICAL ERROR reading JSONL file: {args.batch} not found")
+        return
+
+    # 1. Build shared components, run Optimization and build graph
+    graph_options = {
+        "fused_plan_sql": args.fused_plan_sql,
+        "prefetch": not args.no_prefetch,
+        "speculative_plan": args.speculative_plan,
+    }
+    get_runtime().warm_up()
+    print("1. Optimizing DSPy SQL Module...")
+    try:
+        optimized_sql_gen = optimize_sql_module(recompile=args.recompile)
+        app = build_app(optimized_sql_gen, **graph_options)
+        print("   Success. Using optimized SQL generator.")
+    except Exception as e:
+        print(f"   Warning: Optimization failed ({e}). Continuing with base module.")
+        app = build_app(**graph_options) if graph_options != DEFAULT_GRAPH_OPTIONS else get_app()
+    if args.fused_plan_sql:
+        print("   Graph mode: fused planner + SQL generation (one LLM call)")
+
+    # 2. Questions are streamed from the batch file
+    done_ids = read_done_ids(args.out) if args.resume else set()
+    if done_ids:
+        print(f"   Resuming: {len(done_ids)} questions already in {args.out}")
+    questions = iter_questions(args.batch, skip_ids=done_ids)
+
+    # 3. Process, writing each result as soon as it is ready
+    workers = max(1, args.workers)
+    set_max_llm_calls(args.max_llm_calls)
+    print(f"2. Processing questions (workers={workers}, max_llm_calls={args.max_llm_calls})...")
+    start = time.perf_counter()
+    start_tracing(args.trace_dir)
+    writer = ResultWriter(args.out, append=args.resume, sync_every=args.sync_every)
+    try:
+        for result in run_ordered(app, questions, workers):
+            writer.write(result)
+    finally:
+        writer.close()
+        tracer = stop_tracing()
+    elapsed = time.perf_counter() - start
+
+    qpm = writer.count / elapsed * 60 if elapsed > 0 else 0.0
     print(f"Done. Results saved to {args.out}")
+    print(f"Throughput: {writer.count} questions in {elapsed:.1f}s ({qpm:.2f} questions/min)")
+    if graph.llm_cache is not None:
+        print(f"LLM cache: {graph.llm_cache.stats()}")
+    print(f"SQL cache: {sql_cache_stats()}")
+    print(f"SQL rollups: {rollup_stats()}")
+    print(f"SQL templates: {template_stats()}")
+    print(f"SQL local repair: {repair_stats()}")
+    if args.speculative_plan:
+        print(f"Speculative planning: {graph.speculation_stats()}")
+    if hasattr(get_runtime().lm, "stats"):
+        print(f"LM client: {get_runtime().lm.stats()}")
+    print("Latency per span (ms):")
+    print(tracer.format_summary())
+    if args.trace_dir:
+        print(f"Traces written to {args.trace_dir}/trace.jsonl and trace.chrome.json")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,71 @@
+"""
+Shared fixtures. The agent resolves data/ and docs/ relative to the working
+directory, so the session runs in a temp dir holding a small synthetic
+Northwind database (same tables and compatibility view as the real one),
+a copy of docs/ and the query expansion file.
+"""
+import os
+import random
+import shutil
+import sqlite3
+
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CATEGORIES = ["Beverages", "Condiments", "Confections", "Dairy Products",
+              "Grains/Cereals", "Meat/Poultry", "Produce", "Seafood"]
+
+
+def build_northwind(path, seed=1, orders=800):
+    """Write a deterministic synthetic Northwind database to path."""
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE Categories (CategoryID INTEGER PRIMARY KEY, CategoryName TEXT, Description TEXT);
+        CREATE TABLE Customers (CustomerID TEXT PRIMARY KEY, CompanyName TEXT, Country TEXT);
+        CREATE TABLE Products (ProductID INTEGER PRIMARY KEY, ProductName TEXT, SupplierID INTEGER,
+                               CategoryID INTEGER REFERENCES Categories(CategoryID),
+                               UnitPrice REAL, Discontinued INTEGER);
+        CREATE TABLE Orders (OrderID INTEGER PRIMARY KEY, CustomerID TEXT REFERENCES Customers(CustomerID),
+                             EmployeeID INTEGER, OrderDate TEXT, ShipCountry TEXT);
+        CREATE TABLE "Order Details" (OrderID INTEGER REFERENCES Orders(OrderID),
+                                      ProductID INTEGER REFERENCES Products(ProductID),
+                                      UnitPrice REAL, Quantity INTEGER, Discount REAL,
+                                      PRIMARY KEY (OrderID, ProductID));
+        CREATE VIEW order_items AS SELECT * FROM "Order Details";
+    """)
+    rng = random.Random(seed)
+    for i, name in enumerate(CATEGORIES, 1):
+        conn.execute("INSERT INTO Categories VALUES (?, ?, '')", (i, name))
+    for i in range(30):
+        conn.execute("INSERT INTO Customers VALUES (?, ?, ?)",
+                     (f"C{i:03d}", f"Company {i}", rng.choice(["USA", "UK", "Germany"])))
+    for i in range(1, 78):
+        conn.execute("INSERT INTO Products VALUES (?, ?, 1, ?, ?, 0)",
+                     (i, f"Product {i}", rng.randint(1, 8), round(rng.uniform(5, 100), 2)))
+    for order_id in range(10248, 10248 + orders):
+        date = f"{rng.choice([1996, 1997, 1998])}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d} 00:00:00"
+        conn.execute("INSERT INTO Orders VALUES (?, ?, 1, ?, 'USA')",
+                     (order_id, f"C{rng.randint(0, 29):03d}", date))
+        for product in rng.sample(range(1, 78), rng.randint(1, 4)):
+            conn.execute('INSERT INTO "Order Details" VALUES (?, ?, ?, ?, ?)',
+                         (order_id, product, round(rng.uniform(5, 100), 2), rng.randint(1, 50),
+                          rng.choice([0, 0.05, 0.1])))
+    conn.commit()
+    conn.close()
+
+
+@pytest.fixture(scope="session", autouse=True)
+def workdir(tmp_path_factory):
+    """Run the session in a temp dir with data/northwind.sqlite, docs/ and data/query_expansions.json."""
+    root = tmp_path_factory.mktemp("workdir")
+    os.makedirs(root / "data" / "cache")
+    build_northwind(str(root / "data" / "northwind.sqlite"))
+    shutil.copytree(os.path.join(REPO, "docs"), root / "docs")
+    shutil.copy(os.path.join(REPO, "data", "query_expansions.json"), root / "data")
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        yield root
+    finally:
+        os.chdir(cwd)
@@ -0,0 +1,35 @@
+import pytest
+
+from agent.answer_format import validate_answer
+
+
+@pytest.mark.parametrize("value, hint, expected", [
+    ("About 14 days.", "int", 14),
+    ("1234.56", "float", 1234.56),
+    (7, "float", 7.0),
+    ('{"category": "Beverages", "quantity": 12.0}', "{category:str, quantity:int}",
+     {"category": "Beverages", "quantity": 12}),
+    ("[{'product': 'Chai', 'revenue': 10}]", "list[{product:str, revenue:float}]",
+     [{"product": "Chai", "revenue": 10.0}]),
+])
+def test_valid_answers_are_coerced(value, hint, expected):
+    ok, fixed, problem = validate_answer(value, hint)
+    assert ok and problem is None
+    assert fixed == expected
+
+
+@pytest.mark.parametrize("value, hint", [
+    # Fields are strictly typed: no numbers pulled out of strings.
+    ({"category": "Beverages", "quantity": "12 units"}, "{category:str, quantity:int}"),
+    ({"customer": "Company 1", "margin": "1.5k"}, "{customer:str, margin:float}"),
+    ([{"product": "Chai", "revenue": "n/a 10"}], "list[{product:str, revenue:float}]"),
+    ({"category": "Beverages", "quantity": True}, "{category:str, quantity:int}"),
+    ({"category": 3, "quantity": 12}, "{category:str, quantity:int}"),
+    ({"category": "Beverages"}, "{category:str, quantity:int}"),
+    ("no number here", "int"),
+])
+def test_mismatches_are_reported(value, hint):
+    ok, fixed, problem = validate_answer(value, hint)
+    assert not ok
+    assert fixed == value
+    assert problem
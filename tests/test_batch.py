@@ -0,0 +1,58 @@
+import json
+import os
+import random
+import time
+
+import pytest
+
+import run_agent_hybrid
+from run_agent_hybrid import ResultWriter, iter_questions, read_done_ids, run_ordered
+
+
+@pytest.fixture
+def fake_process(monkeypatch):
+    """process_question that takes a random time and fails for id 'q3'."""
+    rng = random.Random(0)
+
+    def process(app, q_data):
+        time.sleep(rng.uniform(0, 0.02))
+        if q_data["id"] == "q3":
+            raise RuntimeError("boom")
+        return {"id": q_data["id"], "final_answer": q_data["question"].upper()}
+
+    monkeypatch.setattr(run_agent_hybrid, "process_question", process)
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_results_keep_input_order(fake_process, workers):
+    questions = ({"id": f"q{i}", "question": f"question {i}"} for i in range(20))
+    results = list(run_ordered(None, questions, workers))
+    assert [r["id"] for r in results] == [f"q{i}" for i in range(20)]
+    assert results[3]["final_answer"] == "Error" and "boom" in results[3]["explanation"]
+    assert results[4]["final_answer"] == "QUESTION 4"
+
+
+def test_resume_after_a_truncated_line(fake_process, tmp_path, monkeypatch):
+    batch, out = tmp_path / "batch.jsonl", tmp_path / "out.jsonl"
+    batch.write_text("".join(json.dumps({"id": f"q{i}", "question": f"question {i}"}) + "\n"
+                             for i in range(8)) + "\n{not json\n", encoding="utf-8")
+    out.write_text(json.dumps({"id": "q0", "final_answer": "A"}) + "\n"
+                   + json.dumps({"id": "q1", "final_answer": "B"}) + "\n"
+                   + '{"id": "q2", "final_ans', encoding="utf-8")  # crashed mid-write
+
+    done = read_done_ids(str(out))
+    assert done == {"q0", "q1"}
+    assert out.read_text(encoding="utf-8").endswith('"B"}\n')
+
+    syncs = []
+    real_fsync = os.fsync
+    monkeypatch.setattr(os, "fsync", lambda fd: (syncs.append(fd), real_fsync(fd)))
+    writer = ResultWriter(str(out), append=True, sync_every=2)
+    for result in run_ordered(None, iter_questions(str(batch), skip_ids=done), 3):
+        writer.write(result)
+    writer.close()
+    assert len(syncs) == 6 // 2 + 1  # every 2 rows, plus close()
+
+    rows = [json.loads(line) for line in out.read_text(encoding="utf-8").splitlines()]
+    assert [r["id"] for r in rows] == [f"q{i}" for i in range(8)]
+    assert read_done_ids(str(out)) == {f"q{i}" for i in range(8)}
@@ -0,0 +1,52 @@
+import random
+
+import numpy as np
+import pytest
+
+from agent.rag.bm25 import SparseBM25
+from agent.rag.retrieval import LocalRetriever
+
+WORDS = ["order", "revenue", "beverages", "policy", "return", "days", "kpi", "aov", "margin",
+         "customer", "product", "summer", "winter", "dairy", "seafood", "unopened", "window"]
+
+
+def _corpus(seed=0, docs=60):
+    rng = random.Random(seed)
+    return [rng.choices(WORDS[:rng.randint(3, len(WORDS))], k=rng.randint(0, 25)) for _ in range(docs)]
+
+
+def _queries(seed=1, n=40):
+    rng = random.Random(seed)
+    return [rng.choices(WORDS + ["unknown"], k=rng.randint(1, 5)) for _ in range(n)]
+
+
+def _dense_top_k(scores, k):
+    # The pre-sparse baseline: stable sort of every positive score.
+    order = sorted((i for i in range(len(scores)) if scores[i] > 0), key=lambda i: -scores[i])
+    return [(i, scores[i]) for i in order[:k]]
+
+
+def test_scores_match_rank_bm25():
+    rank_bm25 = pytest.importorskip("rank_bm25")
+    corpus = _corpus()
+    reference, sparse_bm25 = rank_bm25.BM25Okapi(corpus), SparseBM25(corpus)
+    for query in _queries():
+        np.testing.assert_allclose(sparse_bm25.get_scores(query), reference.get_scores(query), rtol=1e-9)
+
+
+@pytest.mark.parametrize("k", [1, 3, 10, 100])
+def test_partial_top_k_matches_full_sort(k):
+    corpus = _corpus(docs=80) + _corpus(docs=20)  # repeats the first 20 docs: exact ties
+    bm25 = SparseBM25(corpus)
+    queries = _queries()
+    for query, hits in zip(queries, bm25.top_k(queries, k)):
+        expected = _dense_top_k(bm25.get_scores(query), k)
+        assert [i for i, _ in hits] == [i for i, _ in expected]
+        np.testing.assert_allclose([s for _, s in hits], [s for _, s in expected], rtol=1e-12)
+
+
+def test_search_many_matches_search():
+    retriever = LocalRetriever("docs/", persist=False)
+    queries = ["return policy for beverages", "AOV definition", "summer campaign dates", "zzz"]
+    assert retriever.search_many(queries, k=3) == [retriever.search(q, k=3) for q in queries]
+    assert retriever.search_many(["zzz"]) == [[]]
@@ -0,0 +1,49 @@
+import json
+import random
+
+from agent.rag.expansion import EXPANSIONS_PATH, QueryExpander
+
+
+def test_shipped_rules_expand_their_triggers():
+    expander = QueryExpander.load(EXPANSIONS_PATH)
+    assert expander.expand("Return window for Beverages?") == (
+        "return window for beverages? returns policy days window beverages drinks unopened opened")
+    assert "marketing calendar campaign dates" in expander.expand("AOV in Summer 1997")
+    assert expander.expand("Top 3 products") == "top 3 products"
+
+
+def test_missing_rules_file_means_no_expansion(tmp_path):
+    assert QueryExpander.load(str(tmp_path / "none.json")).expand("Return policy") == "return policy"
+
+
+def test_every_overlapping_match_fires_each_rule_once():
+    expander = QueryExpander([
+        {"match": ["order value", "average order value"], "expand": ["aov"]},
+        {"match": ["value"], "expand": ["amount"]},
+        {"match": ["he", "she", "hers"], "expand": ["pronoun"]},
+    ])
+    # Nested triggers are all reported, not just the longest one.
+    assert expander.matches("average order value") == [0, 1]
+    # "she", "he" and "hers" overlap inside "ushers": the rule still fires once.
+    assert expander.expand("ushers") == "ushers pronoun"
+
+
+def test_word_rules_need_whole_words():
+    expander = QueryExpander([{"match": ["kpi"], "expand": {"definition": 2.0}, "word": True},
+                              {"match": ["cat"], "expand": ["category"]}])
+    assert expander.matches("kpis and categories") == [1]
+    assert expander.matches("the kpi, defined") == [0]
+    assert expander.weighted_tokens("KPI kpi") == {"kpi": 2.0, "definition": 2.0}
+
+
+def test_automaton_agrees_with_substring_search():
+    with open(EXPANSIONS_PATH, encoding="utf-8") as f:
+        rules = json.load(f)["expansions"]
+    expander = QueryExpander(rules)
+    words = ["return", "policy", "beverages", "aov", "average", "order", "value", "kpi",
+             "summer", "winter", "categories", "x", "polic", "retur"]
+    rng = random.Random(0)
+    for _ in range(300):
+        query = rng.choice(["", " ", "-"]).join(rng.choices(words, k=rng.randint(1, 6)))
+        expected = [i for i, rule in enumerate(rules) if any(t in query for t in rule["match"])]
+        assert expander.matches(query) == expected, query
@@ -0,0 +1,28 @@
+import shutil
+
+import dspy
+import pytest
+
+from agent.graph_hybrid import build_app, configure_llm_cache
+from bench_stub_lm import StubLM
+
+
+@pytest.fixture
+def app():
+    dspy.configure(lm=StubLM())
+    configure_llm_cache(enabled=False)
+    yield build_app(prefetch=True)
+    configure_llm_cache()
+
+
+@pytest.mark.parametrize("question", [
+    "According to the product policy, what is the return window (days) for unopened Beverages?",
+    "What is the returns process for unopened items?",  # not obviously rag locally: warm-up runs and fails
+])
+def test_rag_questions_work_without_a_database(app, question, workdir, tmp_path, monkeypatch):
+    shutil.copytree(workdir / "docs", tmp_path / "docs")
+    (tmp_path / "data").mkdir()
+    monkeypatch.chdir(tmp_path)
+    out = app.invoke({"question": question + " Return an integer.", "format_hint": "int", "retry_count": 0})
+    assert out["route"] == "rag"
+    assert out["final_output"]["final_answer"] == "14"
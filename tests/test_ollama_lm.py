@@ -0,0 +1,109 @@
+import threading
+import time
+
+import pytest
+
+from agent.ollama_lm import OllamaLM, request_priority
+from bench_stub_lm import FakeOllamaServer
+
+
+def _ask(lm, text):
+    return lm.forward(messages=[{"role": "user", "content": text}]).choices[0].message.content
+
+
+@pytest.fixture
+def make_lm():
+    lms = []
+
+    def make(server, **kwargs):
+        kwargs.setdefault("backoff_s", 0.001)
+        lms.append(OllamaLM("ollama_chat/llama3.1:8b", api_base=server.url, **kwargs))
+        return lms[-1]
+
+    yield make
+    for lm in lms:
+        lm.close()
+
+
+def test_retries_5xx_responses(make_lm):
+    with FakeOllamaServer(fail_first=2) as server:
+        lm = make_lm(server, max_retries=2)
+        assert _ask(lm, "hello")
+        assert server.stats()["failed"] == 2
+        assert lm.stats()["retries"] == 2
+        assert lm.stats()["errors"] == 0
+
+
+def test_retries_transport_errors(make_lm):
+    with FakeOllamaServer(drop_first=1, fail_first=1) as server:
+        lm = make_lm(server, max_retries=2)
+        assert _ask(lm, "hello")
+        assert server.stats()["dropped"] == 1
+        assert lm.stats()["retries"] == 2
+
+
+def test_gives_up_after_max_retries(make_lm):
+    with FakeOllamaServer(fail_first=5) as server:
+        lm = make_lm(server, max_retries=1)
+        with pytest.raises(RuntimeError, match="after 2 attempts"):
+            _ask(lm, "hello")
+        assert lm.stats()["errors"] == 1
+        assert server.stats()["failed"] == 2
+
+
+def test_queued_requests_run_by_priority(make_lm):
+    with FakeOllamaServer(latency_s=0.3) as server:
+        lm = make_lm(server, max_concurrency=1)
+
+        def ask(text, priority):
+            with request_priority(priority):
+                _ask(lm, text)
+
+        first = threading.Thread(target=ask, args=("first", 5))
+        first.start()
+        time.sleep(0.1)  # the single worker is now busy with "first"
+        queued = [threading.Thread(target=ask, args=args)
+                  for args in [("route", 5), ("synth", 0), ("sql", 2)]]
+        for t in queued:
+            t.start()
+        for t in [first, *queued]:
+            t.join()
+        assert server.chat_log() == ["first", "synth", "sql", "route"]
+
+
+def test_keep_alive_and_connection_reuse(make_lm):
+    with FakeOllamaServer() as server:
+        lm = make_lm(server, keep_alive="30m")
+        lm.warm()
+        assert server.stats()["generate"] == 1
+        for i in range(5):
+            _ask(lm, f"question {i}")
+        stats = server.stats()
+        assert stats["chat"] == 5
+        assert stats["keep_alive"] == "30m"
+        assert stats["connections"] == 1
+
+
+def test_startup_failure_is_raised_not_hung(make_lm, monkeypatch):
+    import httpx
+
+    def broken_client(*args, **kwargs):
+        raise ValueError("bad client config")
+
+    with FakeOllamaServer() as server:
+        lm = make_lm(server)
+        monkeypatch.setattr(httpx, "AsyncClient", broken_client)
+        errors = []
+
+        def ask():
+            try:
+                _ask(lm, "hello")
+            except ValueError as e:
+                errors.append(e)
+
+        t = threading.Thread(target=ask, daemon=True)
+        t.start()
+        t.join(timeout=5)
+        assert not t.is_alive() and str(errors[0]) == "bad client config"
+        monkeypatch.undo()
+        assert _ask(lm, "hello")  # the next call starts the loop afresh
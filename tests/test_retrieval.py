@@ -0,0 +1,21 @@
+import threading
+
+from agent.rag import retrieval
+
+
+def test_parallel_ingest_matches_serial_with_threads_running(tmp_path, monkeypatch):
+    paths = []
+    for i in range(6):
+        path = tmp_path / f"doc{i}.md"
+        path.write_text(f"# Doc {i}\n\n## Section\n- item {i} alpha\n- item {i} beta\n", encoding="utf-8")
+        paths.append(str(path))
+    serial = dict(retrieval._iter_ingest(paths))
+    stop = threading.Event()
+    busy = threading.Thread(target=stop.wait, daemon=True)  # a live thread, as in batch runs
+    busy.start()
+    monkeypatch.setattr(retrieval, "INGEST_PARALLEL_MIN_FILES", 2)
+    try:
+        parallel = dict(retrieval._iter_ingest(paths, workers=2))
+    finally:
+        stop.set()
+    assert parallel == serial
@@ -0,0 +1,128 @@
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from agent.tools import rollups
+from agent.tools.rollups import ROLLUP_DB_PATH, build_rollups, rewrite_for_rollups
+from agent.tools.sqlite_tool import DB_PATH, execute_query
+
+ALL_JOINS = {"orders", "products", "categories", "customers"}
+
+REVENUE = "SUM(oi.UnitPrice * oi.Quantity * (1 - oi.Discount))"
+
+EQUIVALENT = [
+    f"SELECT {REVENUE} AS revenue FROM orders o JOIN order_items oi ON oi.OrderID = o.OrderID "
+    "WHERE date(o.OrderDate) BETWEEN '1997-01-01' AND '1997-12-31'",
+    "SELECT SUM(oi.Quantity) FROM order_items oi JOIN products p ON p.ProductID = oi.ProductID "
+    "WHERE p.CategoryID = 1",
+    f"SELECT c.CategoryName, {REVENUE} AS Revenue FROM order_items oi "
+    "JOIN products p ON p.ProductID = oi.ProductID JOIN categories c ON c.CategoryID = p.CategoryID "
+    "GROUP BY c.CategoryName ORDER BY Revenue DESC",
+    f"SELECT cu.CompanyName, ROUND({REVENUE}, 2) FROM orders o "
+    "JOIN order_items oi ON oi.OrderID = o.OrderID JOIN customers cu ON cu.CustomerID = o.CustomerID "
+    "GROUP BY cu.CompanyName ORDER BY 2 DESC LIMIT 5",
+    "SELECT strftime('%Y-%m', o.OrderDate) AS month, COUNT(DISTINCT o.OrderID) AS orders "
+    "FROM orders o JOIN order_items oi ON oi.OrderID = o.OrderID GROUP BY month ORDER BY month",
+    "SELECT o.CustomerID, COUNT(DISTINCT o.OrderID) FROM orders o "
+    "JOIN order_items oi ON oi.OrderID = o.OrderID GROUP BY o.CustomerID ORDER BY o.CustomerID",
+]
+
+NOT_REWRITTEN = [
+    # Not an aggregate: one row per product per day from the rollup.
+    "SELECT p.ProductName FROM order_items oi JOIN products p ON p.ProductID = oi.ProductID "
+    "WHERE p.CategoryID = 1",
+    # Bare dimension column outside GROUP BY.
+    "SELECT p.ProductName, SUM(oi.Quantity) FROM order_items oi "
+    "JOIN products p ON p.ProductID = oi.ProductID GROUP BY p.CategoryID",
+    # Sorted by a column that is neither grouped nor an output.
+    "SELECT p.CategoryID, SUM(oi.Quantity) FROM order_items oi "
+    "JOIN products p ON p.ProductID = oi.ProductID GROUP BY p.CategoryID ORDER BY p.ProductName",
+    # Filter on a column the rollups do not carry.
+    "SELECT SUM(oi.Quantity) FROM order_items oi WHERE oi.UnitPrice > 10",
+]
+
+
+def _fetch(path, sql):
+    conn = sqlite3.connect(path)
+    try:
+        cursor = conn.execute(sql)
+        return [d[0] for d in cursor.description], cursor.fetchall()
+    finally:
+        conn.close()
+
+
+def _assert_same_rows(base, rolled):
+    assert len(base) == len(rolled)
+    for base_row, rolled_row in zip(base, rolled):
+        for a, b in zip(base_row, rolled_row):
+            assert b == (pytest.approx(a) if isinstance(a, float) else a)
+
+
+@pytest.fixture(scope="module")
+def sidecar():
+    build_rollups()
+    yield ROLLUP_DB_PATH
+    rollups.close_rollup_pool()
+
+
+@pytest.mark.parametrize("sql", EQUIVALENT)
+def test_rollup_results_match_base_tables(sidecar, sql):
+    rewritten = rewrite_for_rollups(sql, ALL_JOINS)
+    assert rewritten is not None
+    base_cols, base_rows = _fetch(DB_PATH, sql)
+    rolled_cols, rolled_rows = _fetch(sidecar, rewritten)
+    assert rolled_cols == base_cols
+    _assert_same_rows(base_rows, rolled_rows)
+
+
+@pytest.mark.parametrize("sql", NOT_REWRITTEN)
+def test_non_equivalent_shapes_are_not_rewritten(sql):
+    assert rewrite_for_rollups(sql, ALL_JOINS) is None
+
+
+def test_unverified_joins_are_not_rewritten():
+    sql = EQUIVALENT[3]
+    assert rewrite_for_rollups(sql, ALL_JOINS - {"customers"}) is None
+    # Leaving orders out is only safe if every order line has an order.
+    assert rewrite_for_rollups(EQUIVALENT[1], {"products"}) is None
+    assert rewrite_for_rollups(EQUIVALENT[1], {"orders", "products"}) is not None
+
+
+def test_build_records_lossless_joins(sidecar):
+    meta = dict(_fetch(sidecar, "SELECT key, value FROM rollup_meta")[1])
+    assert set(meta["lossless_joins"].split(",")) == ALL_JOINS
+
+
+def test_orphan_order_lines_disable_the_join(tmp_path):
+    db = tmp_path / "orphans.sqlite"
+    conn = sqlite3.connect(DB_PATH)
+    conn.execute("VACUUM INTO ?", (str(db),))
+    conn.close()
+    conn = sqlite3.connect(db)
+    conn.execute("INSERT INTO Orders VALUES (1, 'NOPE', 1, '1997-01-01 00:00:00', 'USA')")
+    conn.execute("""INSERT INTO "Order Details" VALUES (1, 1, 10.0, 1, 0)""")
+    conn.commit()
+    conn.close()
+    out = tmp_path / "rollups.sqlite"
+    build_rollups(str(db), str(out))
+    meta = dict(_fetch(str(out), "SELECT key, value FROM rollup_meta")[1])
+    assert set(meta["lossless_joins"].split(",")) == ALL_JOINS - {"customers"}
+
+
+def test_execute_query_routes_and_keeps_column_names(sidecar):
+    sql = EQUIVALENT[1]
+    routed, error = execute_query(sql, use_cache=False)
+    base, base_error = execute_query(sql, use_cache=False, use_rollups=False)
+    assert error is None and base_error is None
+    assert routed.splitlines()[0] == base.splitlines()[0] == "| SUM(oi.Quantity) |"
+    assert rollups.rollup_stats()["routed"] >= 1
+
+
+def test_routing_counts_every_call_across_threads(sidecar):
+    version = rollups._db_version(DB_PATH)
+    before = rollups.rollup_stats()["routed"]
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        routed = list(pool.map(lambda _: rollups.route_query(EQUIVALENT[0], version), range(400)))
+    assert all(r is not None for r in routed)
+    assert rollups.rollup_stats()["routed"] == before + 400
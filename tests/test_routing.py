@@ -0,0 +1,97 @@
+import json
+import os
+import subprocess
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+from agent import graph_hybrid
+from agent.routing import ROUTER_CONFIDENCE_THRESHOLD, RouteClassifier, load_training_data
+from agent.runtime import AgentRuntime, set_runtime
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LOGGED = [
+    ("What is the return window for unopened beverages per the policy?", "rag", "llm"),
+    ("Summarize the returns policy for perishable items.", "rag", "llm"),
+    ("Which document defines the AOV KPI?", "rag", "rule"),
+    ("Top 3 products by total revenue all time.", "sql", "llm"),
+    ("How many orders were shipped to Germany in 1997?", "sql", "llm"),
+    ("Total quantity sold per category in 1998.", "sql", "label"),
+    ("Revenue from Beverages during Summer Beverages 1997 as defined in the marketing calendar.", "hybrid", "llm"),
+    ("AOV during Winter Classics 1997 using the KPI definition.", "hybrid", "llm"),
+    ("Best customer by gross margin in 1997 per the KPI docs.", "hybrid", "rule"),
+    # The classifier's own decisions are never trained on.
+    ("Total quantity sold per category in 1998.", "rag", "classifier"),
+]
+
+
+def _write_log(path):
+    with open(path, "w", encoding="utf-8") as f:
+        for question, route, source in LOGGED:
+            f.write(json.dumps({"question": question, "route": route, "source": source}) + "\n")
+        f.write('{"question": "truncated\n')
+
+
+def test_training_data_skips_classifier_decisions(tmp_path):
+    log = tmp_path / "route_log.jsonl"
+    _write_log(log)
+    questions, routes = load_training_data(str(log))
+    assert len(questions) == 9
+    assert dict(zip(questions, routes))["Total quantity sold per category in 1998."] == "sql"
+
+
+def test_train_cli_writes_a_loadable_model(tmp_path):
+    log, model = tmp_path / "route_log.jsonl", tmp_path / "route_classifier.pkl"
+    _write_log(log)
+    subprocess.run([sys.executable, "-m", "agent.routing", "--train", "--log", str(log), "--model", str(model)],
+                   cwd=REPO, check=True, capture_output=True)
+    clf = RouteClassifier.load(str(model))
+    assert clf.trained_on == 9
+    assert clf.predict("How many orders were shipped to Germany in 1997?")[0] == "sql"
+
+
+@pytest.fixture
+def routed(tmp_path, monkeypatch):
+    """route_question with a classifier trained on LOGGED and an LLM router that answers 'sql'."""
+    log = tmp_path / "route_log.jsonl"
+    _write_log(log)
+    clf = RouteClassifier().fit(*load_training_data(str(log)))
+    runtime = AgentRuntime()
+    runtime._components["route_classifier"] = clf
+    old = set_runtime(runtime)
+    llm_calls = []
+
+    def fake_call_llm(module, **kwargs):
+        llm_calls.append(kwargs["question"])
+        return SimpleNamespace(classification="sql")
+
+    monkeypatch.setattr(graph_hybrid, "call_llm", fake_call_llm)
+    monkeypatch.chdir(tmp_path)
+
+    def route(question):
+        out = graph_hybrid.route_question({"question": question})
+        with open("data/routing/route_log.jsonl", encoding="utf-8") as f:
+            last = json.loads(f.readlines()[-1])
+        return out["route"], last["source"], last["confidence"]
+
+    yield clf, route, llm_calls
+    set_runtime(old)
+
+
+def test_confident_classifier_skips_the_llm_router(routed):
+    clf, route, llm_calls = routed
+    question = "How many orders were shipped to Germany in 1997?"
+    assert clf.predict(question)[1] >= ROUTER_CONFIDENCE_THRESHOLD
+    assert route(question)[:2] == ("sql", "classifier")
+    assert llm_calls == []
+
+
+def test_unsure_classifier_falls_back_to_the_llm_router(routed):
+    clf, route, llm_calls = routed
+    question = "Which supplier ships the fewest items?"
+    confidence = clf.predict(question)[1]
+    assert confidence < ROUTER_CONFIDENCE_THRESHOLD
+    assert route(question) == ("sql", "llm", round(confidence, 4))
+    assert llm_calls == [question]
@@ -0,0 +1,21 @@
+from agent.prompt_budget import estimate_tokens
+from agent.tools.schema import SCHEMA_TABLES, get_schema_string
+
+
+def test_schema_within_budget_is_untrimmed():
+    full = get_schema_string()
+    assert get_schema_string(max_tokens=estimate_tokens(full)) == full
+
+
+def test_trimming_drops_columns_before_tables():
+    full = get_schema_string()
+    no_samples = "\n".join(line for line in full.split("\n") if not line.startswith("Sample values:"))
+    budget = estimate_tokens(no_samples) - 10
+    trimmed = get_schema_string(max_tokens=budget)
+    assert estimate_tokens(trimmed) <= budget
+    assert "Sample values:" not in trimmed
+    assert "more)" in trimmed
+    for table in SCHEMA_TABLES:
+        assert f"Table: {table} " in trimmed
+    # Keys survive so joins can still be written.
+    assert "OrderID" in trimmed and "ProductID" in trimmed and "CustomerID" in trimmed
@@ -0,0 +1,53 @@
+from agent.tools.sql_repair import FUNCTION_RENAMES, repair_sql
+from agent.tools.sqlite_tool import execute_query
+
+JOIN = "FROM products p JOIN order_items oi ON p.ProductID = oi.ProductID"
+
+
+def _error(sql):
+    result, error = execute_query(sql, use_cache=False)
+    assert error, result
+    return error
+
+
+def test_ambiguous_join_key_is_qualified():
+    sql = f"SELECT ProductID, SUM(oi.Quantity) {JOIN} GROUP BY ProductID"
+    fixed, rule = repair_sql(sql, _error(sql))
+    assert rule == "alias_prefix"
+    assert fixed == f"SELECT p.ProductID, SUM(oi.Quantity) {JOIN} GROUP BY p.ProductID"
+    assert execute_query(fixed, use_cache=False)[1] is None
+
+
+def test_ambiguous_non_key_column_is_left_to_the_llm():
+    # p.UnitPrice is the list price, oi.UnitPrice the sale price: picking one changes the revenue.
+    sql = f"SELECT SUM(UnitPrice * oi.Quantity) {JOIN}"
+    assert repair_sql(sql, _error(sql)) is None
+
+
+def test_wrong_alias_with_several_candidate_tables_is_left_to_the_llm():
+    sql = f"SELECT SUM(x.UnitPrice * oi.Quantity) {JOIN}"
+    assert repair_sql(sql, _error(sql)) is None
+
+
+def test_wrong_alias_with_one_candidate_table_is_fixed():
+    sql = f"SELECT SUM(x.Quantity) {JOIN}"
+    fixed, rule = repair_sql(sql, _error(sql))
+    assert rule == "wrong_alias"
+    assert fixed == f"SELECT SUM(oi.Quantity) {JOIN}"
+
+
+def test_unbound_qualifier_names_the_inserted_join():
+    sql = ("SELECT p.ProductName, p.CategoryID, SUM(oi.Quantity) FROM order_items oi "
+           "GROUP BY p.ProductName, p.CategoryID")
+    fixed, rule = repair_sql(sql, _error(sql))
+    assert rule == "join_insertion"
+    assert " join products p on oi.productid = p.productid" in fixed.lower()
+    assert execute_query(fixed, use_cache=False)[1] is None
+
+
+def test_nvl_becomes_coalesce():
+    # GenerateSQL forbids IFNULL, so repairs must not introduce it.
+    assert FUNCTION_RENAMES["isnull"] == FUNCTION_RENAMES["nvl"] == "coalesce"
+    sql = "SELECT nvl(MAX(oi.Quantity), 0) FROM order_items oi"
+    fixed, rule = repair_sql(sql, _error(sql))
+    assert (fixed, rule) == ("SELECT coalesce(MAX(oi.Quantity), 0) FROM order_items oi", "function_rewrite")
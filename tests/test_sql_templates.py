@@ -0,0 +1,51 @@
+import pytest
+
+from agent.tools.sql_templates import match_template
+
+SUMMER_PLAN = "Date Range: 1997-06-01 AND 1997-06-30\nFilters: Beverages\nLogic: SUM(revenue)"
+
+
+@pytest.mark.parametrize("question, plan, template, fragments", [
+    ("Total revenue from the 'Beverages' category during 'Summer Beverages 1997' dates. "
+     "Return a float rounded to 2 decimals.", SUMMER_PLAN, "revenue",
+     ["p.CategoryID = 1", "BETWEEN '1997-06-01' AND '1997-06-30'"]),
+    ("What was the Average Order Value in March 1997? Return a float rounded to 2 decimals.", "", "aov",
+     ["BETWEEN '1997-03-01' AND '1997-03-31'"]),
+    ("Top 3 products by total revenue all-time. Revenue uses Order Details: "
+     "SUM(UnitPrice*Quantity*(1-Discount)). Return list[{product:str, revenue:float}].", "",
+     "top_products_by_revenue", ["LIMIT 3"]),
+    ("Per the KPI definition of gross margin, who was the top customer by gross margin in 1997? "
+     "Assume CostOfGoods is approximated by 70% of UnitPrice if not available. "
+     "Return {customer:str, margin:float}.", "", "customer_gross_margin",
+     ["BETWEEN '1997-01-01' AND '1997-12-31'", "LIMIT 1"]),
+])
+def test_known_shapes_use_templates(question, plan, template, fragments):
+    name, sql = match_template(question, plan)
+    assert name == template
+    for fragment in fragments:
+        assert fragment in sql
+
+
+@pytest.mark.parametrize("question", [
+    "What was the total revenue of customer ALFKI in 1997?",
+    "Total revenue for product 'Chai' in 1997.",
+    "Total revenue of orders shipped to Germany in 1997.",
+    "Total revenue from Germany in 1997.",  # a country name from the database
+    "Total revenue from discontinued products.",
+    "How many orders had revenue above 500?",
+    "What was the AOV for customers in the USA?",
+    "What was the average revenue of Beverages orders?",
+    "Total revenue in 1996 and 1997.",
+    "Total revenue between 1997-01-01 and 1997-01-31 and in 1998.",
+    "Who was the top customer by gross margin in 1997? Assume CostOfGoods is approximated by 60% of UnitPrice.",
+    "Total revenue during 'Summer Beverages 1997'.",  # campaign dates not resolved by the planner
+])
+def test_unconsumed_filters_fall_through_to_the_llm(question):
+    assert match_template(question) is None
+
+
+def test_planner_filters_other_than_category_fall_through():
+    plan = "Date Range: 1997-01-01 AND 1997-12-31\nFilters: ProductName = 'Chai'\nLogic: SUM(revenue)"
+    assert match_template("Total revenue in 1997.", plan) is None
+    plan = "Date Range: None\nFilters: None\nLogic: SUM(revenue)"
+    assert match_template("Total revenue in 1997.", plan)[0] == "revenue"
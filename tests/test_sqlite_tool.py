@@ -0,0 +1,170 @@
+import os
+import shutil
+import sqlite3
+import threading
+
+import pytest
+
+from agent.tools import sqlite_tool
+from agent.tools.sqlite_tool import SQLResultCache, canonicalize_sql, execute_query
+
+
+@pytest.mark.parametrize("a, b", [
+    ("SELECT  a ,b FROM t WHERE x = 'A  B' ;", "select a,b from t where x='A  B'"),
+    ("SELECT /* note */ a FROM t -- trailing", "select a from t"),
+    ("select a from t;  -- done", "SELECT a FROM t"),
+    ("SELECT 5 - - 3", "SELECT 5 - -3"),
+])
+def test_canonical_forms_match(a, b):
+    assert canonicalize_sql(a) == canonicalize_sql(b)
+
+
+@pytest.mark.parametrize("a, b", [
+    ("SELECT 5 - -3 AS x", "SELECT 5--3 AS x"),
+    ("SELECT a FROM t WHERE x = 'A'", "SELECT a FROM t WHERE x = 'a'"),
+    ('SELECT "A B" FROM t', 'SELECT "a b" FROM t'),
+    ("SELECT a <= b", "SELECT a < = b"),
+])
+def test_canonical_forms_differ(a, b):
+    assert canonicalize_sql(a) != canonicalize_sql(b)
+
+
+def test_comment_is_not_cached_as_operator():
+    sqlite_tool.clear_sql_cache()
+    assert "| 8 |" in execute_query("SELECT 5 - -3 AS x")[0]
+    assert "| 5 |" in execute_query("SELECT 5--3 AS x")[0]
+
+
+def test_result_cache_hits_misses_and_invalidates():
+    cache = SQLResultCache(max_entries=2)
+    assert cache.get("q1", (1, 10)) is None
+    cache.put("q1", (1, 10), ("rows", None))
+    assert cache.get("q1", (1, 10)) == ("rows", None)
+    assert cache.get("q1", (2, 10)) is None  # new mtime: dropped
+    cache.put("q1", (2, 10), ("rows", None))
+    assert cache.get("q1", (2, 11)) is None  # new size: dropped
+    for key in ("a", "b", "c"):
+        cache.put(key, (2, 11), (key, None))
+    assert cache.get("a", (2, 11)) is None  # LRU evicted
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["invalidations"]) == (1, 4, 2)
+    assert stats["entries"] == 2 and stats["evictions"] == 1
+
+
+def test_execute_query_cache_follows_db_file(workdir, tmp_path, monkeypatch):
+    db = tmp_path / "northwind.sqlite"
+    shutil.copy(workdir / sqlite_tool.DB_PATH, db)
+    monkeypatch.setattr(sqlite_tool, "DB_PATH", str(db))
+    sqlite_tool.close_pool()
+    sqlite_tool.clear_sql_cache()
+    try:
+        sql = "SELECT COUNT(*) AS n FROM Orders"
+        first = execute_query(sql, use_rollups=False)
+        before = sqlite_tool.sql_cache_stats()
+        assert execute_query(sql.lower() + ";", use_rollups=False) == first
+        assert sqlite_tool.sql_cache_stats()["hits"] == before["hits"] + 1
+
+        st = os.stat(db)
+        os.utime(db, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+        execute_query(sql, use_rollups=False)
+        after = sqlite_tool.sql_cache_stats()
+        assert after["misses"] == before["misses"] + 1
+        assert after["invalidations"] == before["invalidations"] + 1
+    finally:
+        sqlite_tool.close_pool()
+        sqlite_tool.clear_sql_cache()
+
+
+@pytest.mark.parametrize("sql", [
+    "DELETE FROM Orders",
+    "ATTACH DATABASE 'other.db' AS other",
+    "PRAGMA table_info(Orders)",
+    "VACUUM",
+    "SELECT load_extension('x')",
+])
+def test_writes_and_side_channels_are_rejected(sql):
+    assert execute_query(sql, use_cache=False) == (None, sqlite_tool.UNSAFE_QUERY_ERROR)
+
+
+def test_runaway_query_times_out(monkeypatch):
+    monkeypatch.setattr(sqlite_tool, "SQL_TIMEOUT_S", 0.2)
+    sql = "WITH RECURSIVE r(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM r) SELECT COUNT(*) FROM r"
+    result, error = execute_query(sql, use_rollups=False)
+    assert result is None and error.startswith(sqlite_tool.TIMEOUT_ERROR)
+    assert sqlite_tool.canonicalize_sql(sql) not in sqlite_tool._result_cache._data  # load-dependent
+
+
+def test_cartesian_plan_is_flagged_with_full_table_names(monkeypatch, capsys):
+    sql = 'SELECT COUNT(*) FROM "Order Details", Orders'
+    attrs = {}
+    result, error = sqlite_tool._run_query(sql, attrs, use_rollups=False)
+    assert error is None and result
+    assert [sorted(t) for t in attrs["cartesian_scan"]] == [['"Order Details"', "Orders"]]
+    assert '"Order Details"' in capsys.readouterr().out
+
+    monkeypatch.setattr(sqlite_tool, "SQL_PLAN_CHECK", "block")
+    result, error = sqlite_tool._run_query("SELECT COUNT(*) FROM Orders o, Customers c", use_rollups=False)
+    assert result is None and error.startswith("Error: Query plan is a cartesian product")
+    joined = "SELECT COUNT(*) FROM Orders o JOIN Customers c ON c.CustomerID = o.CustomerID"
+    assert sqlite_tool._run_query(joined, use_rollups=False)[1] is None
+
+
+def test_pool_reuses_connections_and_counts():
+    pool = sqlite_tool.ConnectionPool(sqlite_tool.DB_PATH, max_connections=2)
+    try:
+        for _ in range(3):
+            with pool.connection() as conn:
+                conn.execute("SELECT 1").fetchone()
+        stats = pool.stats()
+        assert (stats["opens"], stats["hits"], stats["waits"], stats["open"]) == (1, 2, 0, 1)
+    finally:
+        pool.close()
+
+
+def test_pool_blocks_at_max_connections():
+    pool = sqlite_tool.ConnectionPool(sqlite_tool.DB_PATH, max_connections=1)
+    got = threading.Event()
+
+    def borrow():
+        with pool.connection():
+            got.set()
+
+    try:
+        with pool.connection():
+            t = threading.Thread(target=borrow)
+            t.start()
+            assert not got.wait(0.2)  # blocked while the only connection is out
+        t.join(timeout=5)
+        assert got.is_set()
+        stats = pool.stats()
+        assert (stats["opens"], stats["waits"], stats["open"]) == (1, 1, 1)
+        assert stats["wait_time_s"] > 0
+    finally:
+        pool.close()
+    with pytest.raises(RuntimeError, match="closed"):
+        with pool.connection():
+            pass
+
+
+def test_pool_connections_are_read_only_without_the_authorizer():
+    pool = sqlite_tool.ConnectionPool(sqlite_tool.DB_PATH, pragmas={})  # no query_only
+    try:
+        with pool.connection() as conn:
+            conn.set_authorizer(None)
+            with pytest.raises(sqlite3.OperationalError, match="readonly"):
+                conn.execute("DELETE FROM Orders")
+            conn.set_authorizer(sqlite_tool._read_only_authorizer)
+    finally:
+        pool.close()
+
+
+def test_close_pool_reopens_on_next_query():
+    execute_query("SELECT 1", use_cache=False)
+    old = sqlite_tool.get_pool()
+    sqlite_tool.close_pool()
+    assert sqlite_tool.pool_stats() == {}
+    assert execute_query("SELECT 1 AS one", use_cache=False)[1] is None
+    assert sqlite_tool.get_pool() is not old
+    with pytest.raises(RuntimeError):
+        with old.connection():
+            pass
@@ -0,0 +1,15 @@
+import pytest
+
+from agent.tracing import _percentile
+
+
+@pytest.mark.parametrize("n, pct, expected", [
+    (10, 50, 5), (10, 95, 10), (10, 90, 9), (10, 10, 1), (10, 0, 1), (10, 100, 10),
+    (4, 50, 2), (4, 75, 3), (4, 76, 4), (5, 50, 3), (100, 95, 95), (100, 99, 99), (1, 99, 1),
+])
+def test_percentile_is_nearest_rank(n, pct, expected):
+    assert _percentile(list(range(1, n + 1)), pct) == expected
+
+
+def test_percentile_of_nothing_is_zero():
+    assert _percentile([], 50) == 0.0